@@ -0,0 +1,227 @@
+"""A local cache of downloaded bot submissions.
+
+Each submission is stored once, under a hash of its object key, as the
+archive it was downloaded as and a read-only tree extracted from the
+download stream while the archive is written (see extract.py, which also
+bounds its size and file count). Matches copy the tree into their own
+working directory, so concurrent games never share files and a submission
+that plays hundreds of matches is downloaded and unpacked once. Entries are
+evicted least-recently-used first when the cache grows past its disk
+budget.
+"""
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import extract
+
+TREE_NAME = "tree"
+ARCHIVE_NAME = "archive"
+
+def _tree_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+def _chmod_writable(path, writable):
+    mode = os.lstat(path).st_mode
+    if writable:
+        mode |= stat.S_IWUSR
+    else:
+        mode &= ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    os.chmod(path, stat.S_IMODE(mode))
+
+def _set_writable(path, writable):
+    """Add or remove write permission on everything under path."""
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            full = os.path.join(root, name)
+            if not os.path.islink(full):
+                _chmod_writable(full, writable)
+    _chmod_writable(path, writable)
+
+class _Tee:
+    """A stream that copies everything read from it to out, up to limit
+    bytes."""
+
+    def __init__(self, stream, out, limit):
+        self.stream = stream
+        self.out = out
+        self.limit = limit
+        self.copied = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.copied += len(data)
+        if self.copied > self.limit:
+            raise extract.ArchiveError("Archive is larger than %d bytes" % self.limit)
+        self.out.write(data)
+        return data
+
+    def drain(self):
+        """Copy the rest of the stream, which extraction may not have read."""
+        while self.read(extract.CHUNK):
+            pass
+
+class ArtifactCache:
+
+    def __init__(self, root, bucket, budget_bytes, prefetch_workers=2,
+                 max_bytes=extract.MAX_BYTES, max_files=extract.MAX_FILES):
+        """root: cache directory. bucket: a boto3 Bucket or storage.LocalBucket.
+        budget_bytes: evict entries once the cache holds more than this.
+        max_bytes, max_files: limits on one unpacked submission."""
+        self.root = os.path.abspath(root)
+        self.bucket = bucket
+        self.budget_bytes = budget_bytes
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        os.makedirs(self.root, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # digest -> (size in bytes, last use time)
+        self._entries = {}
+        # digest -> number of checkouts in progress; those are never evicted
+        self._in_use = {}
+        # digest -> (lock held while that entry is being downloaded, number
+        # of fetches holding or waiting for it); removed when that's 0
+        self._fetching = {}
+        self._prefetcher = ThreadPoolExecutor(max_workers=prefetch_workers)
+
+        for digest in os.listdir(self.root):
+            entry = os.path.join(self.root, digest)
+            if not (os.path.isdir(os.path.join(entry, TREE_NAME)) and
+                    os.path.isfile(os.path.join(entry, ARCHIVE_NAME))):
+                # left over from an interrupted download, or from before
+                # archives were kept
+                _set_writable(entry, True)
+                shutil.rmtree(entry, ignore_errors=True)
+                continue
+            self._entries[digest] = (_tree_size(entry), os.stat(entry).st_mtime)
+
+    def _digest(self, key):
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, digest):
+        return os.path.join(self.root, digest)
+
+    def fetch(self, key):
+        """Make sure the submission stored under key is cached. Returns the
+        path to its read-only extracted tree."""
+        return os.path.join(self._fetch(key), TREE_NAME)
+
+    def archive(self, key):
+        """Like fetch, but returns the path to the submission's archive, as
+        it was downloaded."""
+        return os.path.join(self._fetch(key), ARCHIVE_NAME)
+
+    def _fetch(self, key):
+        """Cache the submission stored under key. Returns its entry's path."""
+        digest = self._digest(key)
+        with self._lock:
+            fetch_lock, count = self._fetching.get(digest, (None, 0))
+            if fetch_lock is None:
+                fetch_lock = threading.Lock()
+            self._fetching[digest] = (fetch_lock, count + 1)
+        try:
+            with fetch_lock:
+                fetched = self._fetch_locked(key, digest)
+        finally:
+            with self._lock:
+                fetch_lock, count = self._fetching[digest]
+                if count == 1:
+                    del self._fetching[digest]
+                else:
+                    self._fetching[digest] = (fetch_lock, count - 1)
+        if fetched:
+            self._evict(keep=digest)
+        return self._entry_path(digest)
+
+    def _fetch_locked(self, key, digest):
+        """Download the entry unless it's cached. Returns whether it had to."""
+        entry = self._entry_path(digest)
+        with self._lock:
+            if digest in self._entries:
+                now = time.time()
+                self._entries[digest] = (self._entries[digest][0], now)
+                # survives restarts: the startup scan reads mtimes
+                os.utime(entry, (now, now))
+                return False
+
+        staging = tempfile.mkdtemp(prefix=".fetch-", dir=self.root)
+        try:
+            tree = os.path.join(staging, TREE_NAME)
+            body = self.bucket.Object(key).get()['Body']
+            try:
+                with open(os.path.join(staging, ARCHIVE_NAME), "wb") as archive:
+                    tee = _Tee(body, archive, self.max_bytes)
+                    extract.extract(tee, tree, self.max_bytes, self.max_files)
+                    tee.drain()
+            finally:
+                body.close()
+            _set_writable(tree, False)
+            _chmod_writable(os.path.join(staging, ARCHIVE_NAME), False)
+            size = _tree_size(staging)
+            os.rename(staging, entry)
+        except Exception:
+            _set_writable(staging, True)
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        with self._lock:
+            self._entries[digest] = (size, time.time())
+        return True
+
+    def checkout(self, key, destination):
+        """Copy the submission stored under key into destination (which may
+        already exist), leaving the copy writable."""
+        digest = self._digest(key)
+        with self._lock:
+            self._in_use[digest] = self._in_use.get(digest, 0) + 1
+        try:
+            tree = self.fetch(key)
+            shutil.copytree(tree, destination, symlinks=True, dirs_exist_ok=True)
+        finally:
+            with self._lock:
+                self._in_use[digest] -= 1
+                if self._in_use[digest] == 0:
+                    del self._in_use[digest]
+        _set_writable(destination, True)
+
+    def prefetch(self, keys):
+        """Download submissions in the background, ignoring failures."""
+        for key in keys:
+            if self._digest(key) not in self._entries:
+                self._prefetcher.submit(self._prefetch_one, key)
+
+    def _prefetch_one(self, key):
+        try:
+            self.fetch(key)
+        except Exception as e:
+            print("Failed to prefetch " + key + ": " + str(e))
+
+    def _evict(self, keep=None):
+        """Remove least recently used entries until the cache fits its budget,
+        never removing keep (the entry just fetched) or entries in use."""
+        with self._lock:
+            total = sum(size for size, _ in self._entries.values())
+            if total <= self.budget_bytes:
+                return
+            victims = []
+            for digest, (size, used) in sorted(self._entries.items(), key=lambda e: e[1][1]):
+                if total <= self.budget_bytes:
+                    break
+                if digest == keep or digest in self._in_use:
+                    continue
+                victims.append(digest)
+                del self._entries[digest]
+                total -= size
+        for digest in victims:
+            entry = self._entry_path(digest)
+            _set_writable(entry, True)
+            shutil.rmtree(entry, ignore_errors=True)
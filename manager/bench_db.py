@@ -0,0 +1,150 @@
+"""Benchmark: finished matches written back per second when many finish at once.
+
+Compares the old scheme, where every thread shared one connection guarded by
+a polled DB_BEING_USED flag, with the Database pool. Runs against a
+throwaway sqlite stand-in database; --latency adds a delay to every query to
+stand in for the round trip to a remote Postgres server.
+
+    python3 bench_db.py [--matches 400] [--threads 16] [--latency 2]
+"""
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+import db
+import results
+
+TEAMS = 20
+
+def setup(path, matches):
+    conn = db.connect_sqlite(path, create=True)
+    rnd = random.Random(0)
+    for team in range(1, TEAMS+1):
+        conn.execute("INSERT INTO battlecode_teams VALUES (?, ?)", (team, "team%d" % team))
+    pairs = []
+    for match_id in range(1, matches+1):
+        red, blue = rnd.sample(range(1, TEAMS+1), 2)
+        pairs.append((match_id, red, blue))
+        conn.execute("INSERT INTO scrimmage_matches (id, red_team, blue_team, status) VALUES (?, ?, ?, 'running')", (match_id, red, blue))
+    conn.commit()
+    conn.close()
+    return pairs
+
+class LatentCursor:
+    def __init__(self, cursor, latency):
+        self._cursor = cursor
+        self._latency = latency
+
+    def execute(self, query, params=()):
+        time.sleep(self._latency)
+        return self._cursor.execute(query, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class LatentConnection(sqlite3.Connection):
+    """A sqlite3 connection whose queries each take an extra latency seconds."""
+    latency = 0
+
+    def cursor(self, *args):
+        return LatentCursor(sqlite3.Connection.cursor(self, *args), self.latency)
+
+    def commit(self):
+        time.sleep(self.latency)
+        sqlite3.Connection.commit(self)
+
+def connect(path, latency):
+    LatentConnection.latency = latency
+    return sqlite3.connect(path, timeout=30, check_same_thread=False,
+                           factory=LatentConnection)
+
+class SpinFlagDatabase:
+    """The old arrangement: one connection, one cursor and a polled flag."""
+
+    def __init__(self, path, latency):
+        self.conn = connect(path, latency)
+        self.c = self.conn.cursor()
+        self.sneak = {'DB_BEING_USED': False}
+
+    def record_result(self, match_id, red_team, blue_team, winner, keys, winners):
+        red_elo, blue_elo = results.elo_update(self.rating(red_team), self.rating(blue_team), winner)
+        while self.sneak['DB_BEING_USED']:
+            time.sleep(0.005)
+        self.sneak['DB_BEING_USED'] = True
+        db.execute(self.c, self.conn, "UPDATE scrimmage_matches SET status='completed', match_files=%s, match_winners=%s, red_rating_after=%s, blue_rating_after=%s, finish_time=CURRENT_TIMESTAMP WHERE id=%s", [keys,winners,red_elo,blue_elo,match_id])
+        self.conn.commit()
+        self.sneak['DB_BEING_USED'] = False
+
+    def rating(self, team_id):
+        while self.sneak['DB_BEING_USED']:
+            time.sleep(0.005)
+        self.sneak['DB_BEING_USED'] = True
+        elos = []
+        for side in ('red', 'blue'):
+            db.execute(self.c, self.conn, "SELECT " + side + "_rating_after, finish_time FROM scrimmage_matches WHERE ranked = TRUE and status = 'completed' and " + side + "_team=%s ORDER BY finish_time DESC", [team_id])
+            elos += self.c.fetchall()
+        self.sneak['DB_BEING_USED'] = False
+        if len(elos) == 0:
+            return results.ELO_START
+        return sorted(elos, key=lambda x: x[1], reverse=True)[0][0]
+
+def run(finish, pairs, threads):
+    """Finish every match from threads threads; returns (seconds, errors)."""
+    work = Queue()
+    for pair in pairs:
+        work.put(pair)
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                match_id, red, blue = work.get_nowait()
+            except Empty:
+                return
+            try:
+                finish(match_id, red, blue, 1 + match_id % 2, ["replay"], [red])
+            except Exception as e:
+                errors.append(e)
+
+    start = time.time()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.time() - start, errors
+
+def main():
+    parser = OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--matches", type="int", default=400)
+    parser.add_option("--threads", type="int", default=16)
+    parser.add_option("--pool-size", type="int", default=4)
+    parser.add_option("--latency", type="float", default=2,
+            help="milliseconds added to every query and commit")
+    options, _ = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    for name in ("spin-flag", "pool"):
+        path = os.path.join(workdir, name + ".db")
+        pairs = setup(path, options.matches)
+        if name == "spin-flag":
+            finish = SpinFlagDatabase(path, options.latency / 1000).record_result
+        else:
+            database = db.Database(lambda: connect(path, options.latency / 1000), size=options.pool_size)
+            finish = lambda *args: results.record_result(database, *args)
+        elapsed, errors = run(finish, pairs, options.threads)
+        print("%-10s %6.1f matches/s  (%d matches, %d threads, %.1fms latency, %d errors)" % (
+            name, len(pairs) / elapsed, len(pairs), options.threads,
+            options.latency, len(errors)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Benchmark: time from a match being ready to a Python bot logging in.
+
+Compares a cold start (python3 Battle.py, as run.sh does) with a
+forkserver.py template that has had --warmup seconds to import the bot's
+modules, the way the worker overlaps it with createGame. A stand-in engine
+on 127.0.0.1:6147 answers each login and records when it arrived.
+
+By default the bot is player-python's testplayer with its battlecode.py;
+--bot DIR uses a bot directory with a Battle.py instead.
+
+    python3 bench_startup.py [--runs 20] [--warmup 1.0] [--bot DIR]
+"""
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+import forkserver
+
+PLAYER_PYTHON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "player-python")
+ENGINE_ADDRESS = ("127.0.0.1", 6147)
+
+class LoginRecorder:
+    """Accepts bot connections and records the time each key logged in."""
+
+    def __init__(self):
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(ENGINE_ADDRESS)
+        self._server.listen(64)
+        self._lock = threading.Condition()
+        self.logins = {}
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self._server.accept()
+            thread = threading.Thread(target=self._login, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _login(self, conn):
+        with conn, conn.makefile('rb') as stream:
+            line = stream.readline()
+            arrived = time.time()
+            try:
+                key = json.loads(line.decode()).get('key')
+            except ValueError:
+                return
+            with self._lock:
+                self.logins[key] = arrived
+                self._lock.notify_all()
+
+    def wait(self, key, timeout=30):
+        with self._lock:
+            self._lock.wait_for(lambda: key in self.logins, timeout)
+            return self.logins.get(key)
+
+def make_bot(directory):
+    os.makedirs(directory)
+    shutil.copy(os.path.join(PLAYER_PYTHON, "battlecode.py"), directory)
+    shutil.copy(os.path.join(PLAYER_PYTHON, "testplayer.py"), os.path.join(directory, "Battle.py"))
+
+def stop(process):
+    process.kill()
+    process.wait()
+
+def cold(bot_dir, recorder, key):
+    env = dict(os.environ, BATTLECODE_IP=ENGINE_ADDRESS[0], BATTLECODE_PLAYER_KEY=key)
+    start = time.time()
+    process = subprocess.Popen([sys.executable, "Battle.py"], cwd=bot_dir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    arrived = recorder.wait(key)
+    stop(process)
+    return arrived - start if arrived else None
+
+def forked(bot_dir, recorder, key, warmup):
+    process = subprocess.Popen([sys.executable, forkserver.__file__, "Battle.py", ENGINE_ADDRESS[0]],
+                               cwd=bot_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+    time.sleep(warmup)
+    start = time.time()
+    forkserver.write_key(bot_dir, key)
+    arrived = recorder.wait(key)
+    os.killpg(process.pid, 9)
+    process.wait()
+    return arrived - start if arrived else None
+
+def report(name, times):
+    times = sorted(t for t in times if t is not None)
+    if not times:
+        print("%-12s no logins" % name)
+        return
+    print("%-12s mean %6.1f ms   p50 %6.1f ms   max %6.1f ms   (%d runs)" % (
+        name, 1000 * sum(times) / len(times), 1000 * times[len(times) // 2], 1000 * times[-1], len(times)))
+
+def main():
+    parser = OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--runs", type="int", default=20)
+    parser.add_option("--warmup", type="float", default=1.0,
+                      help="seconds the template gets before the key arrives")
+    parser.add_option("--bot", default=None,
+                      help="bot directory with a Battle.py (default: player-python's testplayer)")
+    options, _ = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_startup-")
+    try:
+        source = options.bot
+        if source is None:
+            source = os.path.join(workdir, "bot")
+            make_bot(source)
+        recorder = LoginRecorder()
+        cold_times, fork_times = [], []
+        for run in range(options.runs):
+            for times, launch in ((cold_times, cold), (fork_times, forked)):
+                bot_dir = os.path.join(workdir, "run%d-%s" % (run, launch.__name__))
+                shutil.copytree(source, bot_dir)
+                key = "%s-%d" % (launch.__name__, run)
+                if launch is cold:
+                    times.append(cold(bot_dir, recorder, key))
+                else:
+                    times.append(forked(bot_dir, recorder, key, options.warmup))
+        report("cold", cold_times)
+        report("forkserver", fork_times)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Helpers for talking to the scrimmage database.
+
+The manager runs against Postgres through psycopg2. Everything here also
+accepts a sqlite3 connection, which is what local testing uses as a stand-in
+for the real database.
+"""
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    from Queue import LifoQueue, Empty
+except ImportError:
+    from queue import LifoQueue, Empty
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+    _PG_TRANSIENT = (psycopg2.OperationalError, psycopg2.InterfaceError,
+                     psycopg2.extensions.TransactionRollbackError)
+except ImportError:
+    _PG_TRANSIENT = ()
+
+def is_sqlite(conn):
+    return isinstance(conn, sqlite3.Connection)
+
+def prepare(conn, query):
+    """Convert a query written with %s placeholders to the connection's style."""
+    if is_sqlite(conn):
+        return query.replace('%s', '?')
+    return query
+
+def execute(cursor, conn, query, params=()):
+    cursor.execute(prepare(conn, query), params)
+    return cursor
+
+SQLITE_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema_sqlite.sql")
+
+def connect_sqlite(path, create=False):
+    """Open a sqlite3 stand-in for the scrimmage database.
+
+    Array columns (maps, match_files, match_winners) are stored as JSON text.
+    With create, the tables in schema_sqlite.sql are created if missing.
+    """
+    sqlite3.register_adapter(list, json.dumps)
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    if create:
+        # let readers carry on while another connection writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        with open(SQLITE_SCHEMA) as f:
+            conn.executescript(f.read())
+        conn.commit()
+    return conn
+
+def as_list(value):
+    """Read an array column, which the sqlite stand-in returns as JSON text."""
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
+def is_transient(error):
+    """Whether an operation that failed with error is worth retrying."""
+    if isinstance(error, sqlite3.OperationalError):
+        message = str(error)
+        return 'locked' in message or 'busy' in message
+    return isinstance(error, _PG_TRANSIENT)
+
+class Database:
+    """A thread-safe pool of database connections.
+
+    Every operation checks a connection out of the pool for as long as it
+    runs, so the engine listener and the queue loop never share a cursor.
+    Operations that fail with a transient error (lost connection,
+    serialization failure, locked sqlite file) are rolled back and retried on
+    a fresh connection.
+    """
+
+    def __init__(self, connect, size=4, retries=3, retry_delay=0.05):
+        """connect: a function returning a new DB-API connection."""
+        self._connect = connect
+        self._idle = LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Check out a connection; it is rolled back if the block raises."""
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            except Exception as e:
+                try:
+                    conn.rollback()
+                except Exception:
+                    conn = None
+                if conn is not None and is_transient(e) and not is_sqlite(conn):
+                    # the connection itself may be broken; don't reuse it
+                    conn.close()
+                    conn = None
+                raise
+            finally:
+                if conn is not None:
+                    self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def transaction(self, operation):
+        """Run operation(conn, cursor) and commit, retrying transient errors.
+
+        Returns whatever operation returns.
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.connection() as conn:
+                    result = operation(conn, conn.cursor())
+                    conn.commit()
+                    return result
+            except Exception as e:
+                attempt += 1
+                if attempt > self.retries or not is_transient(e):
+                    raise
+                time.sleep(self.retry_delay * attempt)
+
+    def execute(self, query, params=(), fetch=None):
+        """Run a single query in its own transaction.
+
+        fetch: None, 'one' or 'all'.
+        """
+        def operation(conn, c):
+            execute(c, conn, query, params)
+            if fetch == 'one':
+                return c.fetchone()
+            if fetch == 'all':
+                return c.fetchall()
+        return self.transaction(operation)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                return
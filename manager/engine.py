@@ -0,0 +1,294 @@
+"""The manager's connection to a game engine.
+
+Every message the engine sends about a game carries the game's id, so
+incoming messages are routed through a dict from game id to handler instead
+of searching the running matches. createGame requests carry a requestID that
+the engine echoes in its createGameConfirm (or its error, if the game can't be
+created), so any number of them can be in flight at once; each one gets a
+Future that resolves to the new game id or fails with EngineError.
+
+An engine is a single Node event loop, so EnginePool can run several of them
+on separate ports, placing each new game on the least loaded one and
+restarting any that crash. Bots have to log in to the engine their game is
+on, so create_game's Future says which port that is.
+"""
+import itertools
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+
+# weight of the newest createGame round trip in EngineConnection.latency
+LATENCY_ALPHA = 0.2
+
+class EngineError(Exception):
+    pass
+
+class EngineConnection:
+
+    def __init__(self, address, server_key=None):
+        self.address = address
+        self.server_key = server_key
+        self._socket = socket.create_connection(address)
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+        # requestID -> (Future, handler, time sent) for unconfirmed createGames
+        self._requests = {}
+        # game id -> handler(message)
+        self._handlers = {}
+        self.closed = False
+        # moving average of createGame round trips in seconds; the engine
+        # answers them on the same event loop that runs its games, so this
+        # rises as it gets busy
+        self.latency = None
+
+        thread = threading.Thread(target=self._listen)
+        thread.daemon = True
+        thread.start()
+
+    def _send(self, message):
+        data = json.dumps(message).encode() + b'\n'
+        with self._send_lock:
+            self._socket.sendall(data)
+
+    def create_game(self, teams, match_map, handler, timeout_ms=1000000):
+        """Ask the engine for a new game. Returns a Future for its game id,
+        with the engine's TCP port, where the game's bots log in, as .port.
+
+        handler(message) is registered for the game's messages before the
+        Future resolves, so nothing the engine sends about the game is missed.
+        A caller that stops waiting can cancel() the Future; if that succeeds,
+        the game is never registered.
+        """
+        future = Future()
+        future.port = self.address[1]
+        request_id = str(next(self._request_ids))
+        with self._lock:
+            if self.closed:
+                raise EngineError("engine connection is closed")
+            self._requests[request_id] = (future, handler, time.time())
+        try:
+            self._send({"command": "createGame", "serverKey": self.server_key,
+                        "teams": teams, "map": match_map, "sendReplay": True,
+                        "timeoutMS": timeout_ms, "requestID": request_id})
+        except Exception:
+            with self._lock:
+                self._requests.pop(request_id, None)
+            raise
+        return future
+
+    def unregister(self, game_id):
+        """Stop routing messages for a game that's over."""
+        with self._lock:
+            self._handlers.pop(game_id, None)
+
+    def close(self):
+        try:
+            self._socket.close()
+        except OSError:
+            pass
+
+    def _listen(self):
+        stream = self._socket.makefile('rb', 2**16)
+        try:
+            for line in stream:
+                self._dispatch(json.loads(line.decode()))
+        except (OSError, ValueError) as e:
+            print("Engine connection to " + str(self.address) + " failed: " + str(e))
+        finally:
+            with self._lock:
+                self.closed = True
+                requests, self._requests = self._requests, {}
+            for future, handler, sent in requests.values():
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(EngineError("engine connection closed"))
+
+    def _dispatch(self, message):
+        if message['command'] == 'createGameConfirm':
+            with self._lock:
+                request = self._requests.pop(message.get('requestID'), None)
+                # a cancelled request's game is left for the engine to time out
+                confirmed = request is not None and request[0].set_running_or_notify_cancel()
+                if confirmed:
+                    self._handlers[message['gameID']] = request[1]
+                    elapsed = time.time() - request[2]
+                    self.latency = elapsed if self.latency is None else \
+                        (1 - LATENCY_ALPHA) * self.latency + LATENCY_ALPHA * elapsed
+            if request is None:
+                print("Unexpected createGameConfirm: " + str(message))
+            elif confirmed:
+                request[0].set_result(message['gameID'])
+            return
+
+        if message['command'] == 'error':
+            with self._lock:
+                request = self._requests.pop(message.get('requestID'), None)
+            if request is None:
+                print("Engine error: " + str(message.get('reason')))
+            elif request[0].set_running_or_notify_cancel():
+                request[0].set_exception(EngineError(message.get('reason')))
+            return
+
+        with self._lock:
+            handler = self._handlers.get(message.get('id'))
+        if handler is not None:
+            handler(message)
+
+class EngineProcess:
+    """One engine run as a child process, listening on its own ports."""
+
+    def __init__(self, command, tcp_port, ws_port, server_key=None, log_path=None):
+        self.command = command
+        self.tcp_port = tcp_port
+        self.ws_port = ws_port
+        self.server_key = server_key
+        self.log_path = log_path
+        self.process = None
+        self.connection = None
+        # game ids placed on this engine that haven't been unregistered yet
+        self.games = set()
+        # createGames sent but not confirmed, counted as load too
+        self.pending = 0
+
+    def start(self, connect_timeout=30):
+        # otherwise we'd connect to whatever is listening there while our own
+        # engine dies failing to bind, and the pool would restart it forever
+        try:
+            socket.create_connection(('127.0.0.1', self.tcp_port), timeout=1).close()
+        except OSError:
+            pass
+        else:
+            raise EngineError("port " + str(self.tcp_port) + " is already in use, is another engine running?")
+        args = list(self.command) + ["start", "--tcp-port", str(self.tcp_port),
+                                     "--ws-port", str(self.ws_port), "--no-viewer"]
+        if self.server_key is not None:
+            args += ["--server-key", self.server_key]
+        log = open(self.log_path, "ab") if self.log_path else subprocess.DEVNULL
+        self.process = subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT)
+        if self.log_path:
+            log.close()
+        deadline = time.time() + connect_timeout
+        while True:
+            try:
+                self.connection = EngineConnection(('127.0.0.1', self.tcp_port), self.server_key)
+                return
+            except OSError:
+                if self.process.poll() is not None or time.time() > deadline:
+                    self.stop()
+                    raise EngineError("engine on port " + str(self.tcp_port) + " didn't start")
+                time.sleep(0.1)
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None and \
+            self.connection is not None and not self.connection.closed
+
+    def load(self, latency_unit):
+        """Live games, plus one per latency_unit seconds of round trip."""
+        latency = self.connection.latency or 0
+        return len(self.games) + self.pending + latency / latency_unit
+
+    def stop(self):
+        if self.connection is not None:
+            self.connection.close()
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+class EnginePool:
+    """Runs size engines and spreads games across them.
+
+    Engine i listens on base_port + 2i (TCP) and base_port + 2i + 1
+    (websocket). A supervisor thread restarts engines whose process exits or
+    whose connection drops, first passing the ids of the games they were
+    running to on_crash(game_ids) so the caller can fail those matches.
+    """
+
+    def __init__(self, command, size, base_port=6147, server_key=None,
+                 on_crash=None, latency_unit=0.05, log_dir=None, check_time=1.0):
+        self.latency_unit = latency_unit
+        self.on_crash = on_crash
+        self.check_time = check_time
+        self._lock = threading.Lock()
+        # game id -> EngineProcess
+        self._placement = {}
+        self.engines = []
+        for i in range(size):
+            log_path = os.path.join(log_dir, "engine%d.log" % i) if log_dir else None
+            self.engines.append(EngineProcess(command, base_port + 2*i, base_port + 2*i + 1,
+                                              server_key, log_path))
+
+    def start(self):
+        for engine in self.engines:
+            engine.start()
+        thread = threading.Thread(target=self._supervise)
+        thread.daemon = True
+        thread.start()
+
+    def create_game(self, teams, match_map, handler, timeout_ms=1000000):
+        """Like EngineConnection.create_game, on the least loaded engine."""
+        with self._lock:
+            engines = [engine for engine in self.engines if engine.alive()]
+            if not engines:
+                raise EngineError("no engines are running")
+            engine = min(engines, key=lambda e: e.load(self.latency_unit))
+            engine.pending += 1
+        try:
+            future = engine.connection.create_game(teams, match_map, handler, timeout_ms)
+        except Exception:
+            with self._lock:
+                engine.pending -= 1
+            raise
+        future.add_done_callback(lambda f: self._placed(engine, f))
+        return future
+
+    def _placed(self, engine, future):
+        with self._lock:
+            engine.pending -= 1
+            if not future.cancelled() and future.exception() is None:
+                engine.games.add(future.result())
+                self._placement[future.result()] = engine
+
+    def unregister(self, game_id):
+        with self._lock:
+            engine = self._placement.pop(game_id, None)
+            if engine is not None:
+                engine.games.discard(game_id)
+        if engine is not None:
+            engine.connection.unregister(game_id)
+
+    def loads(self):
+        """(port, live games, latency) for each engine."""
+        with self._lock:
+            return [(e.tcp_port, len(e.games), e.connection.latency if e.connection else None)
+                    for e in self.engines]
+
+    def _supervise(self):
+        while True:
+            time.sleep(self.check_time)
+            for engine in self.engines:
+                if engine.alive():
+                    continue
+                with self._lock:
+                    lost = list(engine.games)
+                    engine.games.clear()
+                    for game_id in lost:
+                        self._placement.pop(game_id, None)
+                print("Engine on port " + str(engine.tcp_port) + " died with " + str(len(lost)) + " games, restarting it.")
+                engine.stop()
+                if lost and self.on_crash is not None:
+                    try:
+                        self.on_crash(lost)
+                    except Exception as e:
+                        print("Failed to fail the crashed engine's games: " + str(e))
+                try:
+                    engine.start()
+                except EngineError as e:
+                    print(str(e) + ", will retry.")
+
+    def stop(self):
+        for engine in self.engines:
+            engine.stop()
@@ -0,0 +1,232 @@
+"""Unpacking submission archives in-process, with limits.
+
+extract() reads a .tar.gz or .zip from a file-like object (a bucket download
+stream or an open file) straight into a directory. It checks as it goes that
+every entry, and everything a symlink resolves to, stays inside the
+directory, and that the archive doesn't expand past a total size, a count of
+entries (directories and symlinks count as files) or, given one, a deadline.
+A tar.gz is extracted as it streams in; a zip keeps its index at the end, so
+an unseekable zip stream is first read into a temporary file (in memory while
+small), bounded by the same size limit.
+"""
+import gzip
+import os
+import stat
+import tarfile
+import tempfile
+import time
+import zipfile
+import zlib
+
+MAX_BYTES = 512 * 1024 * 1024
+MAX_FILES = 10000
+CHUNK = 1 << 16
+# zips smaller than this are spooled in memory rather than on disk
+SPOOL_BYTES = 16 * 1024 * 1024
+
+class ArchiveError(Exception):
+    pass
+
+class ArchiveTimeout(ArchiveError):
+    pass
+
+class _Peek:
+    """A read-only stream with its first bytes already read."""
+
+    def __init__(self, stream, head):
+        self.stream = stream
+        self.head = head
+
+    def read(self, size=-1):
+        if self.head:
+            if size is None or size < 0:
+                data, self.head = self.head + self.stream.read(), b""
+                return data
+            data, self.head = self.head[:size], self.head[size:]
+            if len(data) < size:
+                data += self.stream.read(size - len(data))
+            return data
+        return self.stream.read(size)
+
+class _Limits:
+    def __init__(self, destination, max_bytes, max_files, deadline=None):
+        self.root = os.path.realpath(destination)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.deadline = deadline
+        self.bytes = 0
+        self.files = 0
+
+    def inside(self, path):
+        return path == self.root or path.startswith(self.root + os.sep)
+
+    def path(self, name):
+        """Where an archive entry goes, or ArchiveError if that's outside the
+        destination (absolute paths, .., or through a symlink)."""
+        parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+        if not parts or name.startswith("/") or ".." in parts or ":" in parts[0]:
+            raise ArchiveError("Unsafe path in archive: " + name)
+        target = os.path.join(self.root, *parts)
+        parent = os.path.realpath(os.path.dirname(target))
+        if not self.inside(parent):
+            raise ArchiveError("Unsafe path in archive: " + name)
+        return target
+
+    def count(self):
+        self.files += 1
+        if self.files > self.max_files:
+            raise ArchiveError("Archive has more than %d files" % self.max_files)
+        self.check_time()
+
+    def makedirs(self, target):
+        """os.makedirs, counting each directory it creates as a file."""
+        missing = []
+        while not os.path.isdir(target):
+            missing.append(target)
+            target = os.path.dirname(target)
+        for path in reversed(missing):
+            if os.path.lexists(path):
+                raise ArchiveError("Directory clashes with a file in archive: " + os.path.relpath(path, self.root))
+            self.count()
+            os.mkdir(path)
+
+    def add(self, size):
+        self.bytes += size
+        if self.bytes > self.max_bytes:
+            raise ArchiveError("Archive expands to more than %d bytes" % self.max_bytes)
+        self.check_time()
+
+    def check_time(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            raise ArchiveTimeout("Archive took too long to extract")
+
+def _write_file(limits, name, source, mode):
+    target = limits.path(name)
+    limits.count()
+    limits.makedirs(os.path.dirname(target))
+    if os.path.lexists(target) and not os.path.isdir(target):
+        os.remove(target)
+    # O_NOFOLLOW: a symlink created since the path check isn't followed
+    fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW,
+                 (mode & 0o777) | stat.S_IRUSR | stat.S_IWUSR)
+    with os.fdopen(fd, "wb") as out:
+        while True:
+            chunk = source.read(CHUNK)
+            if not chunk:
+                break
+            limits.add(len(chunk))
+            out.write(chunk)
+
+def _make_dir(limits, name):
+    target = limits.path(name)
+    if os.path.lexists(target) and not os.path.isdir(target):
+        raise ArchiveError("Directory clashes with a file in archive: " + name)
+    limits.makedirs(target)
+
+def _make_symlink(limits, name, link):
+    target = limits.path(name)
+    if os.path.isabs(link):
+        raise ArchiveError("Unsafe symlink in archive: " + name)
+    resolved = os.path.normpath(os.path.join(os.path.dirname(target), link))
+    if not limits.inside(resolved):
+        raise ArchiveError("Unsafe symlink in archive: " + name)
+    limits.count()
+    limits.makedirs(os.path.dirname(target))
+    if os.path.lexists(target):
+        os.remove(target)
+    os.symlink(link, target)
+    # the link may go through links made earlier (s -> ., a -> s/..)
+    if not limits.inside(os.path.realpath(target)):
+        os.remove(target)
+        raise ArchiveError("Unsafe symlink in archive: " + name)
+
+def _check_symlinks(limits):
+    """Resolve every symlink again once everything is extracted: an entry
+    can change where an earlier link goes (a -> s/.. before s -> .)."""
+    for base, dirs, files in os.walk(limits.root):
+        for name in dirs + files:
+            path = os.path.join(base, name)
+            if os.path.islink(path) and not limits.inside(os.path.realpath(path)):
+                raise ArchiveError("Unsafe symlink in archive: " + os.path.relpath(path, limits.root))
+
+def _extract_tar(stream, limits):
+    try:
+        archive = tarfile.open(fileobj=stream, mode="r|gz")
+        for member in archive:
+            if member.isdir():
+                _make_dir(limits, member.name)
+            elif member.isfile():
+                if member.size > limits.max_bytes - limits.bytes:
+                    raise ArchiveError("Archive expands to more than %d bytes" % limits.max_bytes)
+                _write_file(limits, member.name, archive.extractfile(member), member.mode)
+            elif member.issym():
+                _make_symlink(limits, member.name, member.linkname)
+            elif member.islnk():
+                # a hard link to a file extracted earlier: copy it
+                source = limits.path(member.linkname)
+                if not os.path.isfile(source) or os.path.islink(source):
+                    raise ArchiveError("Bad hard link in archive: " + member.name)
+                with open(source, "rb") as f:
+                    _write_file(limits, member.name, f, os.stat(source).st_mode)
+            else:
+                raise ArchiveError("Unsupported entry in archive: " + member.name)
+    except (tarfile.TarError, EOFError, zlib.error, gzip.BadGzipFile) as e:
+        raise ArchiveError("Bad tar.gz archive: " + str(e))
+
+def _extract_zip(stream, limits):
+    spool = None
+    if not (hasattr(stream, "seekable") and stream.seekable()):
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+        size = 0
+        while True:
+            chunk = stream.read(CHUNK)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > limits.max_bytes:
+                raise ArchiveError("Archive is larger than %d bytes" % limits.max_bytes)
+            limits.check_time()
+            spool.write(chunk)
+        spool.seek(0)
+        stream = spool
+    try:
+        with zipfile.ZipFile(stream) as archive:
+            for info in archive.infolist():
+                mode = info.external_attr >> 16
+                if info.is_dir():
+                    _make_dir(limits, info.filename)
+                elif stat.S_ISLNK(mode):
+                    _make_symlink(limits, info.filename, archive.read(info).decode("utf-8"))
+                else:
+                    with archive.open(info) as source:
+                        _write_file(limits, info.filename, source, mode or 0o644)
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, EOFError, zlib.error, UnicodeDecodeError) as e:
+        raise ArchiveError("Bad zip archive: " + str(e))
+    finally:
+        if spool is not None:
+            spool.close()
+
+def extract(stream, destination, max_bytes=MAX_BYTES, max_files=MAX_FILES, deadline=None):
+    """Unpack the .tar.gz or .zip read from stream into destination, which is
+    created if needed. Raises ArchiveError if the archive is malformed,
+    breaks a limit or tries to write outside destination, and ArchiveTimeout
+    if it's still going at deadline (a time.time()); what was extracted
+    before that is left for the caller to remove."""
+    os.makedirs(destination, exist_ok=True)
+    limits = _Limits(destination, max_bytes, max_files, deadline)
+    head = stream.read(4)
+    if head[:2] == b"\x1f\x8b":
+        _extract_tar(_Peek(stream, head), limits)
+    elif head[:2] == b"PK":
+        if hasattr(stream, "seekable") and stream.seekable():
+            stream.seek(-len(head), os.SEEK_CUR)
+            _extract_zip(stream, limits)
+        else:
+            _extract_zip(_Peek(stream, head), limits)
+    else:
+        raise ArchiveError("Not a .tar.gz or .zip archive")
+    _check_symlinks(limits)
+
+def extract_file(path, destination, max_bytes=MAX_BYTES, max_files=MAX_FILES, deadline=None):
+    with open(path, "rb") as f:
+        extract(f, destination, max_bytes, max_files, deadline)
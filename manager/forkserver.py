@@ -0,0 +1,98 @@
+"""Launcher for Python bots that gets their slow start-up done early.
+
+    python3 forkserver.py Battle.py ENGINE_IP
+
+runs inside a bot's sandbox in place of run.sh, started while the engine is
+still creating the game. It imports the battlecode client and the modules
+Battle.py imports at the top level, then waits for the manager to write the
+match's player key to GO_FILE in the working directory (a file rather than
+stdin, since docker run -d doesn't pass stdin through). Once the key arrives
+it forks, and the child runs Battle.py (compiled in advance) as __main__
+with the key and engine address in its environment, just as run.sh would.
+Time from the game being created to the bot logging in is then about one
+fork, instead of an interpreter start plus every import.
+
+The template exits with the child's status. It's copied into the bot's
+directory by the worker, so it only uses the standard library.
+"""
+import ast
+import os
+import sys
+import time
+
+GO_FILE = ".battlehack_go"
+POLL_TIME = 0.001
+
+def top_level_imports(path):
+    """Names of the modules a script imports outside any function."""
+    with open(path, "rb") as f:
+        tree = ast.parse(f.read(), path)
+    names = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.append(node.module)
+    return names
+
+def warm(main):
+    try:
+        names = top_level_imports(main)
+    except (IOError, OSError, SyntaxError, ValueError):
+        names = []
+    for name in ["battlecode"] + names:
+        try:
+            __import__(name)
+        except BaseException:
+            # leave it to the bot's own import to fail, with its own traceback
+            pass
+
+def wait_for_key(path):
+    """The manager writes the key to a temporary file and renames it into
+    place, so the file is complete once it exists."""
+    while True:
+        try:
+            with open(path) as f:
+                key = f.read().strip()
+            os.remove(path)
+            return key
+        except (IOError, OSError):
+            time.sleep(POLL_TIME)
+
+def write_key(directory, key):
+    """Start the bot whose template is waiting in directory."""
+    tmp = os.path.join(directory, GO_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        f.write(key)
+    os.rename(tmp, os.path.join(directory, GO_FILE))
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit("Usage: forkserver.py MAIN ENGINE_IP")
+    main_file, engine_ip = sys.argv[1], sys.argv[2]
+    # battlecode reads the engine address when it's imported
+    os.environ["BATTLECODE_IP"] = engine_ip
+    sys.path.insert(0, os.path.dirname(os.path.abspath(main_file)))
+    warm(main_file)
+    with open(main_file, "rb") as f:
+        code = compile(f.read(), main_file, "exec")
+    key = wait_for_key(GO_FILE)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        os.environ["BATTLECODE_PLAYER_KEY"] = key
+        sys.argv = [main_file]
+        module = type(sys)("__main__")
+        module.__file__ = main_file
+        sys.modules["__main__"] = module
+        exec(code, module.__dict__)
+        sys.exit(0)
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+        sys.exit(128 + os.WTERMSIG(status))
+    sys.exit(os.WEXITSTATUS(status))
+
+if __name__ == "__main__":
+    main()
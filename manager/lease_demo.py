@@ -0,0 +1,81 @@
+"""Demo: several manager nodes sharing one queue through leases.
+
+Starts --nodes processes against one sqlite stand-in database. Each claims
+matches with a short lease, heartbeats while "playing" them and writes a
+result. One node dies while holding a lease; its match is requeued by another
+node once the lease expires, and every match still completes exactly once.
+
+    python3 lease_demo.py [--nodes 4] [--matches 40]
+"""
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from optparse import OptionParser
+
+import db
+import leases
+import matchqueue
+import results
+
+LEASE_TIME = 1.0
+
+def setup(path, matches):
+    conn = db.connect_sqlite(path, create=True)
+    conn.execute("INSERT INTO battlecode_teams VALUES (1, 'red'), (2, 'blue')")
+    conn.execute("INSERT INTO scrimmage_submissions VALUES (1, 1, 'red.tar.gz'), (2, 2, 'blue.tar.gz')")
+    for match_id in range(1, matches+1):
+        conn.execute("INSERT INTO scrimmage_matches (id, red_team, blue_team, red_submission, blue_submission, maps, request_time) VALUES (?, 1, 2, 1, 2, '[1]', ?)", (match_id, match_id))
+    conn.commit()
+    conn.close()
+    leases.ensure_schema(db.Database(lambda: db.connect_sqlite(path)))
+
+def node(path, index, crash):
+    database = db.Database(lambda: db.connect_sqlite(path))
+    node_id = "node%d:%d" % (index, os.getpid())
+    rnd = random.Random(index)
+    idle_since = time.time()
+    while time.time() - idle_since < 3 * LEASE_TIME:
+        for match_id in leases.reclaim_expired(database):
+            print("%s requeued match %d" % (node_id, match_id))
+        claimed = matchqueue.claim_matches(database, 1, node_id=node_id, lease_time=LEASE_TIME)
+        if not claimed:
+            time.sleep(0.05)
+            continue
+        match_id = claimed[0][0]
+        if crash:
+            print("%s crashing while holding match %d" % (node_id, match_id))
+            os._exit(1)
+        # play the match, heartbeating as the manager does
+        end = time.time() + rnd.uniform(0.05, 0.3)
+        while time.time() < end:
+            leases.heartbeat(database, node_id, [match_id], LEASE_TIME)
+            time.sleep(0.05)
+        results.record_result(database, match_id, 1, 2, rnd.choice([1, 2]), [node_id], [1], node_id=node_id)
+        idle_since = time.time()
+
+def main():
+    parser = OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--nodes", type="int", default=4)
+    parser.add_option("--matches", type="int", default=40)
+    options, _ = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "scrimmage.db")
+    setup(path, options.matches)
+    nodes = [multiprocessing.Process(target=node, args=(path, i, i == 0))
+             for i in range(options.nodes)]
+    for process in nodes:
+        process.start()
+    for process in nodes:
+        process.join()
+
+    conn = db.connect_sqlite(path)
+    statuses = dict(conn.execute("SELECT status, count(*) FROM scrimmage_matches GROUP BY status").fetchall())
+    print("match statuses:", statuses)
+    for files, count in conn.execute("SELECT match_files, count(*) FROM scrimmage_matches WHERE status='completed' GROUP BY match_files").fetchall():
+        print("  %s completed %d" % (db.as_list(files)[0], count))
+    print("leases left:", conn.execute("SELECT count(*) FROM match_leases").fetchone()[0])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Leases on running matches, so several manager nodes can share one queue.
+
+A node that claims a match also takes a lease on it in match_leases and keeps
+renewing it with heartbeat() while the match runs. If the node dies the lease
+runs out, and whichever node next calls reclaim_expired() puts the match back
+in the queue. match_leases is the shared record of what is running where;
+each node only keeps the live sandboxes for its own matches in memory.
+
+Times are seconds since the epoch as seen by the database server, so nodes
+with skewed clocks still agree on when a lease expires.
+"""
+import os
+import socket
+
+import db
+
+LEASE_TIME = 60
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS match_leases (
+    match_id INTEGER PRIMARY KEY,
+    node_id TEXT NOT NULL,
+    started_at DOUBLE PRECISION NOT NULL,
+    expires_at DOUBLE PRECISION NOT NULL
+)"""
+
+def default_node_id():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+def _now(conn):
+    if db.is_sqlite(conn):
+        return "((julianday('now') - 2440587.5) * 86400.0)"
+    return "extract(epoch from clock_timestamp())"
+
+def ensure_schema(database):
+    database.execute(SCHEMA)
+
+def grant(conn, c, match_ids, node_id, lease_time=LEASE_TIME):
+    """Take leases on freshly claimed matches, inside the claiming transaction."""
+    now = _now(conn)
+    for match_id in match_ids:
+        db.execute(c, conn, "INSERT INTO match_leases (match_id, node_id, started_at, expires_at) VALUES (%s, %s, " + now + ", " + now + " + %s)", [match_id, node_id, lease_time])
+
+def heartbeat(database, node_id, match_ids, lease_time=LEASE_TIME):
+    """Renew node_id's leases on match_ids, the matches it is still working
+    on. Returns the ones it still holds.
+
+    Leases the node holds on anything else are left to expire: with a fixed
+    node id, a restarted node would otherwise keep alive the leases on
+    matches that died with its previous run."""
+    match_ids = sorted(set(match_ids))
+    if not match_ids:
+        return set()
+    placeholders = ", ".join(["%s"] * len(match_ids))
+    def renew(conn, c):
+        db.execute(c, conn, "UPDATE match_leases SET expires_at = " + _now(conn) + " + %s WHERE node_id=%s AND match_id IN (" + placeholders + ")", [lease_time, node_id] + match_ids)
+        db.execute(c, conn, "SELECT match_id FROM match_leases WHERE node_id=%s AND match_id IN (" + placeholders + ")", [node_id] + match_ids)
+        return set(row[0] for row in c.fetchall())
+    return database.transaction(renew)
+
+def owns(database, match_id, node_id):
+    row = database.execute("SELECT node_id FROM match_leases WHERE match_id=%s", [match_id], fetch='one')
+    return row is not None and row[0] == node_id
+
+def end(conn, c, match_id, node_id):
+    """Drop node_id's lease on a match inside the transaction that writes the
+    match's outcome, before writing it. Returns False if the lease has been
+    lost, in which case nothing should be written.
+
+    Deleting the row locks it, so reclaim_expired on another node either
+    skips it or has already deleted it: the match can't be requeued and
+    finished at the same time."""
+    db.execute(c, conn, "DELETE FROM match_leases WHERE match_id=%s AND node_id=%s", [match_id, node_id])
+    return c.rowcount == 1
+
+def release(database, match_id, node_id):
+    """Drop a lease once the match's result is written. Returns False if it
+    had already been lost to another node."""
+    def drop(conn, c):
+        db.execute(c, conn, "DELETE FROM match_leases WHERE match_id=%s AND node_id=%s", [match_id, node_id])
+        return c.rowcount == 1
+    return database.transaction(drop)
+
+def reclaim_expired(database):
+    """Requeue every match whose lease ran out. Returns their ids.
+
+    sqlite doesn't lock the rows the SELECT finds, so another node may
+    requeue one of them first (and a third may even claim it again) before
+    this transaction writes anything. Each lease is deleted only if it's
+    still there and expired, and only a match whose lease this call deleted
+    is requeued."""
+    def reclaim(conn, c):
+        lock = "" if db.is_sqlite(conn) else " FOR UPDATE SKIP LOCKED"
+        db.execute(c, conn, "SELECT match_id FROM match_leases WHERE expires_at < " + _now(conn) + lock)
+        ids = []
+        for (match_id,) in c.fetchall():
+            db.execute(c, conn, "DELETE FROM match_leases WHERE match_id=%s AND expires_at < " + _now(conn), [match_id])
+            if c.rowcount != 1:
+                continue
+            db.execute(c, conn, "UPDATE scrimmage_matches SET status='queued' WHERE id=%s AND status='running'", [match_id])
+            ids.append(match_id)
+        return ids
+    return database.transaction(reclaim)
+
+def running(database, node_id=None):
+    """(match_id, node_id, started_at) for every leased match, optionally
+    only those on one node."""
+    if node_id is None:
+        return database.execute("SELECT match_id, node_id, started_at FROM match_leases ORDER BY started_at", fetch='all')
+    return database.execute("SELECT match_id, node_id, started_at FROM match_leases WHERE node_id=%s ORDER BY started_at", [node_id], fetch='all')
@@ -0,0 +1,127 @@
+"""Claiming queued scrimmage matches.
+
+Matches are claimed with a single UPDATE that flips them from 'queued' to
+'running' and returns their ids, so several managers can pull from the same
+table without ever starting a match twice. On Postgres the inner SELECT uses
+FOR UPDATE SKIP LOCKED so concurrent claimers don't wait on each other; sqlite
+runs every write statement under its database lock, which gives the same
+guarantee.
+"""
+import select
+import time
+
+import db
+import leases
+
+NOTIFY_CHANNEL = 'scrimmage_queue'
+
+# Run once against the Postgres database to get a NOTIFY whenever a match is
+# queued. Managers still poll occasionally, so this is an optimization only.
+NOTIFY_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION notify_scrimmage_queue() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('""" + NOTIFY_CHANNEL + """', NEW.id::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS scrimmage_queue_notify ON scrimmage_matches;
+CREATE TRIGGER scrimmage_queue_notify
+    AFTER INSERT OR UPDATE OF status ON scrimmage_matches
+    FOR EACH ROW WHEN (NEW.status = 'queued')
+    EXECUTE PROCEDURE notify_scrimmage_queue();
+"""
+
+_CLAIM = """UPDATE scrimmage_matches SET status='running'
+WHERE id IN (SELECT id FROM scrimmage_matches WHERE status='queued'
+             ORDER BY request_time ASC LIMIT %s{lock})
+RETURNING id"""
+
+# The columns the worker has always used, in the same order, then the
+# submission ids.
+_DETAILS = """SELECT m.id AS id, red_team, blue_team, s1.source_code AS red_source,
+s2.source_code AS blue_source, t1.name AS red_name, t2.name AS blue_name, maps,
+m.red_submission, m.blue_submission
+FROM scrimmage_matches m
+INNER JOIN scrimmage_submissions s1 ON m.red_submission=s1.id
+INNER JOIN scrimmage_submissions s2 ON m.blue_submission=s2.id
+INNER JOIN battlecode_teams t1 ON m.red_team=t1.id
+INNER JOIN battlecode_teams t2 ON m.blue_team=t2.id
+WHERE m.id IN ({ids}) ORDER BY request_time ASC"""
+
+def claim_matches(database, limit=1, node_id=None, lease_time=leases.LEASE_TIME):
+    """Atomically mark up to limit queued matches as running and return them.
+
+    If node_id is given, the node also takes a lease on each match (see
+    leases.py) in the same transaction.
+
+    Returns a list of (id, red_team, blue_team, red_source, blue_source,
+    red_name, blue_name, maps, red_submission, blue_submission) tuples,
+    oldest request first.
+    """
+    def claim(conn, c):
+        lock = "" if db.is_sqlite(conn) else " FOR UPDATE SKIP LOCKED"
+        db.execute(c, conn, _CLAIM.format(lock=lock), [limit])
+        ids = [row[0] for row in c.fetchall()]
+        if not ids:
+            return []
+        if node_id is not None:
+            leases.grant(conn, c, ids, node_id, lease_time)
+        db.execute(c, conn, _DETAILS.format(ids=", ".join(["%s"] * len(ids))), ids)
+        return [tuple(row[:7]) + (db.as_list(row[7]),) + tuple(row[8:10]) for row in c.fetchall()]
+    return database.transaction(claim)
+
+def release_match(database, match_id):
+    """Put a claimed match back in the queue, e.g. if it couldn't be started."""
+    def release(conn, c):
+        db.execute(c, conn, "UPDATE scrimmage_matches SET status='queued' WHERE id=%s AND status='running'", [match_id])
+        db.execute(c, conn, "DELETE FROM match_leases WHERE match_id=%s", [match_id])
+    database.transaction(release)
+
+def queue_depth(database):
+    return database.execute("SELECT count(*) FROM scrimmage_matches WHERE status='queued'", fetch='one')[0]
+
+def upcoming_sources(database, limit):
+    """Source URLs of the bots in the next limit queued matches, oldest first,
+    without claiming anything. Used to prefetch submissions."""
+    rows = database.execute("""SELECT s1.source_code, s2.source_code
+FROM scrimmage_matches m
+INNER JOIN scrimmage_submissions s1 ON m.red_submission=s1.id
+INNER JOIN scrimmage_submissions s2 ON m.blue_submission=s2.id
+WHERE m.status='queued' ORDER BY request_time ASC LIMIT %s""", [limit], fetch='all')
+    sources = []
+    for red, blue in rows:
+        for source in (red, blue):
+            if source not in sources:
+                sources.append(source)
+    return sources
+
+class QueueWaiter:
+    """Sleeps until a match might be queued.
+
+    Given a dedicated Postgres connection it LISTENs on NOTIFY_CHANNEL and
+    wakes up as soon as a notification arrives; otherwise (or on sqlite) it
+    just sleeps for the timeout.
+    """
+
+    def __init__(self, conn=None):
+        self.conn = None
+        if conn is not None and not db.is_sqlite(conn):
+            conn.autocommit = True
+            conn.cursor().execute("LISTEN " + NOTIFY_CHANNEL)
+            self.conn = conn
+
+    def wait(self, timeout):
+        """Returns True if woken by a notification, False on timeout."""
+        if self.conn is None:
+            time.sleep(timeout)
+            return False
+        if self.conn.notifies:
+            del self.conn.notifies[:]
+            return True
+        ready, _, _ = select.select([self.conn], [], [], timeout)
+        if not ready:
+            return False
+        self.conn.poll()
+        woken = bool(self.conn.notifies)
+        del self.conn.notifies[:]
+        return woken
@@ -0,0 +1,204 @@
+"""Counters, gauges and stage timings for the manager, served over HTTP.
+
+    GET /metrics   everything in the Prometheus text format
+    GET /summary   JSON: per-stage count/mean/p50/p95/max and per-counter
+                   rates over the last `window` seconds
+
+Timings are recorded in seconds under one metric name with a label per stage,
+e.g. observe('stage_seconds', 1.2, stage='download').
+"""
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+def _format(name, labels, value, extra=()):
+    pairs = list(labels) + list(extra)
+    if pairs:
+        name += "{" + ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + "}"
+    return "%s %s" % (name, repr(float(value)))
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class _Timing:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        # (time, seconds) within the summary window
+        self.recent = deque()
+
+class Metrics:
+
+    def __init__(self, prefix="manager", window=600):
+        self.prefix = prefix
+        self.window = window
+        self._lock = threading.Lock()
+        # name -> {labels: value}
+        self._counters = {}
+        # name -> {labels: deque of (time, amount)}
+        self._counter_recent = {}
+        # name -> {labels: value or function returning one}
+        self._gauges = {}
+        # name -> {labels: _Timing}
+        self._timings = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = _labels(labels)
+        now = time.time()
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + amount
+            recent = self._counter_recent.setdefault(name, {}).setdefault(key, deque())
+            recent.append((now, amount))
+            self._trim(recent, now)
+
+    def gauge(self, name, value, **labels):
+        """Set a gauge; value may be a function, called at each scrape."""
+        with self._lock:
+            self._gauges.setdefault(name, {})[_labels(labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = _labels(labels)
+        now = time.time()
+        with self._lock:
+            timing = self._timings.setdefault(name, {}).setdefault(key, _Timing())
+            timing.count += 1
+            timing.sum += seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    timing.buckets[i] += 1
+            timing.recent.append((now, seconds))
+            self._trim(timing.recent, now)
+
+    def timer(self, name, **labels):
+        """with metrics.timer('stage_seconds', stage='download'): ..."""
+        return _Timer(self, name, labels)
+
+    def _trim(self, recent, now):
+        while recent and recent[0][0] < now - self.window:
+            recent.popleft()
+
+    def _gauge_values(self):
+        with self._lock:
+            gauges = dict((name, dict(values)) for name, values in self._gauges.items())
+        result = {}
+        for name, values in gauges.items():
+            for key, value in values.items():
+                try:
+                    result.setdefault(name, {})[key] = value() if callable(value) else value
+                except Exception:
+                    # a gauge that can't be read right now (e.g. the database
+                    # is down) is left out of this scrape
+                    pass
+        return result
+
+    def prometheus(self):
+        lines = []
+        gauges = self._gauge_values()
+        with self._lock:
+            for name, values in sorted(self._counters.items()):
+                full = self.prefix + "_" + name + "_total"
+                lines.append("# TYPE %s counter" % full)
+                for key, value in sorted(values.items()):
+                    lines.append(_format(full, key, value))
+            for name, values in sorted(gauges.items()):
+                full = self.prefix + "_" + name
+                lines.append("# TYPE %s gauge" % full)
+                for key, value in sorted(values.items()):
+                    lines.append(_format(full, key, value))
+            for name, values in sorted(self._timings.items()):
+                full = self.prefix + "_" + name
+                lines.append("# TYPE %s histogram" % full)
+                for key, timing in sorted(values.items()):
+                    for bound, count in zip(BUCKETS, timing.buckets):
+                        lines.append(_format(full + "_bucket", key, count, [("le", bound)]))
+                    lines.append(_format(full + "_bucket", key, timing.count, [("le", "+Inf")]))
+                    lines.append(_format(full + "_sum", key, timing.sum))
+                    lines.append(_format(full + "_count", key, timing.count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        now = time.time()
+        result = {"window_seconds": self.window, "gauges": {}, "rates": {}, "timings": {}}
+        for name, values in self._gauge_values().items():
+            for key, value in values.items():
+                result["gauges"][_format(name, key, value).rsplit(" ", 1)[0]] = value
+        with self._lock:
+            for name, values in self._counter_recent.items():
+                for key, recent in values.items():
+                    self._trim(recent, now)
+                    label = _format(name, key, 0).rsplit(" ", 1)[0]
+                    result["rates"][label] = {
+                        "total": self._counters[name][key],
+                        "per_second": sum(amount for _, amount in recent) / float(self.window)}
+            for name, values in self._timings.items():
+                for key, timing in values.items():
+                    self._trim(timing.recent, now)
+                    seconds = [s for _, s in timing.recent]
+                    label = _format(name, key, 0).rsplit(" ", 1)[0]
+                    if not seconds:
+                        result["timings"][label] = {"count": 0}
+                        continue
+                    result["timings"][label] = {
+                        "count": len(seconds),
+                        "mean": sum(seconds) / len(seconds),
+                        "p50": _percentile(seconds, 0.5),
+                        "p95": _percentile(seconds, 0.95),
+                        "max": max(seconds)}
+        return result
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve /metrics and /summary from a background thread."""
+        server = _Server((host, port), _handler(self))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.time() - self.start, **self.labels)
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def _handler(metrics):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path == "/metrics":
+                body, kind = metrics.prometheus(), "text/plain; version=0.0.4"
+            elif path == "/summary":
+                body, kind = json.dumps(metrics.summary(), indent=2, sort_keys=True), "application/json"
+            else:
+                self.send_error(404)
+                return
+            body = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", kind)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return Handler
@@ -0,0 +1,256 @@
+"""The first process in a NamespaceSandbox, which sets up the bot's world.
+
+    python3 nsinit.py --dir WORKING_DIR [--uid UID --gid GID]
+                      [--engine-fd FD --engine-port PORT] -- COMMAND
+
+runs as pid 1 of fresh pid, mount, network, IPC and UTS namespaces (and a
+user namespace when the manager isn't root), started by NamespaceSandbox
+through unshare. It builds a new root filesystem on a tmpfs:
+
+  - READ_ONLY host directories (the system's binaries, libraries and /etc)
+    bound read-only, so bots find the same interpreters and compilers as on
+    the host, but nothing else of it: no home directories, no manager
+    directory and its config.
+  - the bot's working directory bound read-write at the same path.
+  - a private /proc, /tmp, /dev/shm and a few device nodes.
+
+The network namespace has nothing but loopback. The manager passes in a TCP
+socket it created in its own network namespace as --engine-fd; this process
+listens on 127.0.0.1:PORT inside the namespace and, when the bot connects
+there, connects that socket to 127.0.0.1:PORT on the host and forwards
+between the two. That one connection to the engine is all the network the
+bot gets.
+
+COMMAND then runs through sh in the new root, as UID:GID with every
+capability dropped and no_new_privs set (without --uid it keeps the user
+namespace's root user, which maps to the unprivileged user that started the
+manager, again without capabilities). This process stays behind, forwarding
+the engine connection and reaping orphans, and exits with COMMAND's status;
+since it's pid 1, everything else in the sandbox dies with it.
+
+It only uses the standard library, and Linux system calls through ctypes.
+"""
+import ctypes
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+import fcntl
+
+READ_ONLY = ["/bin", "/sbin", "/lib", "/lib32", "/lib64", "/libx32", "/usr", "/etc"]
+DEVICES = ["null", "zero", "full", "random", "urandom", "tty"]
+# the new root is built on a tmpfs mounted over this directory, which hides
+# the host's /tmp in the sandbox
+NEW_ROOT = "/tmp"
+TMP_SIZE = "64m"
+
+MS_RDONLY = 1
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+MS_REMOUNT = 32
+MS_NOATIME = 1024
+MS_NODIRATIME = 2048
+MS_BIND = 4096
+MS_REC = 16384
+MS_PRIVATE = 1 << 18
+MS_RELATIME = 1 << 21
+# statvfs flags a read-only bind has to keep: the kernel refuses to clear
+# them on mounts inherited from a more privileged user namespace
+_LOCKED_FLAGS = [(os.ST_NOSUID, MS_NOSUID), (os.ST_NODEV, MS_NODEV),
+                 (os.ST_NOEXEC, MS_NOEXEC), (os.ST_NOATIME, MS_NOATIME),
+                 (os.ST_NODIRATIME, MS_NODIRATIME), (os.ST_RELATIME, MS_RELATIME)]
+
+PR_SET_DUMPABLE = 4
+PR_CAPBSET_DROP = 24
+PR_SET_NO_NEW_PRIVS = 38
+
+SIOCGIFFLAGS = 0x8913
+SIOCSIFFLAGS = 0x8914
+IFF_UP = 1
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+def _check(result, what):
+    if result != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, what + ": " + os.strerror(error))
+
+def mount(source, target, fstype, flags, data=None):
+    _check(_libc.mount(None if source is None else source.encode(), target.encode(),
+                       None if fstype is None else fstype.encode(), ctypes.c_ulong(flags),
+                       None if data is None else data.encode()),
+           "mount " + target)
+
+def bind(source, target, read_only):
+    mount(source, target, None, MS_BIND | MS_REC)
+    if read_only:
+        flags = MS_REMOUNT | MS_BIND | MS_RDONLY
+        stat = os.statvfs(source)
+        for st_flag, ms_flag in _LOCKED_FLAGS:
+            if stat.f_flag & st_flag:
+                flags |= ms_flag
+        mount(None, target, None, flags)
+
+def build_root(working_dir):
+    # opened before the tmpfs hides it, in case it's under NEW_ROOT
+    working_fd = os.open(working_dir, os.O_RDONLY | os.O_DIRECTORY)
+    mount(None, "/", None, MS_REC | MS_PRIVATE)
+    mount("tmpfs", NEW_ROOT, "tmpfs", MS_NOSUID, "mode=755")
+    root = NEW_ROOT
+    for path in READ_ONLY:
+        if os.path.islink(path):
+            os.symlink(os.readlink(path), root + path)
+        elif os.path.isdir(path):
+            os.makedirs(root + path)
+            bind(path, root + path, read_only=True)
+
+    os.mkdir(root + "/dev")
+    for name in DEVICES:
+        if os.path.exists("/dev/" + name):
+            open(root + "/dev/" + name, "w").close()
+            bind("/dev/" + name, root + "/dev/" + name, read_only=False)
+    for name, target in [("fd", "/proc/self/fd"), ("stdin", "/proc/self/fd/0"),
+                         ("stdout", "/proc/self/fd/1"), ("stderr", "/proc/self/fd/2")]:
+        os.symlink(target, root + "/dev/" + name)
+    os.mkdir(root + "/dev/shm")
+    mount("tmpfs", root + "/dev/shm", "tmpfs", MS_NOSUID | MS_NODEV, "mode=1777,size=" + TMP_SIZE)
+    os.mkdir(root + "/proc")
+    mount("proc", root + "/proc", "proc", MS_NOSUID | MS_NODEV | MS_NOEXEC)
+    os.mkdir(root + "/tmp")
+    mount("tmpfs", root + "/tmp", "tmpfs", MS_NOSUID | MS_NODEV, "mode=1777,size=" + TMP_SIZE)
+
+    os.makedirs(root + working_dir)
+    bind("/proc/self/fd/%d" % working_fd, root + working_dir, read_only=False)
+    os.close(working_fd)
+    # nothing else in the new root is writable
+    mount(None, root, None, MS_REMOUNT | MS_RDONLY | MS_NOSUID)
+    return root
+
+def loopback_up():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        request = struct.pack("16sH14x", b"lo", 0)
+        flags = struct.unpack("16sH14x", fcntl.ioctl(s.fileno(), SIOCGIFFLAGS, request))[1]
+        fcntl.ioctl(s.fileno(), SIOCSIFFLAGS, struct.pack("16sH14x", b"lo", flags | IFF_UP))
+    finally:
+        s.close()
+
+def chown_tree(path, uid, gid):
+    for base, dirs, files in os.walk(path):
+        for name in [base] + [os.path.join(base, n) for n in dirs + files]:
+            os.lchown(name, uid, gid)
+
+def confine(root, working_dir, uid, gid):
+    """Enter the new root and give up root for good."""
+    os.chroot(root)
+    os.chdir(working_dir)
+    last_cap = int(open("/proc/sys/kernel/cap_last_cap").read())
+    for cap in range(last_cap + 1):
+        _check(_libc.prctl(PR_CAPBSET_DROP, cap, 0, 0, 0), "drop capability %d" % cap)
+    _check(_libc.prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0), "set no_new_privs")
+    if uid is not None:
+        os.setgroups([])
+        os.setresgid(gid, gid, gid)
+        os.setresuid(uid, uid, uid)
+
+def forward(listener, engine, port, bot_pid):
+    """Relay the bot's engine connection and reap children until the bot
+    exits. Returns its exit status."""
+    read_end, write_end = os.pipe()
+    os.set_blocking(write_end, False)
+    signal.set_wakeup_fd(write_end)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    selector = selectors.DefaultSelector()
+    selector.register(read_end, selectors.EVENT_READ)
+    if listener is not None:
+        selector.register(listener, selectors.EVENT_READ)
+    peers = {}
+    while True:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return 1
+            if pid == 0:
+                break
+            if pid == bot_pid:
+                code = os.waitstatus_to_exitcode(status)
+                return code if code >= 0 else 128 - code
+        for key, _ in selector.select():
+            if key.fileobj == read_end:
+                os.read(read_end, 4096)
+            elif key.fileobj is listener:
+                bot, _ = listener.accept()
+                # one connection: the bot's login
+                selector.unregister(listener)
+                listener.close()
+                try:
+                    engine.connect(("127.0.0.1", port))
+                except OSError as e:
+                    print("Couldn't connect to the engine: " + str(e), file=sys.stderr)
+                    bot.close()
+                    continue
+                peers = {bot: engine, engine: bot}
+                selector.register(bot, selectors.EVENT_READ)
+                selector.register(engine, selectors.EVENT_READ)
+            else:
+                try:
+                    data = key.fileobj.recv(1 << 16)
+                    if data:
+                        peers[key.fileobj].sendall(data)
+                        continue
+                except OSError:
+                    pass
+                for sock in list(peers):
+                    selector.unregister(sock)
+                    sock.close()
+                peers = {}
+
+def main(argv):
+    if "--" not in argv:
+        sys.exit("Usage: nsinit.py --dir DIR [--uid UID --gid GID] [--engine-fd FD --engine-port PORT] -- COMMAND")
+    split = argv.index("--")
+    options = dict(zip(argv[:split:2], argv[1:split:2]))
+    command = " ".join(argv[split+1:])
+    working_dir = os.path.abspath(options["--dir"])
+    uid = int(options["--uid"]) if "--uid" in options else None
+    gid = int(options.get("--gid", uid)) if uid is not None else None
+
+    root = build_root(working_dir)
+    loopback_up()
+    listener = engine = port = None
+    if "--engine-fd" in options:
+        engine = socket.socket(fileno=int(options["--engine-fd"]))
+        port = int(options["--engine-port"])
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("127.0.0.1", port))
+        listener.listen(1)
+    if uid is not None:
+        chown_tree(working_dir, uid, gid)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            if listener is not None:
+                listener.close()
+                engine.close()
+            confine(root, working_dir, uid, gid)
+            os.execv("/bin/sh", ["sh", "-c", command])
+        except BaseException as e:
+            sys.stderr.write("Failed to start the bot: " + str(e) + "\n")
+            sys.stderr.flush()
+        os._exit(127)
+    confine(root, working_dir, uid, gid)
+    # a bot running as the same user mustn't be able to ptrace its way in
+    _libc.prctl(PR_SET_DUMPABLE, 0, 0, 0, 0)
+    sys.exit(forward(listener, engine, port, pid))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
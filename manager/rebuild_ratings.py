@@ -0,0 +1,132 @@
+"""Recompute team_ratings by replaying every completed ranked match.
+
+Elo is sequential, but matches that share no team don't depend on each other.
+The history is cut into layers of consecutive matches with no team in common,
+and each layer is rated in one vectorized step (with numpy if it's installed,
+plain Python otherwise) using the same formula as results.elo_update.
+
+    python3 rebuild_ratings.py [--sqlite PATH] [--dry-run] [--check]
+
+--check also compares the replayed ratings with the red/blue_rating_after
+values stored on each match and reports how many differ.
+"""
+import time
+from optparse import OptionParser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import db
+import results
+from db import Database
+
+def load_history(database):
+    """Completed ranked matches in the order they finished, as
+    (id, red_team, blue_team, winner, red_rating_after, blue_rating_after)."""
+    rows = database.execute("SELECT id, red_team, blue_team, match_winners, red_rating_after, blue_rating_after FROM scrimmage_matches WHERE ranked = TRUE and status = 'completed' ORDER BY finish_time ASC, id ASC", fetch='all')
+    history = []
+    for match_id, red, blue, winners, red_after, blue_after in rows:
+        winners = db.as_list(winners) or []
+        red_wins, blue_wins = winners.count(red), winners.count(blue)
+        if red_wins == blue_wins:
+            # the worker never completes a tied match; skip rather than guess
+            continue
+        history.append((match_id, red, blue, 1 if red_wins > blue_wins else 2, red_after, blue_after))
+    return history
+
+def layers(history):
+    """Split history into runs of consecutive matches with no team in common."""
+    layer, teams = [], set()
+    for match in history:
+        if match[1] in teams or match[2] in teams:
+            yield layer
+            layer, teams = [], set()
+        layer.append(match)
+        teams.add(match[1])
+        teams.add(match[2])
+    if layer:
+        yield layer
+
+def _rate_layer_numpy(ratings, layer):
+    red = numpy.array([ratings[m[1]] for m in layer], dtype=float)
+    blue = numpy.array([ratings[m[2]] for m in layer], dtype=float)
+    winner = numpy.array([m[3] for m in layer], dtype=float)
+    k = results.ELO_K
+    red = red + k * (2-winner - 1/(1+10**((blue-red)/400)))
+    blue = blue + k * (winner-1 - 1/(1+10**((red-blue)/400)))
+    return red.tolist(), blue.tolist()
+
+def _rate_layer_python(ratings, layer):
+    red, blue = [], []
+    for m in layer:
+        r, b = results.elo_update(ratings[m[1]], ratings[m[2]], m[3])
+        red.append(r)
+        blue.append(b)
+    return red, blue
+
+def replay(history, use_numpy=True):
+    """Returns ({team_id: rating}, [(match_id, red_after, blue_after)])."""
+    rate = _rate_layer_numpy if use_numpy and numpy is not None else _rate_layer_python
+    ratings = {}
+    afters = []
+    for layer in layers(history):
+        for m in layer:
+            ratings.setdefault(m[1], results.ELO_START)
+            ratings.setdefault(m[2], results.ELO_START)
+        red, blue = rate(ratings, layer)
+        for m, r, b in zip(layer, red, blue):
+            ratings[m[1]] = r
+            ratings[m[2]] = b
+            afters.append((m[0], r, b))
+    return ratings, afters
+
+def store(database, ratings):
+    def write(conn, c):
+        db.execute(c, conn, "DELETE FROM team_ratings")
+        for team_id, rating in sorted(ratings.items()):
+            db.execute(c, conn, "INSERT INTO team_ratings (team_id, rating) VALUES (%s, %s)", [team_id, rating])
+    database.transaction(write)
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--sqlite", dest="sqlite", default=None,
+                      help="use this sqlite stand-in database instead of config.PG_CRED")
+    parser.add_option("--dry-run", dest="dry_run", action="store_true", default=False,
+                      help="replay and report without writing team_ratings")
+    parser.add_option("--check", dest="check", action="store_true", default=False,
+                      help="compare against the ratings stored on each match")
+    options, _ = parser.parse_args()
+
+    if options.sqlite:
+        database = Database(lambda: db.connect_sqlite(options.sqlite))
+    else:
+        import psycopg2
+        import config
+        database = Database(lambda: psycopg2.connect(config.PG_CRED))
+    results.ensure_schema(database)
+
+    start = time.time()
+    history = load_history(database)
+    loaded = time.time()
+    ratings, afters = replay(history)
+    replayed = time.time()
+    print("Replayed %d matches (%d layers) for %d teams: %.2fs loading, %.2fs rating%s." % (
+        len(history), sum(1 for _ in layers(history)), len(ratings),
+        loaded - start, replayed - loaded, "" if numpy is not None else " (no numpy)"))
+
+    if options.check:
+        stored = dict((m[0], (m[4], m[5])) for m in history)
+        differ = sum(1 for match_id, r, b in afters
+                     if None in stored[match_id] or abs(stored[match_id][0] - r) > 1e-6
+                     or abs(stored[match_id][1] - b) > 1e-6)
+        print("%d of %d matches have stored ratings that differ from the replay." % (differ, len(afters)))
+
+    if not options.dry_run:
+        store(database, ratings)
+        print("Wrote team_ratings.")
+    database.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Writing finished scrimmage matches back to the database.
+
+Each team's current rating lives in team_ratings, so rating a match reads two
+rows instead of the team's match history. The rows are read FOR UPDATE in the
+transaction that writes the result, which keeps concurrent finishes (and
+several manager nodes) from overwriting each other's updates. A team without a
+row is seeded from its most recent ranked match the first time it is rated;
+rebuild_ratings.py recomputes the whole table from the match history.
+"""
+import db
+import leases
+
+ELO_K = 20
+ELO_START = 1200
+
+RATINGS_SCHEMA = """CREATE TABLE IF NOT EXISTS team_ratings (
+    team_id INTEGER PRIMARY KEY,
+    rating DOUBLE PRECISION NOT NULL
+)"""
+
+def ensure_schema(database):
+    database.execute(RATINGS_SCHEMA)
+
+def _history_rating(conn, c, team_id):
+    """The rating after the team's most recent completed ranked match."""
+    elos = []
+    for side in ('red', 'blue'):
+        db.execute(c, conn, "SELECT " + side + "_rating_after, finish_time FROM scrimmage_matches WHERE ranked = TRUE and status = 'completed' and " + side + "_team=%s ORDER BY finish_time DESC LIMIT 1", [team_id])
+        elos += c.fetchall()
+    if len(elos) == 0:
+        return ELO_START
+    return sorted(elos, key=lambda x: x[1], reverse=True)[0][0]
+
+def _current_ratings(conn, c, team_ids):
+    """{team_id: rating}, locking the teams' rows until the transaction ends."""
+    team_ids = sorted(set(team_ids))
+    placeholders = ", ".join(["%s"] * len(team_ids))
+    db.execute(c, conn, "SELECT team_id FROM team_ratings WHERE team_id IN (" + placeholders + ")", team_ids)
+    missing = set(team_ids) - set(row[0] for row in c.fetchall())
+    for team_id in sorted(missing):
+        db.execute(c, conn, "INSERT INTO team_ratings (team_id, rating) VALUES (%s, %s) ON CONFLICT (team_id) DO NOTHING", [team_id, _history_rating(conn, c, team_id)])
+    lock = "" if db.is_sqlite(conn) else " FOR UPDATE"
+    db.execute(c, conn, "SELECT team_id, rating FROM team_ratings WHERE team_id IN (" + placeholders + ") ORDER BY team_id" + lock, team_ids)
+    return dict(c.fetchall())
+
+def get_team_rating(database, team_id):
+    """The team's current rating."""
+    return database.transaction(lambda conn, c: _current_ratings(conn, c, [team_id])[team_id])
+
+def elo_update(red_elo, blue_elo, winner):
+    """New (red, blue) ratings after a match; winner is 1 for red, 2 for blue."""
+    red_elo += ELO_K * (2-winner - 1/(1+10**((blue_elo-red_elo)/400)))
+    blue_elo += ELO_K * (winner-1 - 1/(1+10**((red_elo-blue_elo)/400)))
+    return red_elo, blue_elo
+
+def record_result(database, match_id, red_team, blue_team, winner, keys, winners, node_id=None):
+    """Rate a completed match and mark it completed. Returns the new ratings.
+
+    Only ranked matches change the teams' stored ratings; unranked ones still
+    record what the ratings would have become.
+
+    With node_id, the node's lease on the match is dropped in the same
+    transaction, and nothing is written (and None returned) if the lease was
+    lost."""
+    def record(conn, c):
+        if node_id is not None and not leases.end(conn, c, match_id, node_id):
+            return None
+        db.execute(c, conn, "SELECT ranked FROM scrimmage_matches WHERE id=%s", [match_id])
+        row = c.fetchone()
+        ranked = row is not None and bool(row[0])
+        ratings = _current_ratings(conn, c, [red_team, blue_team])
+        red_elo, blue_elo = elo_update(ratings[red_team], ratings[blue_team], winner)
+        if ranked:
+            db.execute(c, conn, "UPDATE team_ratings SET rating=%s WHERE team_id=%s", [red_elo, red_team])
+            db.execute(c, conn, "UPDATE team_ratings SET rating=%s WHERE team_id=%s", [blue_elo, blue_team])
+        db.execute(c, conn, "UPDATE scrimmage_matches SET status='completed', match_files=%s, match_winners=%s, red_rating_after=%s, blue_rating_after=%s, finish_time=CURRENT_TIMESTAMP WHERE id=%s", [keys,winners,red_elo,blue_elo,match_id])
+        return red_elo, blue_elo
+    return database.transaction(record)
+
+def record_failure(database, match_id, node_id=None):
+    """Mark a match failed. With node_id, as in record_result: returns False
+    and writes nothing if the node's lease on the match was lost."""
+    def record(conn, c):
+        if node_id is not None and not leases.end(conn, c, match_id, node_id):
+            return False
+        db.execute(c, conn, "UPDATE scrimmage_matches SET status='failed', finish_time=CURRENT_TIMESTAMP WHERE id=%s", [match_id])
+        return True
+    return database.transaction(record)
@@ -1,17 +1,24 @@
 #!/usr/bin/python
 from __future__ import print_function
+import gzip
+import heapq
 import os
+import re
+import selectors
 import shlex
 import signal
 import subprocess
 import sys
+import threading
 import time
+from collections import deque
 from optparse import OptionParser
 from threading import Thread
 import socket
 import fcntl
 import struct
 import shutil
+import resource
 
 def get_ip_address(ifname):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -39,6 +46,37 @@ if sys.version_info >= (3,):
 class SandboxError(Exception):
     pass
 
+# the docker image bots run in, and the limits every bot container gets
+SANDBOX_IMAGE = "ec8e615b0ba5"
+CONTAINER_LIMITS = ["--cpus=1", "--memory=256m", "--memory-swap=256m"]
+# label on every container Sandbox starts, so ones left behind by a crashed
+# manager can be found and removed (see Reaper.sweep)
+SANDBOX_LABEL = "battlehack.sandbox"
+# the engine's port unless start() is given another: bots find it in
+# BATTLECODE_PORT, since a manager running several engines puts each game on
+# one of them
+ENGINE_PORT = 6147
+
+# the manager node sandboxes belong to (see set_node); None for a manager
+# that has the host to itself
+_node = {'id': None}
+
+def set_node(node_id):
+    """Label and name this manager's containers, cgroups and (via
+    node_name) working directories after node_id, so Reaper.sweep only
+    removes what this node left behind when several share a host."""
+    _node['id'] = node_id
+
+def node_name():
+    """The node id made safe for a file or cgroup name, or None."""
+    if _node['id'] is None:
+        return None
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', _node['id'])
+
+def _label():
+    """The label argument docker run gives a sandbox container."""
+    return "=".join([SANDBOX_LABEL, _node['id'] or "1"])
+
 def _guard_monitor(jail):
     guard_out = jail.command_process.stdout
     while True:
@@ -66,67 +104,515 @@ def _guard_monitor(jail):
             jail.resp_queue.put((time, data))
 
 
-def _monitor_file(fd, q):
-    while True:
-        line = fd.readline()
-        if len(line.strip())==64:
-            q.put(line.strip()) 
+CGROUP_FS = "/sys/fs/cgroup"
+
+def _docker_cgroup_dirs(container_id):
+    """The cgroup directories of a docker container, for cgroup v2 (systemd or
+    cgroupfs driver) or the per-controller v1 hierarchies."""
+    for name in ("system.slice/docker-" + container_id + ".scope", "docker/" + container_id):
+        if os.path.isfile(os.path.join(CGROUP_FS, name, "cgroup.controllers")):
+            return [os.path.join(CGROUP_FS, name)]
+    dirs = []
+    for controller in ("cpuacct", "cpu,cpuacct", "cpu", "memory"):
+        for name in ("docker/" + container_id, "system.slice/docker-" + container_id + ".scope"):
+            path = os.path.join(CGROUP_FS, controller, name)
+            if os.path.isdir(path) and path not in dirs:
+                dirs.append(path)
+    return dirs
+
+def _read_file(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+def _read_cgroup(dirs):
+    """Current counters of a cgroup (v1 or v2) as a dict; missing ones are
+    left out. CPU times are in microseconds."""
+    usage = {}
+    for path in dirs:
+        stat = _read_file(os.path.join(path, "cpu.stat"))
+        if stat is not None:
+            fields = dict(line.split() for line in stat.splitlines() if len(line.split()) == 2)
+            if "usage_usec" in fields:
+                usage["cpu_usec"] = int(fields["usage_usec"])
+            if "nr_throttled" in fields:
+                usage["nr_throttled"] = int(fields["nr_throttled"])
+            if "throttled_usec" in fields:
+                usage["throttled_usec"] = int(fields["throttled_usec"])
+            elif "throttled_time" in fields:
+                usage["throttled_usec"] = int(fields["throttled_time"]) // 1000
+        for name, key, scale in (("cpuacct.usage", "cpu_usec", 1000),
+                                 ("memory.current", "memory", 1),
+                                 ("memory.usage_in_bytes", "memory", 1),
+                                 ("memory.peak", "memory_peak", 1),
+                                 ("memory.max_usage_in_bytes", "memory_peak", 1)):
+            value = _read_file(os.path.join(path, name))
+            if value is not None and value.strip().isdigit():
+                usage[key] = int(value) // scale
+    return usage
+
+# Each stream keeps its last LOG_BUFFER_BYTES of output in memory. If
+# set_log_dir() has been called, older output is appended gzipped to
+# <log dir>/<sandbox>.<stream>.gz instead of being dropped.
+LOG_BUFFER_BYTES = 64 * 1024
+_log_dir = {'path': None}
+
+def set_log_dir(path):
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+    _log_dir['path'] = path
+
+class LogBuffer:
+    """A bounded buffer of a stream's most recent lines."""
+
+    def __init__(self, spill_path=None, limit=None):
+        self.spill_path = spill_path
+        self.limit = limit or LOG_BUFFER_BYTES
+        self._lines = deque()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def append(self, line):
+        with self._lock:
+            self._lines.append(line)
+            self._size += len(line) + 1
+            if self._size <= self.limit:
+                return
+            # spill the oldest half at once rather than a line at a time
+            spilled = []
+            while self._size > self.limit // 2:
+                old = self._lines.popleft()
+                self._size -= len(old) + 1
+                spilled.append(old)
+        if self.spill_path is not None:
+            try:
+                with gzip.open(self.spill_path, "at", encoding="utf-8") as f:
+                    f.write("\n".join(spilled) + "\n")
+            except (IOError, OSError) as e:
+                print("Failed to spill sandbox log: " + str(e))
+
+    def lines(self):
+        with self._lock:
+            return list(self._lines)
+
+class _Timer:
+    def __init__(self, interval, fn):
+        self.interval = interval
+        self.fn = fn
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Reactor:
+    """One thread that serves every sandbox's pipes.
+
+    It reads stdout and stderr as they become readable and hands complete
+    lines to the sandbox, writes queued stdin data as the pipe accepts it,
+    reports each process's exit through a pidfd, and runs periodic timers
+    (the resource samplers). The thread count doesn't grow with the number
+    of sandboxes.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._calls = deque()
+        self._timers = []
+        self._sequence = 0
+        # stdin fd -> (owner, pipe, pending bytes)
+        self._writers = {}
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, (self._drain_wakeups, None))
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _call(self, fn):
+        """Run fn on the reactor thread."""
+        with self._lock:
+            self._calls.append(fn)
+        try:
+            os.write(self._wake_w, b"x")
+        except BlockingIOError:
+            pass
+
+    def add(self, owner, process):
+        """Start serving a process's pipes. owner gets _on_line(stream, line)
+        and _on_exit(returncode) calls on the reactor thread."""
+        self._call(lambda: self._add(owner, process))
+
+    def write(self, owner, data):
+        self._call(lambda: self._write(owner, data))
+
+    def call_every(self, interval, fn):
+        """Run fn every interval seconds until the returned timer is cancelled."""
+        timer = _Timer(interval, fn)
+        self._call(lambda: self._schedule(timer, time.time()))
+        return timer
+
+    def _schedule(self, timer, when):
+        self._sequence += 1
+        heapq.heappush(self._timers, (when, self._sequence, timer))
+
+    def _add(self, owner, process):
+        state = {'owner': owner, 'process': process, 'open': 0, 'exited': False}
+        for name, pipe in (('stdout', process.stdout), ('stderr', process.stderr)):
+            if pipe is None:
+                continue
+            os.set_blocking(pipe.fileno(), False)
+            self._selector.register(pipe.fileno(), selectors.EVENT_READ,
+                                    (self._read, (state, name, pipe, bytearray())))
+            state['open'] += 1
+        try:
+            pidfd = os.pidfd_open(process.pid)
+            self._selector.register(pidfd, selectors.EVENT_READ, (self._exited, (state, pidfd)))
+        except (AttributeError, OSError):
+            # no pidfds: notice the exit when the output pipes close
+            state['pidfd'] = None
+        else:
+            state['pidfd'] = pidfd
+        if state['open'] == 0 and state['pidfd'] is None:
+            self._check_exit(state)
+
+    def _drain_wakeups(self, _):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _read(self, data):
+        state, name, pipe, partial = data
+        fd = pipe.fileno()
+        try:
+            chunk = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b""
+        if chunk:
+            partial.extend(chunk)
+            *lines, rest = partial.split(b"\n")
+            partial[:] = rest
+            for line in lines:
+                state['owner']._on_line(name, line.rstrip(b"\r").decode("utf-8", "replace"))
+            return
+        if partial:
+            state['owner']._on_line(name, partial.decode("utf-8", "replace"))
+        self._selector.unregister(fd)
+        pipe.close()
+        state['open'] -= 1
+        if state['open'] == 0 and state['pidfd'] is None:
+            self._check_exit(state)
+
+    def _check_exit(self, state):
+        returncode = state['process'].poll()
+        if returncode is None:
+            # the process closed its output but is still running
+            self._schedule(_Timer(None, lambda: self._check_exit(state)), time.time() + 0.1)
+            return
+        self._finish(state, returncode)
+
+    def _exited(self, data):
+        state, pidfd = data
+        self._selector.unregister(pidfd)
+        os.close(pidfd)
+        state['pidfd'] = None
+        returncode = state['process'].poll()
+        if returncode is None:
+            returncode = state['process'].wait()
+        self._finish(state, returncode)
+
+    def _finish(self, state, returncode):
+        if state['exited']:
+            return
+        state['exited'] = True
+        state['owner']._on_exit(returncode)
+
+    def _write(self, owner, data):
+        pipe = owner.command_process.stdin
+        if pipe is None or pipe.closed:
+            return
+        fd = pipe.fileno()
+        if fd not in self._writers:
+            os.set_blocking(fd, False)
+            self._writers[fd] = (owner, pipe, bytearray())
+            self._selector.register(fd, selectors.EVENT_WRITE, (self._flush, fd))
+        self._writers[fd][2].extend(data)
+
+    def _flush(self, fd):
+        owner, pipe, pending = self._writers[fd]
+        try:
+            written = os.write(fd, pending)
+        except BlockingIOError:
+            return
+        except OSError:
+            # the process closed its stdin (or died); drop what's left
+            written = len(pending)
+        del pending[:written]
+        if not pending:
+            self._selector.unregister(fd)
+            del self._writers[fd]
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self._timers:
+                timeout = max(0, self._timers[0][0] - time.time())
+            for key, mask in self._selector.select(timeout):
+                handler, data = key.data
+                try:
+                    handler(data)
+                except Exception as e:
+                    print("Sandbox reactor error: " + repr(e))
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, timer = heapq.heappop(self._timers)
+                if timer.cancelled:
+                    continue
+                try:
+                    timer.fn()
+                except Exception as e:
+                    print("Sandbox reactor timer error: " + repr(e))
+                if timer.interval is not None:
+                    self._schedule(timer, now + timer.interval)
+            with self._lock:
+                calls, self._calls = self._calls, deque()
+            for fn in calls:
+                try:
+                    fn()
+                except Exception as e:
+                    print("Sandbox reactor error: " + repr(e))
+
+_reactor = {'instance': None}
+_reactor_lock = threading.Lock()
+
+def reactor():
+    """The manager's Reactor, started on first use."""
+    with _reactor_lock:
+        if _reactor['instance'] is None:
+            _reactor['instance'] = Reactor()
+        return _reactor['instance']
+
+class _PipedIO:
+    """Input and output handling shared by the sandbox backends, on top of
+    the Reactor: stdout and stderr lines go to bounded log buffers, and to
+    queues for read_line and read_error if the sandbox was made with
+    read_output, and .exited is set when the process ends. Nothing reads a
+    running bot's output, so its lines would only pile up in the queues."""
+
+    def _init_io(self, read_output=False):
+        self.command_process = None
+        self.stdout_queue = Queue() if read_output else None
+        self.stderr_queue = Queue() if read_output else None
+        self.exited = threading.Event()
+        name = os.path.basename(os.path.normpath(self.working_directory))
+        spill = lambda stream: os.path.join(_log_dir['path'], name + "." + stream + ".gz") if _log_dir['path'] else None
+        self.stdout_log = LogBuffer(spill("stdout"))
+        self.stderr_log = LogBuffer(spill("stderr"))
+
+    def _popen(self, command, **kwargs):
+        self.exited.clear()
+        self.command_process = subprocess.Popen(command,
+                                                stdin=subprocess.PIPE,
+                                                stdout=subprocess.PIPE,
+                                                stderr=subprocess.PIPE,
+                                                **kwargs)
+        reactor().add(self, self.command_process)
+
+    def _on_line(self, stream, line):
+        if stream == 'stdout':
+            self.stdout_log.append(line)
+            if self.stdout_queue is not None:
+                self.stdout_queue.put(line)
+        else:
+            self.stderr_log.append(line)
+            if self.stderr_queue is not None:
+                self.stderr_queue.put(line)
+
+    def _on_exit(self, returncode):
+        self.exited.set()
+
+    def _directory(self):
+        """The working directory if kill() should delete it, else None."""
+        return self.working_directory if self.remove_directory else None
+
+    @property
+    def is_alive(self):
+        """Indicates whether a command is currently running in the sandbox"""
+        if self.command_process is None or self.exited.is_set():
+            return False
+        return self.command_process.poll() is None
+
+    def write(self, str):
+        """Write str to stdin of the process being run"""
+        if not self.is_alive:
+            return False
+        reactor().write(self, str.encode("utf-8"))
+
+    def write_line(self, line):
+        """Write line to stdin of the process being run
+
+        A newline is appended to line and written to stdin of the child process
+
+        """
+        return self.write(line + "\n")
+
+    def read_line(self, timeout=0):
+        """Read line from child process
+
+        Returns a line of the child process' stdout, if one isn't available
+        within timeout seconds it returns None. Also guaranteed to return None
+        at least once after each command that is run in the sandbox.
+
+        """
+        if self.stdout_queue is None:
+            raise SandboxError("Sandbox was made without read_output")
+        if not self.is_alive:
+            timeout=0
+        try:
+            return self.stdout_queue.get(block=True, timeout=timeout)
+        except Empty:
+            return None
+
+    def read_error(self, timeout=0):
+        """Read line from child process' stderr
+
+        Returns a line of the child process' stderr, if one isn't available
+        within timeout seconds it returns None. Also guaranteed to return None
+        at least once after each command that is run in the sandbox.
+
+        """
+        if self.stderr_queue is None:
+            raise SandboxError("Sandbox was made without read_output")
+        if not self.is_alive:
+            timeout=0
+        try:
+            return self.stderr_queue.get(block=True, timeout=timeout)
+        except Empty:
+            return None
+
+    def check_path(self, path, errors):
+        resolved_path = os.path.join(self.working_directory, path)
+        if not os.path.exists(resolved_path):
+            errors.append("Output file " + str(path) + " was not created.")
+            return False
+        else:
+            return True
+
+class ResourceSampler:
+    """Samples a bot's cgroup while it runs.
+
+    cgroup_dirs() returns the cgroup's directories, or None while they aren't
+    known yet (a docker container's id arrives after it starts). If the cgroup
+    was created for this bot alone (fresh), its totals are the bot's; otherwise
+    CPU time and throttling are measured from the first sample and peak memory
+    is the largest use seen between samples.
+    """
+
+    def __init__(self, cgroup_dirs, fresh=True, interval=1.0):
+        self._cgroup_dirs = cgroup_dirs
+        self._fresh = fresh
+        self._interval = interval
+        self._start = time.time()
+        self._baseline = None
+        self._last = {}
+        self._peak = 0
+        self._lock = threading.Lock()
+        self._timer = reactor().call_every(interval, self._sample)
+
+    def _sample(self):
+        dirs = self._cgroup_dirs()
+        if not dirs:
+            return
+        usage = _read_cgroup(dirs)
+        if not usage:
+            return
+        with self._lock:
+            if self._baseline is None:
+                self._baseline = {} if self._fresh else usage
+            self._last = usage
+            self._peak = max(self._peak, usage.get("memory", 0))
+
+    def finish(self):
+        """Take a last sample and return the summary, or None if the cgroup
+        could never be read. Call before the cgroup is removed."""
+        self._timer.cancel()
+        self._sample()
+        if self._baseline is None:
+            return None
+        delta = lambda key: self._last.get(key, 0) - self._baseline.get(key, 0)
+        peak = self._peak
+        if self._fresh:
+            peak = max(peak, self._last.get("memory_peak", 0))
+        return {"wall_seconds": time.time() - self._start,
+                "cpu_seconds": delta("cpu_usec") / 1e6,
+                "throttled_periods": delta("nr_throttled"),
+                "throttled_seconds": delta("throttled_usec") / 1e6,
+                "peak_memory_bytes": peak}
 
-class Sandbox:
+class Sandbox(_PipedIO):
 
-    def __init__(self, working_directory):
+    def __init__(self, working_directory, remove_directory=False, read_output=False):
         """Initialize a new sandbox for the given working directory.
 
         working_directory: the directory in which the shell command should
                            be launched.
+        remove_directory: whether kill() deletes working_directory too, for
+                          directories made just for this sandbox.
+        read_output: whether the output is kept for read_line and read_error.
         """
-        self._is_alive = False
-        self.command_process = None
-        self.stdout_queue = Queue()
-        self.stderr_queue = Queue()
         self.working_directory = working_directory
+        self.remove_directory = remove_directory
+        self._init_io(read_output)
         self.docker_ip = get_ip_address('docker0')
+        # docker run -d prints the new container's id on stdout
+        self.container_id = None
+        self.container_ready = threading.Event()
+        self._killed = False
+        self._kill_lock = threading.Lock()
+        self._sampler = None
+        # set by kill(): the bot's CPU and memory use (see ResourceSampler)
+        self.resource_usage = None
 
-    @property
-    def is_alive(self):
-        """Indicates whether a command is currently running in the sandbox"""
-        if self._is_alive:
-            sub_result = self.command_process.poll()
-            if sub_result is None:
-                return True
-            self.child_queue.put(None)
-            self._is_alive = False
-        return False
+    def _on_line(self, stream, line):
+        if stream == 'stdout' and self.container_id is None and len(line.strip()) == 64:
+            with self._kill_lock:
+                self.container_id = line.strip()
+                killed = self._killed
+            self.container_ready.set()
+            if killed:
+                reaper().remove(self._directory(), container_id=self.container_id)
+            return
+        _PipedIO._on_line(self, stream, line)
+
+    def _on_exit(self, returncode):
+        _PipedIO._on_exit(self, returncode)
+        with self._kill_lock:
+            # docker run exited without printing an id: there's no container
+            orphaned = self._killed and self.container_id is None
+        if orphaned and self.remove_directory:
+            reaper().remove(self.working_directory)
 
-    def start(self, shell_command):
-        shell_command = "docker run -d -v "+self.working_directory+":"+self.working_directory+" --cpus='1' --memory='256m' --memory-swap='256m' --privileged=true ec8e615b0ba5 sh -c \'" + shell_command + " " + self.docker_ip + " \'"
+    def start(self, shell_command, engine_port=ENGINE_PORT):
+        shell_command = "docker run -d --label " + shlex.quote(_label()) + " -e BATTLECODE_PORT=" + str(engine_port) + " -v "+self.working_directory+":"+self.working_directory+" " + " ".join(CONTAINER_LIMITS) + " --privileged=true " + SANDBOX_IMAGE + " sh -c \'" + shell_command + " " + self.docker_ip + " \'"
 
         if self.is_alive:
             raise SandboxError("Tried to run command with one in progress.")
         working_directory = self.working_directory
-        self.child_queue = Queue()
         shell_command = shlex.split(shell_command.replace('\\','/'))
         try:
             print('popen',shell_command)
-            self.command_process = subprocess.Popen(shell_command,
-                                                    stdin=subprocess.PIPE,
-                                                    stdout=subprocess.PIPE,
-                                                    stderr=subprocess.PIPE,
-                                                    universal_newlines=True,
-                                                    cwd=working_directory)
+            self._popen(shell_command, cwd=working_directory)
         except OSError:
             print("There was an error")
             raise SandboxError('Failed to start {0}'.format(shell_command))
-        self._is_alive = True
-        stdout_monitor = Thread(target=_monitor_file,
-                                args=(self.command_process.stdout, self.stdout_queue))
-        stdout_monitor.daemon = True
-        stdout_monitor.start()
-        stderr_monitor = Thread(target=_monitor_file,
-                                args=(self.command_process.stderr, self.stderr_queue))
-        stderr_monitor.daemon = True
-        stderr_monitor.start()
-        Thread(target=self._child_writer).start()
+        self._sampler = ResourceSampler(lambda: self.container_id and _docker_cgroup_dirs(self.container_id))
 
     def kill(self):
         """Stops the sandbox.
@@ -135,21 +621,23 @@ class Sandbox:
         other resources. The shell command running inside the sandbox may be
         suddenly terminated.
 
+        Doesn't block: the container (and the working directory, with
+        remove_directory) is removed by the reaper, once docker run has said
+        which container it started.
+
         """
-        
-        if self.stdout_queue.empty():
+        if self.command_process is None:
             return
-        key = self.stdout_queue.get(block=True, timeout=10)
-        try:
-            os.system("docker container kill " + key + " > /dev/null")
-            os.system("docker container rm " + key + " > /dev/null")
-            self.command_process.kill()
-        except OSError:
-            print("error killing")
-        self.command_process.wait()
-        self.child_queue.put(None)
-        
-        os.system("rm -rf " + self.working_directory)
+        if self._sampler is not None:
+            self.resource_usage = self._sampler.finish()
+            self._sampler = None
+        with self._kill_lock:
+            if self._killed:
+                return
+            self._killed = True
+            ready = self.container_id is not None or self.exited.is_set()
+        if ready and (self.container_id is not None or self.remove_directory):
+            reaper().remove(self._directory(), container_id=self.container_id)
 
     def retrieve(self):
         """Copy the working directory back out of the sandbox."""
@@ -192,77 +680,528 @@ class Sandbox:
         except (ValueError, AttributeError, OSError):
             pass
 
-    def _child_writer(self):
-        queue = self.child_queue
-        stdin = self.command_process.stdin
-        while True:
-            ln = queue.get()
-            if ln is None:
-                break
+def _docker(args, timeout=60):
+    """Run a docker command; returns its stripped stdout or raises SandboxError."""
+    try:
+        result = subprocess.run(["docker"] + args, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, universal_newlines=True,
+                                timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise SandboxError("docker " + args[0] + " failed: " + str(e))
+    if result.returncode != 0:
+        raise SandboxError("docker " + args[0] + " failed: " + result.stderr.strip())
+    return result.stdout.strip()
+
+class Reaper:
+    """Tears down finished sandboxes in the background.
+
+    remove() queues a working directory, optionally with a container to
+    remove first and a cleanup function to call (e.g. removing a cgroup).
+    One thread collects whatever is queued within batch_wait seconds, up to
+    batch_size jobs, removes all their containers with a single docker rm -f,
+    and then runs the cleanups and deletes the directories.
+    """
+
+    def __init__(self, batch_size=32, batch_wait=0.2):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._idle = threading.Condition(self._lock)
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def remove(self, directory=None, container_id=None, cleanup=None):
+        with self._lock:
+            self._pending += 1
+        self._queue.put((directory, container_id, cleanup))
+
+    def backlog(self):
+        """Number of jobs queued or being torn down."""
+        with self._lock:
+            return self._pending
+
+    def drain(self, timeout=None):
+        """Wait until everything queued so far is torn down. Returns False
+        on timeout."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def sweep(self, root, labels=(SANDBOX_LABEL,)):
+        """Queue everything a crashed manager may have left behind: each
+        directory under root, every container with one of labels, and any
+        namespace sandbox cgroups. After set_node(), only containers and
+        cgroups of that node count, and root should be its own directory.
+        Call before starting any sandboxes. Returns how many things were
+        queued."""
+        count = 0
+        for label in labels:
+            if _node['id'] is not None:
+                label += "=" + _node['id']
+            try:
+                ids = _docker(["ps", "-aq", "--filter", "label=" + label]).split()
+            except SandboxError as e:
+                print(str(e))
+                ids = []
+            for container_id in ids:
+                self.remove(container_id=container_id)
+                count += 1
+        if os.path.isdir(root):
+            for name in os.listdir(root):
+                self.remove(os.path.join(root, name))
+                count += 1
+        if os.path.isdir(CGROUP_PARENT):
+            for name in os.listdir(CGROUP_PARENT):
+                path = os.path.join(CGROUP_PARENT, name)
+                if os.path.isdir(path) and name.startswith(_cgroup_prefix()):
+                    self.remove(cleanup=lambda path=path: _remove_cgroup(path))
+                    count += 1
+        return count
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.batch_size:
             try:
-                stdin.write(ln)
-                stdin.flush()
-            except (OSError, IOError):
-                self.kill()
+                batch.append(self._queue.get(timeout=max(0, deadline - time.time())))
+            except Empty:
                 break
+        return batch
 
-    def write(self, str):
-        """Write str to stdin of the process being run"""
-        if not self.is_alive:
-            return False
-        self.child_queue.put(str)
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                ids = [container_id for _, container_id, _ in batch if container_id is not None]
+                if ids:
+                    try:
+                        _docker(["rm", "-f"] + ids, timeout=120)
+                    except SandboxError as e:
+                        print(str(e))
+                for directory, _, cleanup in batch:
+                    if cleanup is not None:
+                        try:
+                            cleanup()
+                        except Exception as e:
+                            print("Sandbox cleanup failed: " + str(e))
+                    if directory is not None:
+                        shutil.rmtree(directory, ignore_errors=True)
+            finally:
+                with self._idle:
+                    self._pending -= len(batch)
+                    self._idle.notify_all()
 
-    def write_line(self, line):
-        """Write line to stdin of the process being run
+_reaper = {'instance': None}
 
-        A newline is appended to line and written to stdin of the child process
+def reaper():
+    """The manager's Reaper, started on first use."""
+    with _reactor_lock:
+        if _reaper['instance'] is None:
+            _reaper['instance'] = Reaper()
+        return _reaper['instance']
 
-        """
-        if not self.is_alive:
+class PooledContainer:
+    """An idle container that keeps running (doing nothing) until a bot is
+    exec'd into it. Its working directory is the only host directory it
+    mounts."""
+
+    def __init__(self, root):
+        self.working_directory = os.path.join(root, "".join("%02x" % b for b in os.urandom(10)))
+        os.makedirs(self.working_directory)
+        os.chmod(self.working_directory, 0o777)
+        try:
+            self.id = _docker(["run", "-d", "--label", ContainerPool.LABEL + "=" + (_node['id'] or "1"),
+                               "-v", self.working_directory + ":" + self.working_directory]
+                              + CONTAINER_LIMITS + ["--privileged=true", SANDBOX_IMAGE,
+                                                    "tail", "-f", "/dev/null"])
+        except SandboxError:
+            shutil.rmtree(self.working_directory, ignore_errors=True)
+            raise
+        self.uses = 0
+
+    def healthy(self):
+        try:
+            _docker(["exec", self.id, "true"], timeout=10)
+            return True
+        except SandboxError:
             return False
-        self.child_queue.put(line + "\n")
 
-    def read_line(self, timeout=0):
-        """Read line from child process
+    def reset(self):
+        """Kill everything but the container's idle process and empty its
+        working directory and /tmp, ready for the next bot."""
+        _docker(["exec", self.id, "sh", "-c", "kill -9 -1; rm -rf /tmp/* /tmp/.[!.]*"], timeout=10)
+        for name in os.listdir(self.working_directory):
+            path = os.path.join(self.working_directory, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
 
-        Returns a line of the child process' stdout, if one isn't available
-        within timeout seconds it returns None. Also guaranteed to return None
-        at least once after each command that is run in the sandbox.
+    def remove(self):
+        reaper().remove(self.working_directory, container_id=self.id)
 
-        """
-        time.sleep(0.1)
-        if not self.is_alive:
-            timeout=0
+class ContainerPool:
+    """Keeps `size` idle bot containers started ahead of time.
+
+    acquire() hands out a PooledSandbox around an idle container (starting
+    one on the spot only if none are idle); when the sandbox is killed its
+    container is reset and reused, or removed and replaced once it has run
+    max_uses bots. One background thread does the resetting, fills the pool
+    at startup, tops it back up and removes idle containers that fail a
+    health check every health_interval seconds.
+    """
+    LABEL = "battlehack.sandbox-pool"
+
+    def __init__(self, root, size, max_uses=1, health_interval=30):
+        self.root = os.path.abspath(root)
+        self.size = size
+        self.max_uses = max_uses
+        self.health_interval = health_interval
+        self.docker_ip = get_ip_address('docker0')
+        os.makedirs(self.root, exist_ok=True)
+        self._idle = Queue()
+        # None to top up the pool, or a released container to recycle
+        self._wake = Queue()
+        thread = Thread(target=self._maintain)
+        thread.daemon = True
+        thread.start()
+
+    def acquire(self):
         try:
-            return self.stdout_queue.get(block=True, timeout=timeout)
+            container = self._idle.get_nowait()
         except Empty:
-            return None
+            container = PooledContainer(self.root)
+        self._wake.put(None)
+        return PooledSandbox(self, container)
 
-    def read_error(self, timeout=0):
-        """Read line from child process' stderr
+    def release(self, container):
+        """Give back a container whose bot is finished; it's recycled in the
+        background."""
+        self._wake.put(container)
 
-        Returns a line of the child process' stderr, if one isn't available
-        within timeout seconds it returns None. Also guaranteed to return None
-        at least once after each command that is run in the sandbox.
+    def _recycle(self, container):
+        container.uses += 1
+        if container.uses < self.max_uses:
+            try:
+                container.reset()
+                self._idle.put(container)
+                return
+            except (SandboxError, OSError) as e:
+                print("Failed to reset sandbox container: " + str(e))
+        container.remove()
 
-        """
-        if not self.is_alive:
-            timeout=0
+    def _maintain(self):
+        last_check = time.time()
+        while True:
+            while self._idle.qsize() < self.size:
+                try:
+                    self._idle.put(PooledContainer(self.root))
+                except (SandboxError, OSError) as e:
+                    print("Failed to start a sandbox container: " + str(e))
+                    time.sleep(1)
+                    break
+            if time.time() - last_check >= self.health_interval:
+                last_check = time.time()
+                for _ in range(self._idle.qsize()):
+                    try:
+                        container = self._idle.get_nowait()
+                    except Empty:
+                        break
+                    if container.healthy():
+                        self._idle.put(container)
+                    else:
+                        print("Removing unhealthy sandbox container " + container.id[:12])
+                        container.remove()
+            try:
+                item = self._wake.get(timeout=max(0, last_check + self.health_interval - time.time()))
+            except Empty:
+                continue
+            # recycle everything released so far before topping up, so
+            # containers about to come back aren't replaced with new ones
+            while True:
+                if item is not None:
+                    self._recycle(item)
+                try:
+                    item = self._wake.get_nowait()
+                except Empty:
+                    break
+
+    def shutdown(self, timeout=60):
+        while True:
+            try:
+                self._idle.get_nowait().remove()
+            except Empty:
+                break
+        reaper().drain(timeout)
+
+class PooledSandbox(_PipedIO):
+    """A Sandbox that runs its command in a pre-started container with
+    docker exec. Files for the bot go in .working_directory."""
+
+    def __init__(self, pool, container):
+        self._pool = pool
+        self._container = container
+        self.working_directory = container.working_directory
+        self._init_io()
+        self._sampler = None
+        self.resource_usage = None
+
+    def start(self, shell_command, engine_port=ENGINE_PORT):
+        if self.is_alive:
+            raise SandboxError("Tried to run command with one in progress.")
+        if self._container is not None:
+            dirs = _docker_cgroup_dirs(self._container.id)
+            self._sampler = ResourceSampler(lambda: dirs, fresh=self._container.uses == 0)
+        if self._container is None:
+            raise SandboxError("Sandbox already killed.")
+        command = ["docker", "exec", "-i", "-e", "BATTLECODE_PORT=" + str(engine_port), self._container.id, "sh", "-c",
+                   shell_command.replace('\\','/') + " " + self._pool.docker_ip]
         try:
-            return self.stderr_queue.get(block=True, timeout=timeout)
-        except Empty:
+            self._popen(command)
+        except OSError:
+            raise SandboxError('Failed to start {0}'.format(command))
+
+    def kill(self):
+        """Stops the bot and hands the container back to the pool."""
+        if self._container is None:
+            return
+        if self.command_process is not None and self.command_process.poll() is None:
+            try:
+                self.command_process.kill()
+            except OSError:
+                pass
+            self.command_process.wait()
+        if self._sampler is not None:
+            self.resource_usage = self._sampler.finish()
+            self._sampler = None
+        container, self._container = self._container, None
+        self._pool.release(container)
+
+    def pause(self):
+        if self._container is not None:
+            try:
+                _docker(["pause", self._container.id])
+            except SandboxError:
+                pass
+
+    def resume(self):
+        if self._container is not None:
+            try:
+                _docker(["unpause", self._container.id])
+            except SandboxError:
+                pass
+
+# The namespace backend puts each bot in its own cgroup under this one,
+# created on first use. If cgroup v2 with the cpu and memory controllers isn't
+# available there, bots fall back to rlimits and a single-CPU affinity.
+CGROUP_PARENT = "/sys/fs/cgroup/battlehack"
+# nsinit.py runs as pid 1 inside these and builds the bot's filesystem and
+# network; --kill-child takes the sandbox down if unshare itself is killed
+UNSHARE_COMMAND = ["unshare", "--pid", "--fork", "--kill-child", "--mount", "--net", "--ipc", "--uts"]
+# without root the namespaces need a user namespace of their own
+UNSHARE_ROOTLESS = ["--user", "--map-root-user"]
+NSINIT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nsinit.py")
+# address bots in the namespace backend use to reach the engine; nsinit.py
+# forwards the engine's port there to the same port on the host
+NAMESPACE_ENGINE_IP = "127.0.0.1"
+# when the manager runs as root each bot gets its own unprivileged uid (and
+# gid) from this range, so bots can't signal, trace or share process limits
+# with each other or anything else on the host
+NAMESPACE_UID_BASE = 200000
+NAMESPACE_UIDS = 10000
+
+MEMORY_LIMIT = 256 * 1024 * 1024
+_cgroup_state = {'parent': False}
+
+def _cgroup_prefix():
+    """What the names of this node's bot cgroups start with."""
+    return node_name() + "@" if _node['id'] is not None else ""
+
+def _cgroup_parent():
+    """The parent cgroup for bots, or None if cgroup v2 can't be used."""
+    if _cgroup_state['parent'] is not False:
+        return _cgroup_state['parent']
+    parent = None
+    try:
+        root = os.path.dirname(CGROUP_PARENT)
+        with open(os.path.join(root, "cgroup.controllers")) as f:
+            available = f.read().split()
+        if "cpu" in available and "memory" in available:
+            with open(os.path.join(root, "cgroup.subtree_control"), "w") as f:
+                f.write("+cpu +memory")
+            if not os.path.isdir(CGROUP_PARENT):
+                os.mkdir(CGROUP_PARENT)
+            with open(os.path.join(CGROUP_PARENT, "cgroup.subtree_control"), "w") as f:
+                f.write("+cpu +memory")
+            parent = CGROUP_PARENT
+    except (IOError, OSError) as e:
+        print("cgroup v2 unavailable (" + str(e) + "), limiting bots with rlimits only")
+    _cgroup_state['parent'] = parent
+    return parent
+
+def _write(path, value):
+    with open(path, "w") as f:
+        f.write(value)
+
+def _remove_cgroup(path):
+    """Kill everything in a bot's cgroup and remove it."""
+    try:
+        _write(os.path.join(path, "cgroup.kill"), "1")
+    except (IOError, OSError):
+        pass
+    for _ in range(50):
+        try:
+            os.rmdir(path)
+            return
+        except FileNotFoundError:
+            return
+        except OSError:
+            time.sleep(0.01)
+    print("Failed to remove cgroup " + path)
+
+class NamespaceSandbox(_PipedIO):
+    """Runs a bot without docker, in its own PID, mount, network, IPC and UTS
+    namespaces set up by nsinit.py: the bot sees only the host's system
+    directories (read-only) and its working directory, its network is
+    loopback with the engine's port forwarded from the host, and it runs
+    with no capabilities, as an unprivileged uid of its own (or, when the
+    manager isn't root, inside a user namespace as the manager's user).
+
+    Limits match the docker sandbox: a cgroup v2 group with cpu.max of one
+    CPU, memory.max of 256MB and no swap. Without cgroup v2 the bot gets an
+    address space rlimit of 256MB and is pinned to one CPU instead. Either
+    way it also gets rlimits on processes, open files and core dumps.
+    """
+    _next_cpu = [0]
+    _next_uid = [0]
+
+    def __init__(self, working_directory, remove_directory=False, read_output=False):
+        self.working_directory = working_directory
+        self.remove_directory = remove_directory
+        self._init_io(read_output)
+        self.cgroup = None
+        self._sampler = None
+        self.resource_usage = None
+
+    def _make_cgroup(self):
+        parent = _cgroup_parent()
+        if parent is None:
             return None
+        path = os.path.join(parent, _cgroup_prefix() + os.path.basename(os.path.normpath(self.working_directory)) +
+                            "-" + "".join("%02x" % b for b in os.urandom(4)))
+        try:
+            os.mkdir(path)
+            _write(os.path.join(path, "cpu.max"), "100000 100000")
+            _write(os.path.join(path, "memory.max"), str(MEMORY_LIMIT))
+            # only there with swap accounting enabled
+            if os.path.exists(os.path.join(path, "memory.swap.max")):
+                _write(os.path.join(path, "memory.swap.max"), "0")
+        except (IOError, OSError) as e:
+            _remove_cgroup(path)
+            raise SandboxError("Failed to create cgroup " + path + ": " + str(e))
+        return path
 
-    def check_path(self, path, errors):
-        resolved_path = os.path.join(self.working_directory, path)
-        if not os.path.exists(resolved_path):
-            errors.append("Output file " + str(path) + " was not created.")
-            return False
+    def _limit_child(self, cpu):
+        """Runs in the child between fork and exec, so it mustn't import or
+        take locks."""
+        if self.cgroup is not None:
+            _write(os.path.join(self.cgroup, "cgroup.procs"), str(os.getpid()))
         else:
-            return True
+            resource.setrlimit(resource.RLIMIT_AS, (MEMORY_LIMIT, MEMORY_LIMIT))
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, [cpu])
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+        resource.setrlimit(resource.RLIMIT_NOFILE, (256, 256))
+        resource.setrlimit(resource.RLIMIT_NPROC, (512, 512))
+
+    def start(self, shell_command, engine_port=ENGINE_PORT):
+        if self.is_alive:
+            raise SandboxError("Tried to run command with one in progress.")
+        self.cgroup = self._make_cgroup()
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else [0]
+        cpu = cpus[self._next_cpu[0] % len(cpus)]
+        self._next_cpu[0] += 1
+        # created here, so it stays in the host's network namespace; nsinit
+        # connects it to the engine when the bot does
+        engine = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        command = list(UNSHARE_COMMAND)
+        init = [sys.executable, NSINIT_SCRIPT, "--dir", self.working_directory,
+                "--engine-fd", str(engine.fileno()), "--engine-port", str(engine_port)]
+        if os.geteuid() == 0:
+            uid = NAMESPACE_UID_BASE + self._next_uid[0] % NAMESPACE_UIDS
+            self._next_uid[0] += 1
+            init += ["--uid", str(uid), "--gid", str(uid)]
+        else:
+            command += UNSHARE_ROOTLESS
+        command += init + ["--", shell_command.replace('\\','/') + " " + NAMESPACE_ENGINE_IP]
+        try:
+            self._popen(command, cwd=self.working_directory, start_new_session=True,
+                        env=dict(os.environ, BATTLECODE_PORT=str(engine_port)),
+                        pass_fds=[engine.fileno()], preexec_fn=lambda: self._limit_child(cpu))
+        except (OSError, subprocess.SubprocessError):
+            self._remove_cgroup()
+            raise SandboxError('Failed to start {0}'.format(command))
+        finally:
+            engine.close()
+        if self.cgroup is not None:
+            dirs = [self.cgroup]
+            self._sampler = ResourceSampler(lambda: dirs)
+
+    def _remove_cgroup(self):
+        if self.cgroup is None:
+            return
+        _remove_cgroup(self.cgroup)
+        self.cgroup = None
+
+    def kill(self):
+        """Kills the bot and everything it started; its cgroup (and the
+        working directory, with remove_directory) are removed by the
+        reaper."""
+        if self.command_process is not None:
+            try:
+                os.killpg(self.command_process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        if self._sampler is not None:
+            self.resource_usage = self._sampler.finish()
+            self._sampler = None
+        cgroup, self.cgroup = self.cgroup, None
+        if cgroup is not None or self.remove_directory:
+            reaper().remove(self._directory(),
+                            cleanup=(lambda: _remove_cgroup(cgroup)) if cgroup is not None else None)
+
+    def _signal(self, sig, freeze):
+        if self.cgroup is not None:
+            try:
+                _write(os.path.join(self.cgroup, "cgroup.freeze"), freeze)
+                return
+            except (IOError, OSError):
+                pass
+        try:
+            os.killpg(self.command_process.pid, sig)
+        except (AttributeError, OSError):
+            pass
+
+    def pause(self):
+        self._signal(signal.SIGSTOP, "1")
+
+    def resume(self):
+        self._signal(signal.SIGCONT, "0")
+
+SANDBOX_BACKENDS = {'docker': Sandbox, 'namespace': NamespaceSandbox}
 
-def get_sandbox(working_dir, secure=None):
-    return Sandbox(working_dir)
+def get_sandbox(working_dir, secure=None, backend='docker', remove_directory=False,
+                read_output=False):
+    """backend: 'docker' (a container per bot) or 'namespace' (see
+    NamespaceSandbox). With remove_directory the sandbox deletes working_dir
+    when it's killed; leave it off for directories it doesn't own, like a
+    bot's source tree being compiled. read_output keeps the command's output
+    for read_line and read_error, as compiling needs."""
+    if backend not in SANDBOX_BACKENDS:
+        raise SandboxError("Unknown sandbox backend " + str(backend))
+    return SANDBOX_BACKENDS[backend](working_dir, remove_directory, read_output)
 
 if __name__ == "__main__":
     main()
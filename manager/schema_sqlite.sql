@@ -0,0 +1,39 @@
+-- The parts of the scrimmage database the manager touches, for running it
+-- against a local sqlite3 file instead of Postgres. Array columns hold JSON.
+CREATE TABLE IF NOT EXISTS battlecode_teams (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS scrimmage_submissions (
+    id INTEGER PRIMARY KEY,
+    team INTEGER REFERENCES battlecode_teams(id),
+    source_code TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS scrimmage_maps (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS scrimmage_matches (
+    id INTEGER PRIMARY KEY,
+    red_team INTEGER REFERENCES battlecode_teams(id),
+    blue_team INTEGER REFERENCES battlecode_teams(id),
+    red_submission INTEGER REFERENCES scrimmage_submissions(id),
+    blue_submission INTEGER REFERENCES scrimmage_submissions(id),
+    maps TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    ranked BOOLEAN NOT NULL DEFAULT TRUE,
+    request_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finish_time TIMESTAMP,
+    match_files TEXT,
+    match_winners TEXT,
+    red_rating_after REAL,
+    blue_rating_after REAL
+);
+
+CREATE TABLE IF NOT EXISTS team_ratings (
+    team_id INTEGER PRIMARY KEY,
+    rating DOUBLE PRECISION NOT NULL
+);
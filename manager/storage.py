@@ -0,0 +1,50 @@
+"""Object storage for bot submissions and replays.
+
+The manager talks to an S3 bucket through boto3. LocalBucket offers the same
+calls against a plain directory, for local testing without S3.
+"""
+import os
+import shutil
+
+class LocalBucket:
+    """The subset of a boto3 Bucket the manager uses, backed by a directory."""
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.directory, key))
+        if not path.startswith(self.directory + os.sep):
+            raise ValueError("Key escapes the bucket: " + key)
+        return path
+
+    def download_file(self, key, filename):
+        shutil.copyfile(self._path(key), filename)
+
+    def Object(self, key):
+        return _LocalObject(self._path(key))
+
+    def put_object(self, Key, Body, ACL=None):
+        path = self._path(Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".part"
+        with open(tmp, "wb") as f:
+            f.write(Body)
+        os.rename(tmp, path)
+
+class _LocalObject:
+    def __init__(self, path):
+        self.path = path
+
+    def get(self):
+        """Like boto3's, the object's contents are the open stream in 'Body'."""
+        return {'Body': open(self.path, 'rb')}
+
+def open_bucket(config):
+    """The bucket named in config: LocalBucket if BUCKET_DIR is set, else S3."""
+    directory = getattr(config, 'BUCKET_DIR', None)
+    if directory:
+        return LocalBucket(directory)
+    import boto3
+    return boto3.resource('s3').Bucket(config.BUCKET_NAME)
@@ -0,0 +1,142 @@
+"""Tests for the submission cache, against a LocalBucket.
+
+    python -m pytest manager/test_artifacts.py
+"""
+import io
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import threading
+import unittest
+import zipfile
+
+import artifacts
+import extract
+from artifacts import ArtifactCache
+from storage import LocalBucket
+
+def _tar(files):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w:gz") as archive:
+        for name, body in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(body)
+            info.mode = 0o755
+            archive.addfile(info, io.BytesIO(body))
+    return data.getvalue()
+
+def _zip(files):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as archive:
+        for name, body in files.items():
+            archive.writestr(name, body)
+    return data.getvalue()
+
+class CountingBucket(LocalBucket):
+    """A LocalBucket that counts downloads."""
+
+    def __init__(self, directory):
+        LocalBucket.__init__(self, directory)
+        self.downloads = []
+        self._lock = threading.Lock()
+
+    def Object(self, key):
+        with self._lock:
+            self.downloads.append(key)
+        return LocalBucket.Object(self, key)
+
+class TestArtifactCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bucket = CountingBucket(os.path.join(self.dir, "bucket"))
+        self.root = os.path.join(self.dir, "cache")
+
+    def tearDown(self):
+        artifacts._set_writable(self.dir, True)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def put(self, key, body):
+        self.bucket.put_object(Key=key, Body=body)
+        return body
+
+    def test_keeps_archive_and_tree(self):
+        cache = ArtifactCache(self.root, self.bucket, 1 << 30)
+        for key, pack in [("subs/a.tar.gz", _tar), ("subs/b.zip", _zip)]:
+            body = self.put(key, pack({"run.sh": b"#!/bin/sh\n", "bot/main.py": b"print(1)\n"}))
+            tree = cache.fetch(key)
+            with open(os.path.join(tree, "bot", "main.py"), "rb") as f:
+                self.assertEqual(f.read(), b"print(1)\n")
+            with open(cache.archive(key), "rb") as f:
+                self.assertEqual(f.read(), body)
+            for path in [os.path.join(tree, "run.sh"), cache.archive(key)]:
+                self.assertFalse(os.stat(path).st_mode & stat.S_IWUSR)
+        self.assertEqual(self.bucket.downloads, ["subs/a.tar.gz", "subs/b.zip"])
+
+    def test_fetches_once(self):
+        self.put("subs/a.tar.gz", _tar({"run.sh": b"#!/bin/sh\n"}))
+        cache = ArtifactCache(self.root, self.bucket, 1 << 30)
+        trees = []
+        threads = [threading.Thread(target=lambda: trees.append(cache.fetch("subs/a.tar.gz")))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(len(set(trees)), 1)
+        self.assertEqual(len(trees), 8)
+        self.assertEqual(self.bucket.downloads, ["subs/a.tar.gz"])
+        # nothing is left behind per key once its fetches are done
+        self.assertEqual(cache._fetching, {})
+
+        # a restarted cache finds the entry on disk
+        cache = ArtifactCache(self.root, self.bucket, 1 << 30)
+        self.assertEqual(cache.fetch("subs/a.tar.gz"), trees[0])
+        self.assertEqual(self.bucket.downloads, ["subs/a.tar.gz"])
+
+    def test_checkout(self):
+        self.put("subs/a.tar.gz", _tar({"run.sh": b"#!/bin/sh\n"}))
+        cache = ArtifactCache(self.root, self.bucket, 1 << 30)
+        destination = os.path.join(self.dir, "game")
+        cache.checkout("subs/a.tar.gz", destination)
+        with open(os.path.join(destination, "run.sh"), "ab") as f:
+            f.write(b"echo changed\n")
+        with open(os.path.join(cache.fetch("subs/a.tar.gz"), "run.sh"), "rb") as f:
+            self.assertEqual(f.read(), b"#!/bin/sh\n")
+
+    def test_evicts_least_recently_used(self):
+        payload = os.urandom(20000)
+        for name in "abc":
+            self.put("subs/%s.tar.gz" % name, _tar({"data": payload}))
+        # room for two entries (tree and archive each) but not three
+        cache = ArtifactCache(self.root, self.bucket, 90000)
+        cache.fetch("subs/a.tar.gz")
+        cache.fetch("subs/b.tar.gz")
+        cache.fetch("subs/a.tar.gz")
+        cache.fetch("subs/c.tar.gz")
+        self.assertEqual(len(os.listdir(self.root)), 2)
+        cache.fetch("subs/a.tar.gz")
+        cache.fetch("subs/c.tar.gz")
+        self.assertEqual(self.bucket.downloads, ["subs/a.tar.gz", "subs/b.tar.gz", "subs/c.tar.gz"])
+        cache.fetch("subs/b.tar.gz")
+        self.assertEqual(self.bucket.downloads[-1], "subs/b.tar.gz")
+
+    def test_bad_archive(self):
+        self.put("subs/bad.tar.gz", b"not an archive")
+        cache = ArtifactCache(self.root, self.bucket, 1 << 30)
+        with self.assertRaises(extract.ArchiveError):
+            cache.fetch("subs/bad.tar.gz")
+        self.assertEqual(os.listdir(self.root), [])
+        self.assertEqual(cache._fetching, {})
+
+    def test_archive_too_large(self):
+        self.put("subs/big.tar.gz", _tar({"data": os.urandom(5000)}))
+        cache = ArtifactCache(self.root, self.bucket, 1 << 30, max_bytes=4000)
+        with self.assertRaises(extract.ArchiveError):
+            cache.fetch("subs/big.tar.gz")
+        self.assertEqual(os.listdir(self.root), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+"""Tests for the engine pool, against stand-in engines.
+
+    python -m pytest manager/test_engine.py
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import unittest
+
+from engine import EnginePool
+
+PLAYER_PYTHON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "player-python")
+
+# an engine that answers createGame and reports logins to the manager, which
+# is enough to tell which engine a bot reached
+FAKE_ENGINE = r'''
+import json, socket, sys, threading
+port = int(sys.argv[sys.argv.index("--tcp-port") + 1])
+games = {}
+manager = []
+lock = threading.Lock()
+def serve(conn):
+    for line in conn.makefile("rb"):
+        message = json.loads(line.decode())
+        if message["command"] == "createGame":
+            game_id = "game-%d-%d" % (port, len(games))
+            with lock:
+                manager[:] = [conn]
+                for index, team in enumerate(message["teams"]):
+                    games[team["key"]] = (game_id, index + 1)
+            reply = {"command": "createGameConfirm", "gameID": game_id, "requestID": message["requestID"]}
+        elif message["command"] == "login":
+            with lock:
+                game_id, team = games[message["key"]]
+                conn = manager[0]
+            reply = {"command": "playerConnected", "id": game_id, "team": team}
+        conn.sendall(json.dumps(reply).encode() + b"\n")
+listener = socket.socket()
+listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+listener.bind(("127.0.0.1", port))
+listener.listen()
+while True:
+    threading.Thread(target=serve, args=(listener.accept()[0],), daemon=True).start()
+'''
+
+# a bot that logs in wherever the client library says its engine is
+BOT = r'''
+import json, os, socket
+import battlecode
+conn = socket.create_connection(battlecode.DEFAULT_SERVER)
+conn.sendall(json.dumps({"command": "login", "key": os.environ["BATTLECODE_PLAYER_KEY"]}).encode() + b"\n")
+'''
+
+def _in_use(port):
+    try:
+        socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+        return True
+    except OSError:
+        return False
+
+def _free_base_port(count):
+    """A port p with p .. p + count - 1 all free."""
+    for base in range(21000, 40000, 97):
+        if not any(_in_use(port) for port in range(base, base + count)):
+            return base
+    raise RuntimeError("no free ports")
+
+class TestEnginePool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = EnginePool([sys.executable, "-c", FAKE_ENGINE], 2, _free_base_port(4))
+        self.pool.start()
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def test_bots_reach_their_games_engine(self):
+        logins = {}
+        done = threading.Event()
+        def handler(name):
+            def handle(message):
+                logins.setdefault(name, []).append(message['team'])
+                if sum(len(teams) for teams in logins.values()) == 4:
+                    done.set()
+            return handle
+
+        created = {}
+        for name in ["first", "second"]:
+            teams = [{"name": name + "-red", "key": name + "-red"},
+                     {"name": name + "-blue", "key": name + "-blue"}]
+            created[name] = self.pool.create_game(teams, "map", handler(name))
+            created[name].result(timeout=10)
+        # one game on each engine
+        self.assertEqual(sorted(future.port for future in created.values()),
+                         sorted(engine.tcp_port for engine in self.pool.engines))
+
+        for name, future in created.items():
+            for color in ["red", "blue"]:
+                env = dict(os.environ, PYTHONPATH=PLAYER_PYTHON, BATTLECODE_PORT=str(future.port),
+                           BATTLECODE_PLAYER_KEY=name + "-" + color)
+                subprocess.run([sys.executable, "-c", BOT], env=env, check=True,
+                               stdout=subprocess.DEVNULL, timeout=30)
+        self.assertTrue(done.wait(10), logins)
+        self.assertEqual({name: sorted(teams) for name, teams in logins.items()},
+                         {"first": [1, 2], "second": [1, 2]})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,272 @@
+"""Tests for unpacking submission archives.
+
+    python -m pytest manager/test_extract.py
+"""
+import io
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import time
+import unittest
+import zipfile
+
+import extract
+from extract import ArchiveError, ArchiveTimeout
+
+
+def _tar(*entries):
+    """A .tar.gz of (name, kind, data) entries: kind is 'file' (data is its
+    contents), 'dir', 'sym' or 'link' (data is the link's target)."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for name, kind, data in entries:
+            info = tarfile.TarInfo(name)
+            if kind == 'file':
+                info.size = len(data)
+                info.mode = 0o644
+                archive.addfile(info, io.BytesIO(data))
+                continue
+            if kind == 'dir':
+                info.type = tarfile.DIRTYPE
+            elif kind == 'sym':
+                info.type = tarfile.SYMTYPE
+                info.linkname = data
+            elif kind == 'link':
+                info.type = tarfile.LNKTYPE
+                info.linkname = data
+            archive.addfile(info)
+    return buffer.getvalue()
+
+def _zip(*entries):
+    """A .zip of (name, kind, data) entries, as for _tar but without hard
+    links."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, kind, data in entries:
+            if kind == 'file':
+                archive.writestr(name, data)
+            elif kind == 'dir':
+                archive.writestr(zipfile.ZipInfo(name.rstrip("/") + "/"), b"")
+            elif kind == 'sym':
+                info = zipfile.ZipInfo(name)
+                info.external_attr = (stat.S_IFLNK | 0o777) << 16
+                archive.writestr(info, data)
+    return buffer.getvalue()
+
+class _Unseekable:
+    """A download stream: read() only."""
+
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+class ExtractTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.out = os.path.join(self.tmp, "out")
+        self.outside = os.path.join(self.tmp, "outside")
+        os.mkdir(self.outside)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def extract(self, data, **limits):
+        extract.extract(io.BytesIO(data), self.out, **limits)
+
+    def read(self, *path):
+        with open(os.path.join(self.out, *path), "rb") as f:
+            return f.read()
+
+    def assertNothingOutside(self):
+        self.assertEqual(os.listdir(self.outside), [])
+        self.assertEqual(sorted(os.listdir(self.tmp)), ["out", "outside"])
+
+class TestExtract(ExtractTest):
+
+    def test_tar(self):
+        self.extract(_tar(("Battle.py", 'file', b"main"), ("lib", 'dir', None),
+                          ("lib/util.py", 'file', b"util"), ("link.py", 'sym', "lib/util.py")))
+        self.assertEqual(self.read("Battle.py"), b"main")
+        self.assertEqual(self.read("lib", "util.py"), b"util")
+        self.assertEqual(os.readlink(os.path.join(self.out, "link.py")), "lib/util.py")
+
+    def test_zip(self):
+        self.extract(_zip(("Battle.py", 'file', b"main"), ("lib", 'dir', None),
+                          ("lib/util.py", 'file', b"util"), ("link.py", 'sym', "lib/util.py")))
+        self.assertEqual(self.read("Battle.py"), b"main")
+        self.assertEqual(self.read("lib", "util.py"), b"util")
+        self.assertEqual(os.readlink(os.path.join(self.out, "link.py")), "lib/util.py")
+
+    def test_unseekable_zip(self):
+        extract.extract(_Unseekable(_zip(("Battle.py", 'file', b"main"))), self.out)
+        self.assertEqual(self.read("Battle.py"), b"main")
+
+    def test_extract_file(self):
+        path = os.path.join(self.tmp, "bot.zip")
+        with open(path, "wb") as f:
+            f.write(_zip(("Battle.py", 'file', b"main")))
+        extract.extract_file(path, self.out)
+        os.remove(path)
+        self.assertEqual(self.read("Battle.py"), b"main")
+
+    def test_not_an_archive(self):
+        with self.assertRaises(ArchiveError):
+            self.extract(b"#!/bin/sh\necho hi\n")
+
+    def test_corrupt_tar(self):
+        data = _tar(("Battle.py", 'file', os.urandom(10000)))
+        with self.assertRaises(ArchiveError):
+            self.extract(data[:len(data) // 2])
+
+    def test_corrupt_zip(self):
+        with self.assertRaises(ArchiveError):
+            self.extract(b"PK\x03\x04" + os.urandom(100))
+
+class TestTraversal(ExtractTest):
+
+    def assertRefused(self, data):
+        with self.assertRaises(ArchiveError):
+            self.extract(data)
+        self.assertNothingOutside()
+
+    def test_dot_dot(self):
+        for name in ["../outside/evil", "lib/../../outside/evil", "./../outside/evil"]:
+            self.assertRefused(_tar((name, 'file', b"evil")))
+            self.assertRefused(_zip((name, 'file', b"evil")))
+
+    def test_absolute(self):
+        name = os.path.join(self.outside, "evil")
+        self.assertRefused(_tar((name, 'file', b"evil")))
+        # zipfile itself strips the leading / when writing, so build the
+        # entry by hand
+        info = zipfile.ZipInfo("x" * len(name))
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            archive.writestr(info, b"evil")
+        self.assertRefused(buffer.getvalue().replace(b"x" * len(name), name.encode()))
+
+    def test_drive_letter(self):
+        self.assertRefused(_tar(("C:/evil", 'file', b"evil")))
+
+    def test_escaping_symlinks(self):
+        for link in [self.outside, "../outside", "lib/../../outside"]:
+            self.assertRefused(_tar(("out", 'sym', link)))
+            self.assertRefused(_zip(("out", 'sym', link)))
+
+    def test_symlink_chain(self):
+        # each link on its own stays inside, but they add up to a way out
+        chain = [("s", 'sym', "."), ("a1", 'sym', "s/..")]
+        chain += [("a%d" % i, 'sym', "a%d/.." % (i - 1)) for i in range(2, 12)]
+        chain.append(("leak", 'sym', "a11/etc/passwd"))
+        for data in [_tar(*chain), _zip(*chain)]:
+            shutil.rmtree(self.out, ignore_errors=True)
+            with self.assertRaises(ArchiveError):
+                self.extract(data)
+            self.assertFalse(os.path.lexists(os.path.join(self.out, "leak")))
+
+    def test_symlink_changed_by_later_entry(self):
+        # a -> s/.. is fine while s doesn't exist, until s -> . arrives
+        self.assertRefused(_tar(("a", 'sym', "s/.."), ("s", 'sym', ".")))
+        shutil.rmtree(self.out)
+        self.assertRefused(_zip(("a", 'sym', "s/.."), ("s", 'sym', ".")))
+
+    def test_symlink_up_inside(self):
+        self.extract(_tar(("lib/util.py", 'file', b"util"), ("bin/util", 'sym', "../lib/util.py"),
+                          ("bin/here", 'sym', "../bin")))
+        self.assertEqual(self.read("bin", "util"), b"util")
+
+    def test_write_through_symlink(self):
+        # a symlink out of the destination that's already there
+        os.makedirs(self.out)
+        os.symlink(self.outside, os.path.join(self.out, "out"))
+        self.assertRefused(_tar(("out/evil", 'file', b"evil")))
+        self.assertRefused(_zip(("out/evil", 'file', b"evil")))
+
+    def test_file_replaces_symlink(self):
+        # writing to a name that's a symlink replaces the link, not its target
+        self.extract(_tar(("target", 'file', b"target"), ("name", 'sym', "target"),
+                          ("name", 'file', b"replaced")))
+        self.assertEqual(self.read("target"), b"target")
+        self.assertEqual(self.read("name"), b"replaced")
+        self.assertFalse(os.path.islink(os.path.join(self.out, "name")))
+
+    def test_hard_link(self):
+        self.extract(_tar(("Battle.py", 'file', b"main"), ("copy.py", 'link', "Battle.py")))
+        self.assertEqual(self.read("copy.py"), b"main")
+        # a copy: the archive can't make two names for one inode
+        self.assertEqual(os.stat(os.path.join(self.out, "copy.py")).st_nlink, 1)
+
+    def test_bad_hard_links(self):
+        secret = os.path.join(self.outside, "secret")
+        with open(secret, "wb") as f:
+            f.write(b"secret")
+        for target in [secret, "../outside/secret", "missing", "lib"]:
+            shutil.rmtree(self.out, ignore_errors=True)
+            with self.assertRaises(ArchiveError):
+                self.extract(_tar(("lib", 'dir', None), ("copy", 'link', target)))
+            self.assertFalse(os.path.exists(os.path.join(self.out, "copy")))
+        # to a symlink, which could point anywhere by the time it's read
+        shutil.rmtree(self.out)
+        with self.assertRaises(ArchiveError):
+            self.extract(_tar(("link", 'sym', "Battle.py"), ("copy", 'link', "link")))
+
+class TestLimits(ExtractTest):
+
+    def test_bytes(self):
+        big = ("big", 'file', b"x" * 1001)
+        for data in [_tar(big), _zip(big)]:
+            with self.assertRaises(ArchiveError):
+                self.extract(data, max_bytes=1000)
+        self.extract(_tar(("a", 'file', b"x" * 600), ("b", 'file', b"x" * 400)), max_bytes=1000)
+        with self.assertRaises(ArchiveError):
+            self.extract(_tar(("a", 'file', b"x" * 600), ("b", 'file', b"x" * 401)), max_bytes=1000)
+
+    def test_unseekable_zip_bytes(self):
+        # spooling the whole stream is bounded too, however well it compresses
+        data = _zip(("big", 'file', os.urandom(3000)))
+        with self.assertRaises(ArchiveError):
+            extract.extract(_Unseekable(data), self.out, max_bytes=2000)
+
+    def test_files(self):
+        files = [("f%d" % i, 'file', b"") for i in range(11)]
+        for data in [_tar(*files), _zip(*files)]:
+            shutil.rmtree(self.out, ignore_errors=True)
+            with self.assertRaises(ArchiveError):
+                self.extract(data, max_files=10)
+        self.extract(_tar(*files[:10]), max_files=10)
+
+    def test_directories_count(self):
+        dirs = [("d%d" % i, 'dir', None) for i in range(11)]
+        for data in [_tar(*dirs), _zip(*dirs)]:
+            shutil.rmtree(self.out, ignore_errors=True)
+            with self.assertRaises(ArchiveError):
+                self.extract(data, max_files=10)
+
+    def test_implied_directories_count(self):
+        # each file makes two directories nobody listed
+        files = [("a%d/b/f" % i, 'file', b"") for i in range(4)]
+        with self.assertRaises(ArchiveError):
+            self.extract(_tar(*files), max_files=10)
+        shutil.rmtree(self.out)
+        self.extract(_tar(*files[:3]), max_files=10)
+        # and the ones that are already there don't count again
+        shutil.rmtree(self.out)
+        self.extract(_tar(*[("a/b/f%d" % i, 'file', b"") for i in range(8)]), max_files=10)
+
+    def test_symlinks_count(self):
+        links = [("l%d" % i, 'sym', "target") for i in range(11)]
+        with self.assertRaises(ArchiveError):
+            self.extract(_tar(*links), max_files=10)
+
+    def test_deadline(self):
+        with self.assertRaises(ArchiveTimeout):
+            self.extract(_tar(("Battle.py", 'file', b"main")), deadline=time.time() - 1)
+        self.extract(_tar(("Battle.py", 'file', b"main")), deadline=time.time() + 60)
+
+if __name__ == "__main__":
+    unittest.main()
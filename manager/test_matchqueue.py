@@ -0,0 +1,128 @@
+"""Tests for claiming matches and requeueing them when their lease runs out,
+on the sqlite stand-in database.
+
+    python -m pytest manager/test_matchqueue.py
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import db
+import leases
+import matchqueue
+
+MATCHES = 120
+
+class QueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "scrim.db")
+        conn = db.connect_sqlite(self.path, create=True)
+        conn.execute("INSERT INTO battlecode_teams VALUES (1, 'red'), (2, 'blue')")
+        conn.execute("INSERT INTO scrimmage_submissions VALUES (1, 1, 'red.zip'), (2, 2, 'blue.zip')")
+        for match_id in range(1, MATCHES + 1):
+            conn.execute("INSERT INTO scrimmage_matches (id, red_team, blue_team, red_submission, blue_submission, maps) VALUES (?, 1, 2, 1, 2, ?)",
+                         (match_id, [1]))
+        conn.commit()
+        conn.close()
+        self.databases = []
+        leases.ensure_schema(self.database())
+
+    def tearDown(self):
+        for database in self.databases:
+            database.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def database(self):
+        """A connection pool of its own, like another manager's."""
+        database = db.Database(lambda: db.connect_sqlite(self.path), size=1, retries=50)
+        self.databases.append(database)
+        return database
+
+    def status(self, match_id):
+        return self.database().execute("SELECT status FROM scrimmage_matches WHERE id=%s", [match_id], fetch='one')[0]
+
+    def run_all(self, targets):
+        errors = []
+        def run(target):
+            try:
+                target()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(target,)) for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+        self.assertEqual(errors, [])
+
+class TestClaim(QueueTest):
+
+    def test_concurrent_claimers_never_share_a_match(self):
+        claimed = [[] for _ in range(8)]
+        def claimer(index):
+            database = self.database()
+            def claim():
+                while True:
+                    rows = matchqueue.claim_matches(database, 3, node_id="node-%d" % index)
+                    if not rows:
+                        return
+                    claimed[index].extend(row[0] for row in rows)
+            return claim
+        self.run_all([claimer(index) for index in range(len(claimed))])
+
+        everything = [match_id for ids in claimed for match_id in ids]
+        self.assertEqual(sorted(everything), list(range(1, MATCHES + 1)))
+        self.assertEqual(matchqueue.queue_depth(self.database()), 0)
+        # each match is leased to the node that claimed it
+        owners = dict((row[0], row[1]) for row in leases.running(self.database()))
+        for index, ids in enumerate(claimed):
+            for match_id in ids:
+                self.assertEqual(owners[match_id], "node-%d" % index)
+
+    def test_claimed_details(self):
+        rows = matchqueue.claim_matches(self.database(), 2, node_id="node")
+        self.assertEqual(rows, [(1, 1, 2, 'red.zip', 'blue.zip', 'red', 'blue', [1], 1, 2),
+                                (2, 1, 2, 'red.zip', 'blue.zip', 'red', 'blue', [1], 1, 2)])
+        self.assertEqual(self.status(1), 'running')
+        self.assertEqual(self.status(3), 'queued')
+
+class TestLeases(QueueTest):
+
+    def test_expired_lease_requeued_once(self):
+        database = self.database()
+        # a lease that has already run out, as if its node died
+        [lost] = matchqueue.claim_matches(database, 1, node_id="dead", lease_time=-1)
+        [kept] = matchqueue.claim_matches(database, 1, node_id="alive")
+
+        requeued = [[] for _ in range(8)]
+        def reclaimer(index):
+            database = self.database()
+            return lambda: requeued[index].extend(leases.reclaim_expired(database))
+        self.run_all([reclaimer(index) for index in range(len(requeued))])
+
+        self.assertEqual(sorted(match_id for ids in requeued for match_id in ids), [lost[0]])
+        self.assertEqual(self.status(lost[0]), 'queued')
+        self.assertEqual(self.status(kept[0]), 'running')
+        self.assertEqual(leases.reclaim_expired(database), [])
+        self.assertEqual([row[0] for row in leases.running(database)], [kept[0]])
+
+        # the node that lost the lease can't write its result any more
+        self.assertFalse(leases.release(database, lost[0], "dead"))
+        self.assertEqual(leases.heartbeat(database, "dead", [lost[0]]), set())
+        # and whoever claims the match next gets a fresh lease on it
+        self.assertEqual(matchqueue.claim_matches(database, 1, node_id="other")[0][0], lost[0])
+        self.assertTrue(leases.owns(database, lost[0], "other"))
+
+    def test_heartbeat_keeps_lease(self):
+        database = self.database()
+        [match] = matchqueue.claim_matches(database, 1, node_id="node", lease_time=-1)
+        self.assertEqual(leases.heartbeat(database, "node", [match[0]]), {match[0]})
+        self.assertEqual(leases.reclaim_expired(database), [])
+        self.assertEqual(self.status(match[0]), 'running')
+
+if __name__ == "__main__":
+    unittest.main()
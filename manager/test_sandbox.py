@@ -0,0 +1,100 @@
+"""Tests for the sandbox's output handling, on the namespace backend, and
+for the startup sweep.
+
+    python -m pytest manager/test_sandbox.py
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import sandbox
+from sandbox import Reaper, SandboxError, get_sandbox
+
+@unittest.skipUnless(shutil.which("unshare"), "needs unshare")
+class TestSandboxOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.chmod(self.dir, 0o777)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def run_lines(self, box, count):
+        box.start("for i in $(seq %d); do echo out $i; echo err $i >&2; done; true" % count)
+        self.assertTrue(box.exited.wait(30))
+        # the exit can be seen before the last lines are handled
+        deadline = time.time() + 10
+        while len(box.stdout_log.lines()) < count and time.time() < deadline:
+            time.sleep(0.01)
+        box.kill()
+
+    def test_read_output(self):
+        box = get_sandbox(self.dir, backend='namespace', read_output=True)
+        self.run_lines(box, 3)
+        lines = []
+        line = box.read_line()
+        while line is not None:
+            lines.append(line)
+            line = box.read_line()
+        self.assertEqual(lines, ["out 1", "out 2", "out 3"])
+        self.assertEqual(box.read_error(), "err 1")
+
+    def test_output_not_queued_by_default(self):
+        box = get_sandbox(self.dir, backend='namespace')
+        self.run_lines(box, 1000)
+        self.assertIsNone(box.stdout_queue)
+        self.assertIsNone(box.stderr_queue)
+        self.assertEqual(box.stdout_log.lines()[-1], "out 1000")
+        self.assertRaises(SandboxError, box.read_line)
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cgroups = os.path.join(self.dir, "cgroups")
+        self.docker = []
+        for name in ["node-a@bot-1", "node-a@bot-2", "node-b@bot-3", "node-a2@bot-4"]:
+            os.makedirs(os.path.join(self.cgroups, name))
+        for path in ["node-a/bot-1", "node-a/pool", "node-b/bot-3"]:
+            os.makedirs(os.path.join(self.dir, "workingPath", path))
+        patches = [mock.patch.object(sandbox, "CGROUP_PARENT", self.cgroups),
+                   mock.patch.object(sandbox, "_docker", self.fake_docker),
+                   # os.rmdir, as writing cgroup.kill would make a real directory non-empty
+                   mock.patch.object(sandbox, "_remove_cgroup", os.rmdir),
+                   mock.patch.dict(sandbox._node)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def fake_docker(self, args, timeout=60):
+        self.docker.append(args)
+        if args[0] == "ps":
+            return {"label=battlehack.sandbox=node-a": "c1\nc2"}.get(args[-1], "")
+        return ""
+
+    def test_only_this_nodes_sandboxes(self):
+        sandbox.set_node("node-a")
+        reaper = Reaper()
+        count = reaper.sweep(os.path.join(self.dir, "workingPath", sandbox.node_name()),
+                             labels=(sandbox.SANDBOX_LABEL,))
+        self.assertTrue(reaper.drain(10))
+        self.assertEqual(count, 6)
+        self.assertEqual(sorted(os.listdir(self.cgroups)), ["node-a2@bot-4", "node-b@bot-3"])
+        self.assertEqual(os.listdir(os.path.join(self.dir, "workingPath", "node-a")), [])
+        self.assertEqual(os.listdir(os.path.join(self.dir, "workingPath", "node-b")), ["bot-3"])
+        self.assertEqual(self.docker[0], ["ps", "-aq", "--filter", "label=battlehack.sandbox=node-a"])
+        self.assertEqual(sorted(self.docker[1][2:]), ["c1", "c2"])
+
+    def test_node_name(self):
+        sandbox.set_node("worker 3:1234")
+        self.assertEqual(sandbox.node_name(), "worker_3_1234")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+"""Tests for the replay uploader.
+
+    python -m pytest manager/test_uploads.py
+"""
+import base64
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from storage import LocalBucket
+from uploads import ReplayUploader
+
+class GatedBucket(LocalBucket):
+    """A LocalBucket whose uploads wait until the test opens the gate."""
+
+    def __init__(self, directory):
+        LocalBucket.__init__(self, directory)
+        self.gate = threading.Event()
+
+    def put_object(self, Key, Body, ACL=None):
+        self.gate.wait()
+        LocalBucket.put_object(self, Key, Body, ACL)
+
+class TestReplayUploader(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bucket = GatedBucket(os.path.join(self.dir, "bucket"))
+        self.finished = []
+        self.uploader = ReplayUploader(self.bucket, os.path.join(self.dir, "spool"),
+                                       lambda meta, keys: self.finished.append(meta),
+                                       workers=1, queue_size=2)
+
+    def tearDown(self):
+        self.bucket.gate.set()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def submit(self, job_id):
+        replay = base64.b64encode(b"replay " + str(job_id).encode()).decode()
+        self.uploader.submit(job_id, [replay], ["replays/%d.bc" % job_id], job_id)
+
+    def test_full_queue_doesnt_block(self):
+        # one job uploading and two queued fill the uploader; the rest must
+        # neither block submit() nor recover()
+        started = time.time()
+        for job_id in range(6):
+            self.submit(job_id)
+        self.uploader.recover()
+        self.assertLess(time.time() - started, 5)
+        self.assertTrue(self.uploader.full())
+        self.assertEqual(len(self.uploader.jobs()), 6)
+        self.assertLessEqual(self.uploader.backlog(), 3)
+
+        # the overflow waited in the spool and a later recover() picks it up
+        self.bucket.gate.set()
+        deadline = time.time() + 10
+        while len(self.finished) < 6 and time.time() < deadline:
+            self.uploader.recover()
+            time.sleep(0.01)
+        self.assertEqual(sorted(self.finished), list(range(6)))
+        self.assertEqual(self.uploader.jobs(), [])
+        self.assertFalse(self.uploader.full())
+        for job_id in range(6):
+            with open(os.path.join(self.bucket.directory, "replays", "%d.bc" % job_id), "rb") as f:
+                self.assertEqual(f.read(), b"replay " + str(job_id).encode())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+"""Tests for recording bots' resource usage, on the sqlite stand-in database.
+
+    python -m pytest manager/test_usage.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import db
+import usage
+
+def _usage(cpu_seconds, wall_seconds=10.0):
+    return {"wall_seconds": wall_seconds, "cpu_seconds": cpu_seconds, "throttled_periods": 0,
+            "throttled_seconds": 0.0, "peak_memory_bytes": 1000}
+
+class TestRecord(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, "scrim.db")
+        self.database = db.Database(lambda: db.connect_sqlite(path, create=True))
+        usage.ensure_schema(self.database)
+
+    def tearDown(self):
+        self.database.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_replayed_match_replaces_its_rows(self):
+        usage.record(self.database, 7, [(0, 1, 11, _usage(2.0)), (0, 2, 12, _usage(3.0)),
+                                        (1, 1, 11, None)])
+        # the match was requeued after its lease expired and played again
+        usage.record(self.database, 7, [(0, 1, 11, _usage(9.0)), (0, 2, 12, _usage(8.0)),
+                                        (1, 1, 11, _usage(1.0))])
+        rows = self.database.execute("SELECT map_index, team_id, cpu_seconds FROM match_resource_usage ORDER BY map_index, team_id", fetch='all')
+        self.assertEqual(rows, [(0, 1, 9.0), (0, 2, 8.0), (1, 1, 1.0)])
+        profile = usage.profile(self.database, submission_id=11)
+        self.assertEqual(profile["matches"], 2)
+        self.assertEqual(profile["cpu_seconds_mean"], 5.0)
+
+if __name__ == "__main__":
+    unittest.main()
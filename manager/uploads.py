@@ -0,0 +1,171 @@
+"""Uploading match replays off the engine listener thread.
+
+A finished game's replays are written to a spool directory and handed to a
+small pool of upload threads; the game's database row is finalized by a
+callback once every replay is in the bucket. The spool makes uploads
+survive a crash or restart: each job is a directory holding the decoded
+replays and a job.json sidecar with the bucket keys, which of them are already
+uploaded, and the caller's metadata for the callback. recover() requeues
+whatever is left in the spool.
+
+The queue of jobs is bounded, but submit() and recover() never block on it:
+they run on the engine listener and heartbeat threads. A job that doesn't
+fit stays in the spool for a later recover(), and full() tells the caller to
+stop taking on new games until uploads catch up.
+"""
+import base64
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+SIDECAR = "job.json"
+
+def _write_json(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+class ReplayUploader:
+
+    def __init__(self, bucket, spool_dir, finalize, workers=4, queue_size=32,
+                 retries=5, retry_delay=1.0, acl='public-read'):
+        """bucket: anything with put_object(Key, Body, ACL).
+        finalize(meta, keys): called once all of a job's replays are uploaded,
+        with keys[i] None where replay i was missing. If it raises, the job
+        stays spooled and is retried by the next recover()."""
+        self.bucket = bucket
+        self.spool_dir = os.path.abspath(spool_dir)
+        self.finalize = finalize
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.acl = acl
+        os.makedirs(self.spool_dir, exist_ok=True)
+        for name in os.listdir(self.spool_dir):
+            if name.startswith("."):
+                # a submit() interrupted before its job was complete
+                shutil.rmtree(os.path.join(self.spool_dir, name), ignore_errors=True)
+
+        self.queue_size = queue_size
+        self._queue = Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        # jobs queued or being uploaded, so recover() doesn't add them twice
+        self._pending = set()
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, job_id, replays, keys, meta):
+        """Spool a job and queue it for upload.
+
+        replays: base64 replay strings (or None); keys: the bucket key for each.
+        meta must be JSON serializable. Never blocks: if the queue is full,
+        the job waits in the spool for the next recover()."""
+        job_id = str(job_id)
+        staging = tempfile.mkdtemp(prefix=".job-", dir=self.spool_dir)
+        files = []
+        for index, replay in enumerate(replays):
+            if replay is None:
+                files.append(None)
+                continue
+            files.append("replay-%d" % index)
+            with open(os.path.join(staging, files[-1]), "wb") as f:
+                f.write(base64.b64decode(replay))
+        _write_json(os.path.join(staging, SIDECAR), {
+            "files": files,
+            "keys": [key if file is not None else None for key, file in zip(keys, files)],
+            "uploaded": [file is None for file in files],
+            "meta": meta,
+        })
+        job_dir = os.path.join(self.spool_dir, job_id)
+        if os.path.exists(job_dir):
+            shutil.rmtree(job_dir)
+        os.rename(staging, job_dir)
+        self._enqueue(job_id)
+
+    def recover(self):
+        """Queue every spooled job that isn't already queued. Returns how many."""
+        count = 0
+        for job_id in sorted(os.listdir(self.spool_dir)):
+            job_dir = os.path.join(self.spool_dir, job_id)
+            if job_id.startswith("."):
+                continue
+            if os.path.isfile(os.path.join(job_dir, SIDECAR)) and self._enqueue(job_id):
+                count += 1
+        return count
+
+    def jobs(self):
+        """Ids of every spooled job, including those waiting for recover()."""
+        return [job_id for job_id in os.listdir(self.spool_dir) if not job_id.startswith(".")]
+
+    def full(self):
+        """Whether the spool holds at least a queue's worth of jobs."""
+        return len(self.jobs()) >= self.queue_size
+
+    def backlog(self):
+        """Number of jobs queued or uploading."""
+        with self._lock:
+            return len(self._pending)
+
+    def _enqueue(self, job_id):
+        with self._lock:
+            if job_id in self._pending:
+                return False
+            self._pending.add(job_id)
+        try:
+            self._queue.put_nowait(job_id)
+        except Full:
+            with self._lock:
+                self._pending.discard(job_id)
+            return False
+        return True
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run(job_id)
+            except Exception as e:
+                print("Replay upload " + job_id + " failed, leaving it spooled: " + str(e))
+            finally:
+                with self._lock:
+                    self._pending.discard(job_id)
+
+    def _retry(self, operation):
+        for attempt in range(self.retries):
+            try:
+                return operation()
+            except Exception:
+                if attempt == self.retries - 1:
+                    raise
+                time.sleep(self.retry_delay * 2**attempt)
+
+    def _run(self, job_id):
+        job_dir = os.path.join(self.spool_dir, job_id)
+        sidecar = os.path.join(job_dir, SIDECAR)
+        with open(sidecar) as f:
+            job = json.load(f)
+
+        for index, file in enumerate(job["files"]):
+            if job["uploaded"][index]:
+                continue
+            with open(os.path.join(job_dir, file), "rb") as f:
+                body = f.read()
+            self._retry(lambda: self.bucket.put_object(Key=job["keys"][index], Body=body, ACL=self.acl))
+            job["uploaded"][index] = True
+            _write_json(sidecar, job)
+            os.remove(os.path.join(job_dir, file))
+
+        self.finalize(job["meta"], job["keys"])
+        shutil.rmtree(job_dir)
@@ -0,0 +1,108 @@
+"""CPU and memory use of bots, per match and per submission.
+
+The worker records one row per bot per map in match_resource_usage from the
+sandbox's cgroup counters (see sandbox.ResourceSampler). profile() sums them
+up per submission, to tell a slow bot from a busy host: a bot that spends
+most of its wall time on CPU, or is often throttled at its one-CPU limit, is
+running close to the turn timeout.
+
+    python3 usage.py --submission ID [--sqlite PATH]
+    python3 usage.py --team ID [--sqlite PATH]
+"""
+import json
+from optparse import OptionParser
+
+import db
+from db import Database
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS match_resource_usage (
+    match_id INTEGER NOT NULL,
+    map_index INTEGER NOT NULL,
+    team_id INTEGER NOT NULL,
+    submission_id INTEGER,
+    wall_seconds DOUBLE PRECISION,
+    cpu_seconds DOUBLE PRECISION,
+    throttled_periods INTEGER,
+    throttled_seconds DOUBLE PRECISION,
+    peak_memory_bytes BIGINT,
+    PRIMARY KEY (match_id, map_index, team_id)
+)"""
+
+INDEX = "CREATE INDEX IF NOT EXISTS match_resource_usage_submission ON match_resource_usage (submission_id)"
+
+# a bot using at least this fraction of its wall time on CPU is counted as
+# running close to its limit
+BUSY_FRACTION = 0.8
+
+def ensure_schema(database):
+    database.execute(SCHEMA)
+    database.execute(INDEX)
+
+# a match that was requeued and played again replaces its earlier rows
+_UPSERT = """INSERT INTO match_resource_usage (match_id, map_index, team_id, submission_id, wall_seconds, cpu_seconds, throttled_periods, throttled_seconds, peak_memory_bytes)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT (match_id, map_index, team_id) DO UPDATE SET
+submission_id=excluded.submission_id, wall_seconds=excluded.wall_seconds, cpu_seconds=excluded.cpu_seconds,
+throttled_periods=excluded.throttled_periods, throttled_seconds=excluded.throttled_seconds,
+peak_memory_bytes=excluded.peak_memory_bytes"""
+
+def record(database, match_id, rows):
+    """rows: (map_index, team_id, submission_id, usage) with usage a
+    ResourceSampler summary; rows whose usage is None are skipped. Rows
+    already recorded for the match, by an earlier attempt at it, are
+    overwritten."""
+    def insert(conn, c):
+        for map_index, team_id, submission_id, usage in rows:
+            if usage is None:
+                continue
+            db.execute(c, conn, _UPSERT,
+                       [match_id, map_index, team_id, submission_id, usage['wall_seconds'], usage['cpu_seconds'],
+                        usage['throttled_periods'], usage['throttled_seconds'], usage['peak_memory_bytes']])
+    database.transaction(insert)
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def profile(database, submission_id=None, team_id=None):
+    """Summary of every recorded match of a submission (or of all a team's
+    submissions), or None if there are none."""
+    column, value = ("submission_id", submission_id) if submission_id is not None else ("team_id", team_id)
+    rows = database.execute("SELECT wall_seconds, cpu_seconds, throttled_periods, throttled_seconds, peak_memory_bytes FROM match_resource_usage WHERE " + column + "=%s", [value], fetch='all')
+    if not rows:
+        return None
+    busy = [cpu / wall for wall, cpu, _, _, _ in rows if wall]
+    throttled = [throttled / wall for wall, _, _, throttled, _ in rows if wall]
+    return {
+        "matches": len(rows),
+        "cpu_seconds_mean": sum(row[1] for row in rows) / len(rows),
+        "cpu_fraction_p50": _percentile(busy, 0.5) if busy else None,
+        "cpu_fraction_p95": _percentile(busy, 0.95) if busy else None,
+        "busy_matches": sum(1 for fraction in busy if fraction >= BUSY_FRACTION),
+        "throttled_fraction_p95": _percentile(throttled, 0.95) if throttled else None,
+        "throttled_periods_total": sum(row[2] for row in rows),
+        "peak_memory_bytes_max": max(row[4] for row in rows),
+    }
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--submission", dest="submission", type="int", default=None)
+    parser.add_option("--team", dest="team", type="int", default=None)
+    parser.add_option("--sqlite", dest="sqlite", default=None,
+                      help="use this sqlite stand-in database instead of config.PG_CRED")
+    options, _ = parser.parse_args()
+    if options.submission is None and options.team is None:
+        parser.error("give --submission or --team")
+
+    if options.sqlite:
+        database = Database(lambda: db.connect_sqlite(options.sqlite))
+    else:
+        import psycopg2
+        import config
+        database = Database(lambda: psycopg2.connect(config.PG_CRED))
+    ensure_schema(database)
+    print(json.dumps(profile(database, options.submission, options.team), indent=2, sort_keys=True))
+    database.close()
+
+if __name__ == "__main__":
+    main()
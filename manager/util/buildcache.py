@@ -0,0 +1,195 @@
+"""A content-addressed build cache for compile_anything.
+
+A tree entry holds everything a successful compile added to or changed in a
+submission's directory, run.sh included, and the paths it deleted. It's keyed
+by the hash of the source tree before compiling, the detected language and
+its compiler arguments, so an archive that was compiled before is restored
+instead of compiled again.
+
+An object entry holds the output of one compiler invocation on one source
+file (TargetCompiler, and ExternalCompiler with separate=True). It's keyed by
+the compiler arguments, the file and every header in the tree, so changing
+one file of a C or C++ bot recompiles only that file before linking.
+Invocations whose outputs aren't declared (no out_ext or out_files) depend
+on the whole tree instead.
+
+Entries are evicted least recently used first once the cache is over its
+byte budget.
+"""
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+CACHE_VERSION = 1
+HEADER_GLOBS = ("*.h", "*.hh", "*.hpp", "*.hxx", "*.inc")
+MANIFEST = "manifest.json"
+
+def file_digest(path):
+	digest = hashlib.sha256()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1 << 16), b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def snapshot(bot_dir):
+	"""{relative path: (content digest, mode)} for every file under bot_dir;
+	symlinks are recorded by their target."""
+	files = {}
+	for root, dirs, names in os.walk(bot_dir):
+		dirs.sort()
+		for name in names + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+			path = os.path.join(root, name)
+			rel = os.path.relpath(path, bot_dir)
+			if os.path.islink(path):
+				files[rel] = ("link:" + os.readlink(path), 0)
+			else:
+				files[rel] = (file_digest(path), os.stat(path).st_mode & 0o7777)
+	return files
+
+def changes(before, after):
+	"""(paths added or changed, paths removed) between two snapshots."""
+	changed = sorted(path for path, entry in after.items() if before.get(path) != entry)
+	removed = sorted(path for path in before if path not in after)
+	return changed, removed
+
+def _digest(*parts):
+	return hashlib.sha256(json.dumps([CACHE_VERSION] + list(parts), sort_keys=True).encode()).hexdigest()
+
+def _dir_size(path):
+	total = 0
+	for root, _, names in os.walk(path):
+		for name in names:
+			try:
+				total += os.lstat(os.path.join(root, name)).st_size
+			except OSError:
+				pass
+	return total
+
+class BuildCache:
+
+	def __init__(self, root, budget_bytes):
+		self.root = os.path.abspath(root)
+		self.budget_bytes = budget_bytes
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		# entry path -> (size, last used)
+		self._entries = {}
+		for kind in ("trees", "objects"):
+			directory = os.path.join(self.root, kind)
+			os.makedirs(directory, exist_ok=True)
+			for name in os.listdir(directory):
+				path = os.path.join(directory, name)
+				if name.startswith(".") or not os.path.isfile(os.path.join(path, MANIFEST)):
+					# an interrupted store
+					shutil.rmtree(path, ignore_errors=True)
+					continue
+				self._entries[path] = (_dir_size(path), os.path.getmtime(path))
+
+	def tree_key(self, before, language, args):
+		"""before: snapshot() of the submission; args: anything else the
+		build depends on (compiler arguments, run command)."""
+		return _digest("tree", sorted(before.items()), language, args)
+
+	def object_key(self, args, source, before, outputs_known=True):
+		"""Key for compiling source (a path relative to the tree) with args.
+		Without declared outputs the invocation may read or write anything,
+		so the whole tree goes into the key."""
+		source = os.path.normpath(source)
+		if outputs_known:
+			depends = sorted((path, entry) for path, entry in before.items()
+							 if any(fnmatch.fnmatch(os.path.basename(path), glob) for glob in HEADER_GLOBS))
+		else:
+			depends = sorted(before.items())
+		return _digest("object", args, source, before.get(source), depends)
+
+	def restore_tree(self, key, bot_dir):
+		return self._restore(os.path.join(self.root, "trees", key), bot_dir)
+
+	def store_tree(self, key, bot_dir, before, after):
+		changed, removed = changes(before, after)
+		self._store(os.path.join(self.root, "trees", key), bot_dir, changed, removed)
+
+	def restore_object(self, key, bot_dir):
+		return self._restore(os.path.join(self.root, "objects", key), bot_dir)
+
+	def store_object(self, key, bot_dir, paths):
+		self._store(os.path.join(self.root, "objects", key), bot_dir,
+					[os.path.normpath(path) for path in paths], [])
+
+	def _restore(self, entry, bot_dir):
+		"""Copy an entry's files into bot_dir and delete its removed paths.
+		False if there's no such entry, including one evicted while it was
+		being restored: the caller builds it instead, overwriting whatever
+		was copied."""
+		try:
+			with open(os.path.join(entry, MANIFEST)) as f:
+				manifest = json.load(f)
+			for path in manifest["removed"]:
+				target = os.path.join(bot_dir, path)
+				if os.path.isdir(target) and not os.path.islink(target):
+					shutil.rmtree(target, ignore_errors=True)
+				elif os.path.lexists(target):
+					os.remove(target)
+			for path in manifest["files"]:
+				source = os.path.join(entry, "files", path)
+				target = os.path.join(bot_dir, path)
+				os.makedirs(os.path.dirname(target), exist_ok=True)
+				if os.path.lexists(target):
+					os.remove(target)
+				shutil.copy2(source, target, follow_symlinks=False)
+		except (IOError, OSError, ValueError):
+			with self._lock:
+				self.misses += 1
+			return False
+		now = time.time()
+		try:
+			os.utime(entry, (now, now))
+		except OSError:
+			pass
+		with self._lock:
+			self.hits += 1
+			if entry in self._entries:
+				self._entries[entry] = (self._entries[entry][0], now)
+		return True
+
+	def _store(self, entry, bot_dir, files, removed):
+		if os.path.isdir(entry):
+			return
+		staging = tempfile.mkdtemp(prefix=".store-", dir=os.path.dirname(entry))
+		try:
+			for path in files:
+				target = os.path.join(staging, "files", path)
+				os.makedirs(os.path.dirname(target), exist_ok=True)
+				shutil.copy2(os.path.join(bot_dir, path), target, follow_symlinks=False)
+			with open(os.path.join(staging, MANIFEST), "w") as f:
+				json.dump({"files": files, "removed": removed}, f)
+			os.rename(staging, entry)
+		except OSError:
+			# a concurrent store of the same entry got there first, or the
+			# outputs vanished; either way there's nothing to keep
+			shutil.rmtree(staging, ignore_errors=True)
+			return
+		with self._lock:
+			self._entries[entry] = (_dir_size(entry), time.time())
+		self._evict(keep=entry)
+
+	def _evict(self, keep=None):
+		with self._lock:
+			total = sum(size for size, _ in self._entries.values())
+			victims = []
+			for entry, (size, used) in sorted(self._entries.items(), key=lambda e: e[1][1]):
+				if total <= self.budget_bytes:
+					break
+				if entry == keep:
+					continue
+				victims.append(entry)
+				del self._entries[entry]
+				total -= size
+		for entry in victims:
+			shutil.rmtree(entry, ignore_errors=True)
@@ -1,26 +1,71 @@
 import sys
+import time
 import zipfile
 from compiler import *
+import extract
 import json
 
-def compile(zipFilename):
+TIMEOUT_MESSAGE = "Compiling your bot timed out."
+
+def unpack(zipFilename, workingPath, deadline=None):
+	"""Extract a submission zip (or tar.gz) into workingPath."""
+	extract.extract_file(zipFilename, workingPath, deadline=deadline)
+
+def zipFolder(workingPath, zipFilename, deadline=None, commit=None):
+	"""Replace zipFilename with a zip of workingPath's contents. Returns False,
+	leaving zipFilename alone, if that isn't done by deadline or commit
+	refuses it: commit is called with a function doing the replacement and
+	returns whether it called it."""
+	tmp = zipFilename + ".tmp"
+	try:
+		with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as archive:
+			for root, dirs, files in os.walk(workingPath):
+				dirs.sort()
+				for name in sorted(files):
+					if deadline is not None and time.time() > deadline:
+						return False
+					path = os.path.join(root, name)
+					archive.write(path, os.path.relpath(path, workingPath))
+		if commit is None:
+			os.replace(tmp, zipFilename)
+			return True
+		return commit(lambda: os.replace(tmp, zipFilename))
+	finally:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+
+def check(zipFilename, workingPath="workingPath", timelimit=600, commit=None):
+	"""Compile the submission in zipFilename in workingPath, replacing the zip
+	with the compiled bot if it compiles. Returns the result as printed by
+	this script.
+
+	timelimit covers the whole check, unpacking and zipping included: past
+	it the zip is left alone and the result is a timeout. commit is passed
+	on to zipFolder."""
+	deadline = time.time() + timelimit
 	# Setup working path
-	workingPath = "workingPath"
 	if os.path.exists(workingPath):
 		shutil.rmtree(workingPath)
 	os.makedirs(workingPath)
 	os.chmod(workingPath, 0o777)
-	unpack(zipFilename, workingPath)
+	try:
+		unpack(zipFilename, workingPath, deadline)
+	except extract.ArchiveTimeout:
+		return {"isError": True, "message": TIMEOUT_MESSAGE}
 
-	language, errors = compile_anything(workingPath)
+	language, errors = compile_anything(workingPath, deadline - time.time())
 	didCompile = True if errors == None else False
-	if didCompile:
-		zipFolder(workingPath, zipFilename)
+	if didCompile and not zipFolder(workingPath, zipFilename, deadline, commit):
+		return {"isError": True, "message": TIMEOUT_MESSAGE}
 	#shutil.rmtree(workingPath)
-	print("ye2")
 	if didCompile:
-		print(json.dumps({"isError": False, "message": "Your bot compiled correctly!", "score": 0}))
+		return {"isError": False, "message": "Your bot compiled correctly!", "score": 0}
 	else:
-		print(json.dumps({"isError": True, "message": "There was an error compiling your bot. Error message: \""+str(errors)+"\""}))
-print(sys.argv[-1])
-compile(sys.argv[-1])
+		return {"isError": True, "message": "There was an error compiling your bot. Error message: \""+str(errors)+"\""}
+
+def compile(zipFilename):
+	print(json.dumps(check(zipFilename)))
+
+if __name__ == "__main__":
+	print(sys.argv[-1])
+	compile(sys.argv[-1])
@@ -0,0 +1,164 @@
+"""A long-running compile service: check.py without paying interpreter and
+import start-up per check, and without two checks sharing one directory.
+
+    python3 compile_server.py [--socket compile.sock] [--workers 4]
+                              [--queue 16] [--timeout 600] [--jobs-dir compileJobs]
+
+Clients connect to the unix socket and send one JSON line per job:
+
+    {"zip": "/path/to/submission.zip"}
+
+Each job is answered with one line in check.py's format, {"isError": ...,
+"message": ...}, and like check.py a submission that compiles has its zip
+replaced with the compiled bot. Jobs run in their own directory under
+--jobs-dir, which is removed afterwards.
+
+At most --workers jobs compile at once and at most --queue more wait for a
+worker; a job beyond that is refused straight away with a busy error, so
+clients can back off instead of piling up. A job has --timeout seconds from
+when it arrived: it starts with whatever is left of that time as check.py's
+limit for unpacking, compiling and zipping together, and a job that runs
+past it gets a timeout error and leaves the zip as it was.
+"""
+import json
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from optparse import OptionParser
+
+import check
+
+# extra time past a job's deadline for it to notice and stop, before the
+# client is answered without it
+GRACE_TIME = 30
+
+def _error(message):
+	return {"isError": True, "message": message}
+
+class _Job:
+	"""A job's deadline, and the lock that makes sure it either replaces the
+	zip in time or its client is told it timed out, never both."""
+
+	def __init__(self, deadline):
+		self.deadline = deadline
+		self._lock = threading.Lock()
+		self._state = None
+
+	def commit(self, replace):
+		"""check.zipFolder's commit: replace the zip unless it's too late."""
+		with self._lock:
+			if self._state is not None or time.time() > self.deadline:
+				return False
+			replace()
+			self._state = "committed"
+			return True
+
+	def cancel(self):
+		"""Stop the job from replacing the zip. False if it already has."""
+		with self._lock:
+			if self._state is None:
+				self._state = "cancelled"
+			return self._state == "cancelled"
+
+class CompileService:
+
+	def __init__(self, jobs_dir, workers=4, queue_size=16, timeout=600):
+		self.jobs_dir = os.path.abspath(jobs_dir)
+		self.timeout = timeout
+		os.makedirs(self.jobs_dir, exist_ok=True)
+		for name in os.listdir(self.jobs_dir):
+			# left behind by a server that was stopped mid-job
+			shutil.rmtree(os.path.join(self.jobs_dir, name), ignore_errors=True)
+		self._pool = ThreadPoolExecutor(max_workers=workers)
+		# a slot for every job running or waiting
+		self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+	def run(self, zip_path):
+		"""Compile one submission and return its result."""
+		if not isinstance(zip_path, str) or not os.path.isfile(zip_path):
+			return _error("No submission zip at " + repr(zip_path) + ".")
+		if not self._slots.acquire(blocking=False):
+			return _error("The compile server is busy, please try again later.")
+		job = _Job(time.time() + self.timeout)
+		try:
+			future = self._pool.submit(self._job, os.path.abspath(zip_path), job)
+		except Exception:
+			self._slots.release()
+			raise
+		future.add_done_callback(lambda f: self._slots.release())
+		try:
+			try:
+				return future.result(timeout=max(0, job.deadline - time.time()) + GRACE_TIME)
+			except TimeoutError:
+				future.cancel()
+				if job.cancel():
+					return _error(check.TIMEOUT_MESSAGE)
+				# it replaced the zip just as we gave up: it's about done
+				return future.result()
+		except Exception as e:
+			return _error("The compile server failed: " + str(e))
+
+	def _job(self, zip_path, job):
+		remaining = job.deadline - time.time()
+		if remaining <= 0:
+			return _error(check.TIMEOUT_MESSAGE)
+		job_dir = tempfile.mkdtemp(prefix="job-", dir=self.jobs_dir)
+		try:
+			return check.check(zip_path, os.path.join(job_dir, "bot"), remaining, job.commit)
+		finally:
+			shutil.rmtree(job_dir, ignore_errors=True)
+
+	def shutdown(self):
+		self._pool.shutdown(wait=True)
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+def _handler(service):
+	class Handler(socketserver.StreamRequestHandler):
+		def handle(self):
+			for line in self.rfile:
+				try:
+					request = json.loads(line.decode())
+					result = service.run(request.get("zip"))
+				except (ValueError, AttributeError):
+					result = _error("Bad request: " + line.decode(errors="replace").strip())
+				self.wfile.write(json.dumps(result).encode() + b"\n")
+				self.wfile.flush()
+	return Handler
+
+def serve(service, socket_path):
+	if os.path.exists(socket_path):
+		os.remove(socket_path)
+	server = _Server(socket_path, _handler(service))
+	os.chmod(socket_path, 0o660)
+	return server
+
+def main():
+	parser = OptionParser(usage="Usage: %prog [options]")
+	parser.add_option("--socket", default="compile.sock")
+	parser.add_option("--workers", type="int", default=os.cpu_count() or 1)
+	parser.add_option("--queue", type="int", default=16,
+					  help="jobs allowed to wait for a worker before new ones are refused")
+	parser.add_option("--timeout", type="float", default=600)
+	parser.add_option("--jobs-dir", default="compileJobs")
+	options, _ = parser.parse_args()
+
+	service = CompileService(options.jobs_dir, options.workers, options.queue, options.timeout)
+	server = serve(service, options.socket)
+	print("Compile server listening on " + options.socket)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		service.shutdown()
+		os.remove(options.socket)
+
+if __name__ == "__main__":
+	main()
@@ -9,15 +9,26 @@ import shutil
 import subprocess
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from optparse import OptionParser
 
 from sandbox import get_sandbox
+from buildcache import BuildCache, snapshot, changes
 
 try:
 	from server_info import server_info
 	MEMORY_LIMIT = server_info.get('memory_limit', 1500)
+	BUILD_CACHE_DIR = server_info.get('build_cache_dir')
+	BUILD_CACHE_BYTES = server_info.get('build_cache_bytes', 2 * 1024**3)
+	COMPILE_WORKERS = server_info.get('compile_workers', os.cpu_count() or 1)
 except ImportError:
 	MEMORY_LIMIT = 1500
+	BUILD_CACHE_DIR = None
+	BUILD_CACHE_BYTES = 2 * 1024**3
+	COMPILE_WORKERS = os.cpu_count() or 1
+
+# used by compile_anything when it isn't given a cache; None disables caching
+build_cache = BuildCache(BUILD_CACHE_DIR, BUILD_CACHE_BYTES) if BUILD_CACHE_DIR else None
 
 BOT = "Battle"
 SAFEPATH = re.compile('[a-zA-Z0-9_.$-]+$')
@@ -34,27 +45,32 @@ class CD(object):
 	def __exit__(self, type, value, traceback):
 		os.chdir(self.org_dir)
 
-def safeglob(pattern):
+# The glob helpers take the directory to search instead of relying on the
+# current directory, so several submissions can compile at once in one
+# process (see compile_server.py). Paths are returned relative to it.
+def safeglob(pattern, base="."):
 	safepaths = []
-	for root, dirs, files in os.walk("."):
+	for root, dirs, files in os.walk(base):
+		rel = os.path.relpath(root, base)
+		root = "." if rel == "." else os.path.join(".", rel)
 		files = fnmatch.filter(files, pattern)
 		for fname in files:
 			if SAFEPATH.match(fname):
 				safepaths.append(os.path.join(root, fname))
 	return safepaths
 
-def safeglob_multi(patterns):
+def safeglob_multi(patterns, base="."):
 	safepaths = []
 	for pattern in patterns:
-		safepaths.extend(safeglob(pattern))
+		safepaths.extend(safeglob(pattern, base))
 	return safepaths
 
-def nukeglob(pattern):
-	paths = safeglob(pattern)
+def nukeglob(pattern, base="."):
+	paths = safeglob(pattern, base)
 	for path in paths:
 		# Ought to be all files, not folders
 		try:
-			os.unlink(path)
+			os.unlink(os.path.join(base, path))
 		except OSError as e:
 			if e.errno != errno.ENOENT:
 				raise
@@ -86,6 +102,36 @@ def _run_cmd(sandbox, cmd, timelimit):
 		err_line = sandbox.read_error()
 	return out, errors
 
+def _run_steps(steps, workers):
+	"""Run independent compile steps, each a function returning its list of
+	errors, on up to workers threads. Returns the errors of the first step,
+	in the order given, that failed, as running them one at a time would;
+	steps after a failed one are cancelled if they haven't started."""
+	if workers <= 1 or len(steps) <= 1:
+		for step in steps:
+			step_errors = step()
+			if step_errors:
+				return step_errors
+		return []
+	with ThreadPoolExecutor(max_workers=min(workers, len(steps))) as pool:
+		futures = [pool.submit(step) for step in steps]
+		index = dict((future, i) for i, future in enumerate(futures))
+		first_failed = len(steps)
+		for future in as_completed(futures):
+			if future.cancelled() or future.exception() is not None:
+				continue
+			if future.result() and index[future] < first_failed:
+				first_failed = index[future]
+				for later in futures[first_failed+1:]:
+					later.cancel()
+	for future in futures:
+		if future.cancelled():
+			continue
+		step_errors = future.result()
+		if step_errors:
+			return step_errors
+	return []
+
 def check_path(path, errors):
 	if not os.path.exists(path):
 		errors.append("Output file " + str(os.path.basename(path)) + " was not created.")
@@ -94,7 +140,7 @@ def check_path(path, errors):
 		return True
 
 class Compiler:
-	def compile(self, globs, errors):
+	def compile(self, bot_dir, globs, errors, timelimit, cache=None):
 		raise NotImplementedError
 
 class ChmodCompiler(Compiler):
@@ -104,13 +150,12 @@ class ChmodCompiler(Compiler):
 	def __str__(self):
 		return "ChmodCompiler: %s" % (self.language,)
 
-	def compile(self, bot_dir, globs, errors, timelimit):
-		with CD(bot_dir):
-			for f in safeglob_multi(globs):
-				try:
-					os.chmod(f, 0o644)
-				except Exception as e:
-					errors.append("Error chmoding %s - %s\n" % (f, e))
+	def compile(self, bot_dir, globs, errors, timelimit, cache=None):
+		for f in safeglob_multi(globs, bot_dir):
+			try:
+				os.chmod(os.path.join(bot_dir, f), 0o644)
+			except Exception as e:
+				errors.append("Error chmoding %s - %s\n" % (f, e))
 		return True
 
 class ExternalCompiler(Compiler):
@@ -133,44 +178,80 @@ class ExternalCompiler(Compiler):
 	def __str__(self):
 		return "ExternalCompiler: %s" % (' '.join(self.args),)
 
-	def compile(self, bot_dir, globs, errors, timelimit):
-		with CD(bot_dir):
-			files = safeglob_multi(globs)
-
-		box = get_sandbox(bot_dir)
+	def outputs(self, filename):
+		"""The files one separate invocation on filename should produce, or
+		None if they aren't declared."""
+		if not self.out_files and not self.out_ext:
+			return None
+		outputs = list(self.out_files)
+		if self.out_ext:
+			outputs.append(os.path.splitext(filename)[0] + self.out_ext)
+		return outputs
+
+	def compile_file(self, bot_dir, filename, timelimit, cache, before):
+		"""One separate invocation, in its own sandbox. Returns its errors."""
+		outputs = self.outputs(filename)
+		if cache is not None:
+			key = cache.object_key(self.args, filename, before, outputs is not None)
+			if cache.restore_object(key, bot_dir):
+				return []
+			invocation_before = snapshot(bot_dir) if outputs is None else None
+		cmdline = " ".join(self.args + [filename])
+		if time.time() > timelimit:
+			return ["Compilation timed out with command %s" % (cmdline,)]
+		box = get_sandbox(bot_dir, read_output=True)
 		try:
-			if self.separate:
-				for filename in files:
-					cmdline = " ".join(self.args + [filename])
-					cmd_out, cmd_errors = _run_cmd(box, cmdline, timelimit)
-					cmd_errors = self.cmd_error_filter(cmd_out, cmd_errors);
-					if not cmd_errors:
-						for ofile in self.out_files:
-							box.check_path(ofile, cmd_errors)
-						if self.out_ext:
-							oname = os.path.splitext(filename)[0] + self.out_ext
-							box.check_path(oname, cmd_errors)
-						if cmd_errors:
-							cmd_errors += cmd_out
-					if cmd_errors:
-						errors += cmd_errors
-						return False
-			else:
-				cmdline = " ".join(self.args + files)
-				cmd_out, cmd_errors = _run_cmd(box, cmdline, timelimit)
-				cmd_errors = self.cmd_error_filter(cmd_out, cmd_errors);
-				if not cmd_errors:
-					for ofile in self.out_files:
-						box.check_path(ofile, cmd_errors)
-					if self.out_ext:
-						for filename in files:
-							oname = os.path.splitext(filename)[0] + self.out_ext
-							box.check_path(oname, cmd_errors)
-					if cmd_errors:
-						cmd_errors += cmd_out
+			cmd_out, cmd_errors = _run_cmd(box, cmdline, timelimit)
+			cmd_errors = self.cmd_error_filter(cmd_out, cmd_errors);
+			if not cmd_errors:
+				for ofile in self.out_files:
+					box.check_path(ofile, cmd_errors)
+				if self.out_ext:
+					oname = os.path.splitext(filename)[0] + self.out_ext
+					box.check_path(oname, cmd_errors)
+				if cmd_errors:
+					cmd_errors += cmd_out
+			if cmd_errors:
+				return cmd_errors
+			box.retrieve()
+		finally:
+			box.release()
+		if cache is not None:
+			if outputs is None:
+				outputs = changes(invocation_before, snapshot(bot_dir))[0]
+			cache.store_object(key, bot_dir, outputs)
+		return []
+
+	def compile(self, bot_dir, globs, errors, timelimit, cache=None):
+		files = safeglob_multi(globs, bot_dir)
+
+		if self.separate:
+			# invocations that don't declare their outputs may write anywhere
+			# in the tree, so only ones that do run side by side
+			workers = COMPILE_WORKERS if self.outputs("") is not None else 1
+			before = snapshot(bot_dir) if cache is not None else None
+			step_errors = _run_steps([lambda filename=filename: self.compile_file(bot_dir, filename, timelimit, cache, before)
+									  for filename in files], workers)
+			errors += step_errors
+			return not step_errors
+
+		box = get_sandbox(bot_dir, read_output=True)
+		try:
+			cmdline = " ".join(self.args + files)
+			cmd_out, cmd_errors = _run_cmd(box, cmdline, timelimit)
+			cmd_errors = self.cmd_error_filter(cmd_out, cmd_errors);
+			if not cmd_errors:
+				for ofile in self.out_files:
+					box.check_path(ofile, cmd_errors)
+				if self.out_ext:
+					for filename in files:
+						oname = os.path.splitext(filename)[0] + self.out_ext
+						box.check_path(oname, cmd_errors)
 				if cmd_errors:
-					errors += cmd_errors
-					return False
+					cmd_errors += cmd_out
+			if cmd_errors:
+				errors += cmd_errors
+				return False
 			box.retrieve()
 		finally:
 			box.release()
@@ -238,28 +319,40 @@ class TargetCompiler(Compiler):
 	def __str__(self):
 		return "TargetCompiler: %s" % (' '.join(self.args),)
 
-	def compile(self, bot_dir, globs, errors, timelimit):
-		with CD(bot_dir):
-			sources = safeglob_multi(globs)
-
-		box = get_sandbox(bot_dir)
+	def compile_file(self, bot_dir, source, timelimit, cache, before):
+		"""Compile one source to its target, in its own sandbox. Returns its
+		errors."""
+		head, ext = os.path.splitext(source)
+		if ext not in self.replacements:
+			return ["Could not determine target for source file %s." % source]
+		target = head + self.replacements[ext]
+		if cache is not None:
+			key = cache.object_key(self.args + [self.outflag, target], source, before)
+			if cache.restore_object(key, bot_dir):
+				return []
+		cmdline = " ".join(self.args + [self.outflag, target, source])
+		if time.time() > timelimit:
+			return ["Compilation timed out with command %s" % (cmdline,)]
+		box = get_sandbox(bot_dir, read_output=True)
 		try:
-			for source in sources:
-				head, ext = os.path.splitext(source)
-				if ext in self.replacements:
-					target = head + self.replacements[ext]
-				else:
-					errors.append("Could not determine target for source file %s." % source)
-					return False
-				cmdline = " ".join(self.args + [self.outflag, target, source])
-				cmd_out, cmd_errors = _run_cmd(box, cmdline, timelimit)
-				if cmd_errors:
-					errors += cmd_errors
-					return False
+			cmd_out, cmd_errors = _run_cmd(box, cmdline, timelimit)
+			if cmd_errors:
+				return cmd_errors
 			box.retrieve()
 		finally:
 			box.release()
-		return True
+		if cache is not None:
+			cache.store_object(key, bot_dir, [target])
+		return []
+
+	def compile(self, bot_dir, globs, errors, timelimit, cache=None):
+		sources = safeglob_multi(globs, bot_dir)
+
+		before = snapshot(bot_dir) if cache is not None else None
+		step_errors = _run_steps([lambda source=source: self.compile_file(bot_dir, source, timelimit, cache, before)
+								  for source in sources], COMPILE_WORKERS)
+		errors += step_errors
+		return not step_errors
 
 PYTHON_EXT_COMPILER = '''"from distutils.core import setup
 from distutils.extension import read_setup_file
@@ -492,19 +585,20 @@ languages = (
 )
 
 
-def compile_function(language, bot_dir, timelimit):
-	"""Compile submission in the current directory with a specified language."""
-	with CD(bot_dir):
-		print("cd")
-		for glob in language.nukeglobs:
-			print("nuke")
-			nukeglob(glob)
+def compile_function(language, bot_dir, timelimit, cache=None):
+	"""Compile submission in the current directory with a specified language.
+
+	With a BuildCache, compilers that run once per source file reuse the
+	objects of files they've compiled before."""
+	for glob in language.nukeglobs:
+		print("nuke")
+		nukeglob(glob, bot_dir)
 
 	errors = []
 	stop_time = time.time() + timelimit
 	for globs, compiler in language.compilers:
 		try:
-			if not compiler.compile(bot_dir, globs, errors, stop_time):
+			if not compiler.compile(bot_dir, globs, errors, stop_time, cache):
 				return False, errors
 		except Exception as exc:
 			raise
@@ -522,50 +616,66 @@ Please add one of the following filenames to your zip file:
 
 def detect_language(bot_dir):
 	"""Try and detect what language a submission is using"""
-	with CD(bot_dir):
-		# Autodetects the language of the entry in the current working directory
-		detected_langs = [
-			lang for lang in languages if os.path.exists(lang.main_code_file)
-		]
-
-		# If no language was detected
-		if len(detected_langs) > 1:
-			return None, ['Found multiple Battle.* files: \n'+
-						  '\n'.join([l.main_code_file for l in detected_langs])]
-		elif len(detected_langs) == 0:
-			return None, [_LANG_NOT_FOUND % (
-				'\n'.join(l.name +": "+ l.main_code_file for l in languages),)]
-		else:
-			return detected_langs[0], None
+	# Autodetects the language of the entry in bot_dir
+	detected_langs = [
+		lang for lang in languages if os.path.exists(os.path.join(bot_dir, lang.main_code_file))
+	]
+
+	# If no language was detected
+	if len(detected_langs) > 1:
+		return None, ['Found multiple Battle.* files: \n'+
+					  '\n'.join([l.main_code_file for l in detected_langs])]
+	elif len(detected_langs) == 0:
+		return None, [_LANG_NOT_FOUND % (
+			'\n'.join(l.name +": "+ l.main_code_file for l in languages),)]
+	else:
+		return detected_langs[0], None
 
 def get_run_cmd(submission_dir):
 	"""Get the command to run a submission"""
-	with CD(submission_dir):
-		if os.path.exists('run.sh'):
-			with open('run.sh') as f:
-				for line in f:
-					if line[0] != '#':
-						return line.rstrip('\r\n')
+	run_sh = os.path.join(submission_dir, 'run.sh')
+	if os.path.exists(run_sh):
+		with open(run_sh) as f:
+			for line in f:
+				if line[0] != '#':
+					return line.rstrip('\r\n')
 
 def get_run_lang(submission_dir):
 	"""Get the language of a submission"""
-	with CD(submission_dir):
-		if os.path.exists('run.sh'):
-			with open('run.sh') as f:
-				for line in f:
-					if line[0] == '#':
-						return line[1:-1]
-
-def compile_anything(bot_dir, timelimit=600, max_error_len = 3072):
-	"""Autodetect the language of an entry and compile it."""
+	run_sh = os.path.join(submission_dir, 'run.sh')
+	if os.path.exists(run_sh):
+		with open(run_sh) as f:
+			for line in f:
+				if line[0] == '#':
+					return line[1:-1]
+
+def build_args(language):
+	"""Everything besides the sources that a language's build depends on."""
+	return [language.command, language.nukeglobs,
+			[(globs, str(compiler)) for globs, compiler in language.compilers],
+			comp_args.get(language.name)]
+
+def compile_anything(bot_dir, timelimit=600, max_error_len = 3072, cache=None):
+	"""Autodetect the language of an entry and compile it.
+
+	cache (default: the module's build_cache) is a BuildCache: a source tree
+	it has seen compile before is restored from it, run.sh included."""
+	if cache is None:
+		cache = build_cache
 	detected_language, errors = detect_language(bot_dir)
 	print("detected language")
 	if detected_language:
 		# If we get this far, then we have successfully auto-detected
 		# the language that this entry is using.
+		if cache is not None:
+			before = snapshot(bot_dir)
+			tree_key = cache.tree_key(before, detected_language.name, build_args(detected_language))
+			if cache.restore_tree(tree_key, bot_dir):
+				print("restored from build cache")
+				return detected_language.name, None
 		print("compiling")
 		compiled, errors = compile_function(detected_language, bot_dir,
-				timelimit)
+				timelimit, cache)
 		print("done compiling")
 		if compiled:
 			name = detected_language.name
@@ -583,6 +693,9 @@ def compile_anything(bot_dir, timelimit=600, max_error_len = 3072):
 			except Exception as e:
 				print("error")
 				print(e.strerror)
+			else:
+				if cache is not None:
+					cache.store_tree(tree_key, bot_dir, before, snapshot(bot_dir))
 			return name, None
 		else:
 			# limit length of reported errors
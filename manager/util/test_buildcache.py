@@ -0,0 +1,221 @@
+"""Tests for the build cache, and for compile_file using it.
+
+	python -m pytest manager/util/test_buildcache.py
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+# compiler imports sandbox from the manager directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import buildcache
+import compiler
+from buildcache import BuildCache, snapshot
+
+def _write(bot_dir, files):
+	for path, body in files.items():
+		path = os.path.join(bot_dir, path)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "w") as f:
+			f.write(body)
+
+def _read(path):
+	with open(path) as f:
+		return f.read()
+
+class CacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.root = os.path.join(self.dir, "cache")
+		self.bot = os.path.join(self.dir, "bot")
+		os.makedirs(self.bot)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir, ignore_errors=True)
+
+	def fresh_bot(self, files):
+		shutil.rmtree(self.bot)
+		os.makedirs(self.bot)
+		_write(self.bot, files)
+
+class TestTrees(CacheTest):
+
+	SOURCES = {"Battle.c": "int main() {}\n", "util.h": "#define X 1\n", "old.o": "stale"}
+
+	def compile(self, cache, key):
+		"""Stand in for a build: add run.sh and a binary, delete old.o."""
+		before = snapshot(self.bot)
+		_write(self.bot, {"run.sh": "#C\n./Battle\n", "Battle": "binary"})
+		os.remove(os.path.join(self.bot, "old.o"))
+		cache.store_tree(key, self.bot, before, snapshot(self.bot))
+
+	def test_hit_restores_the_build(self):
+		cache = BuildCache(self.root, 1 << 30)
+		_write(self.bot, self.SOURCES)
+		key = cache.tree_key(snapshot(self.bot), "C", ["gcc"])
+		self.assertFalse(cache.restore_tree(key, self.bot))
+		self.compile(cache, key)
+		built = snapshot(self.bot)
+
+		self.fresh_bot(self.SOURCES)
+		self.assertEqual(cache.tree_key(snapshot(self.bot), "C", ["gcc"]), key)
+		self.assertTrue(cache.restore_tree(key, self.bot))
+		self.assertEqual(snapshot(self.bot), built)
+		self.assertFalse(os.path.exists(os.path.join(self.bot, "old.o")))
+		self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+		# a restarted cache still has it
+		self.fresh_bot(self.SOURCES)
+		cache = BuildCache(self.root, 1 << 30)
+		self.assertTrue(cache.restore_tree(key, self.bot))
+
+	def test_key_changes_with_inputs(self):
+		cache = BuildCache(self.root, 1 << 30)
+		_write(self.bot, self.SOURCES)
+		before = snapshot(self.bot)
+		key = cache.tree_key(before, "C", ["gcc"])
+		self.assertNotEqual(cache.tree_key(before, "C++", ["gcc"]), key)
+		self.assertNotEqual(cache.tree_key(before, "C", ["gcc", "-O2"]), key)
+		for change in [{"Battle.c": "int main() { return 1; }\n"}, {"notes.txt": "new file"}]:
+			self.fresh_bot(self.SOURCES)
+			_write(self.bot, change)
+			self.assertNotEqual(cache.tree_key(snapshot(self.bot), "C", ["gcc"]), key)
+		self.fresh_bot(self.SOURCES)
+		os.chmod(os.path.join(self.bot, "Battle.c"), 0o755)
+		self.assertNotEqual(cache.tree_key(snapshot(self.bot), "C", ["gcc"]), key)
+
+	def test_evicts_least_recently_used(self):
+		cache = BuildCache(self.root, 25000)
+		keys = []
+		for index in range(3):
+			self.fresh_bot({"Battle.c": str(index)})
+			before = snapshot(self.bot)
+			keys.append(cache.tree_key(before, "C", []))
+			_write(self.bot, {"Battle": "x" * 10000})
+			cache.store_tree(keys[-1], self.bot, before, snapshot(self.bot))
+			if index == 1:
+				# use the first again, so the second is the oldest
+				time.sleep(0.01)
+				self.assertTrue(cache.restore_tree(keys[0], self.bot))
+				time.sleep(0.01)
+		present = [os.path.isdir(os.path.join(self.root, "trees", key)) for key in keys]
+		self.assertEqual(present, [True, False, True])
+
+	def test_evicted_during_restore(self):
+		cache = BuildCache(self.root, 1 << 30)
+		_write(self.bot, self.SOURCES)
+		key = cache.tree_key(snapshot(self.bot), "C", [])
+		self.compile(cache, key)
+		# the manifest was read just before eviction removed the files
+		shutil.rmtree(os.path.join(self.root, "trees", key, "files"))
+		self.fresh_bot(self.SOURCES)
+		self.assertFalse(cache.restore_tree(key, self.bot))
+		self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+class TestObjects(CacheTest):
+
+	def test_key_depends_on_source_and_headers(self):
+		cache = BuildCache(self.root, 1 << 30)
+		_write(self.bot, {"a.c": "a", "b.c": "b", "x.h": "x", "README": "r"})
+		key = lambda: cache.object_key(["gcc", "-c"], "a.c", snapshot(self.bot))
+		original = key()
+		_write(self.bot, {"b.c": "b2", "README": "r2"})
+		self.assertEqual(key(), original)
+		_write(self.bot, {"a.c": "a2"})
+		changed_source = key()
+		self.assertNotEqual(changed_source, original)
+		_write(self.bot, {"x.h": "x2"})
+		self.assertNotEqual(key(), changed_source)
+		self.assertNotEqual(cache.object_key(["gcc", "-c", "-O2"], "a.c", snapshot(self.bot)), key())
+
+	def test_undeclared_outputs_depend_on_everything(self):
+		cache = BuildCache(self.root, 1 << 30)
+		_write(self.bot, {"a.c": "a", "README": "r"})
+		original = cache.object_key(["cc"], "a.c", snapshot(self.bot), outputs_known=False)
+		_write(self.bot, {"README": "r2"})
+		self.assertNotEqual(cache.object_key(["cc"], "a.c", snapshot(self.bot), outputs_known=False), original)
+
+	def test_store_and_restore(self):
+		cache = BuildCache(self.root, 1 << 30)
+		_write(self.bot, {"a.c": "a", "a.o": "object"})
+		key = cache.object_key(["gcc", "-c"], "a.c", snapshot(self.bot))
+		cache.store_object(key, self.bot, ["./a.o"])
+		self.fresh_bot({"a.c": "a"})
+		self.assertTrue(cache.restore_object(key, self.bot))
+		self.assertEqual(_read(os.path.join(self.bot, "a.o")), "object")
+
+class FakeBox:
+	"""What compile_file needs of a sandbox; the command is run by
+	fake_run_cmd on the host."""
+
+	def __init__(self, bot_dir, read_output=False):
+		self.working_directory = bot_dir
+
+	def check_path(self, path, errors):
+		if not os.path.exists(os.path.join(self.working_directory, path)):
+			errors.append("Output file " + path + " was not created.")
+
+	def retrieve(self):
+		pass
+
+	def release(self):
+		pass
+
+class TestCompileFile(CacheTest):
+
+	def setUp(self):
+		CacheTest.setUp(self)
+		self.commands = []
+		for patch in [mock.patch.object(compiler, "get_sandbox", FakeBox),
+					  mock.patch.object(compiler, "_run_cmd", self.fake_run_cmd)]:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def fake_run_cmd(self, box, cmd, timelimit):
+		self.commands.append(cmd)
+		result = subprocess.run(cmd, shell=True, cwd=box.working_directory,
+								stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+		return result.stdout.splitlines(), result.stderr.splitlines()
+
+	def compile(self, cache, files):
+		# "compiles" x.c to x.o by copying it, given x.o x.c like cc -o
+		target = compiler.TargetCompiler(["sh", "-c", "'cp \"$2\" \"$1\"'", "sh"], {".c": ".o"}, outflag="")
+		errors = []
+		ok = target.compile(self.bot, [files], errors, time.time() + 60, cache)
+		return ok, errors
+
+	def test_cached_objects(self):
+		cache = BuildCache(self.root, 1 << 30)
+		_write(self.bot, {"a.c": "a", "b.c": "b"})
+		self.assertEqual(self.compile(cache, "*.c"), (True, []))
+		self.assertEqual(len(self.commands), 2)
+		self.assertEqual(_read(os.path.join(self.bot, "a.o")), "a")
+
+		# only the changed file is compiled again
+		self.fresh_bot({"a.c": "a", "b.c": "b2"})
+		self.assertEqual(self.compile(cache, "*.c"), (True, []))
+		self.assertEqual(len(self.commands), 3)
+		self.assertIn("b.c", self.commands[-1])
+		self.assertEqual(_read(os.path.join(self.bot, "a.o")), "a")
+		self.assertEqual(_read(os.path.join(self.bot, "b.o")), "b2")
+
+	def test_object_evicted_during_restore(self):
+		cache = BuildCache(self.root, 1 << 30)
+		_write(self.bot, {"a.c": "a"})
+		self.compile(cache, "*.c")
+		for name in os.listdir(os.path.join(self.root, "objects")):
+			shutil.rmtree(os.path.join(self.root, "objects", name, "files"))
+		self.fresh_bot({"a.c": "a"})
+		self.assertEqual(self.compile(cache, "*.c"), (True, []))
+		self.assertEqual(len(self.commands), 2)
+		self.assertEqual(_read(os.path.join(self.bot, "a.o")), "a")
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,139 @@
+"""Tests for the compile server, with compiling stubbed out.
+
+	python -m pytest manager/util/test_compile_server.py
+"""
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from unittest import mock
+
+# compiler imports sandbox from the manager directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import check
+import compile_server
+
+class TestCompileServer(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.zip = os.path.join(self.dir, "bot.zip")
+		with zipfile.ZipFile(self.zip, "w") as archive:
+			archive.writestr("Battle.py", "print('hi')\n")
+		with open(self.zip, "rb") as f:
+			self.original = f.read()
+		# compiling waits for this, once started is set; with honour_limit
+		# only until its time limit, as the real compile does
+		self.started = threading.Event()
+		self.proceed = threading.Event()
+		self.honour_limit = False
+		for patch in [mock.patch.object(check, "compile_anything", self.fake_compile),
+					  mock.patch.object(compile_server, "GRACE_TIME", 0.2)]:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def tearDown(self):
+		self.proceed.set()
+		shutil.rmtree(self.dir, ignore_errors=True)
+
+	def fake_compile(self, bot_dir, timelimit):
+		self.started.set()
+		self.proceed.wait(min(timelimit, 30) if self.honour_limit else 30)
+		with open(os.path.join(bot_dir, "run.sh"), "w") as f:
+			f.write("#Python\npython3 Battle.py\n")
+		return "Python", None
+
+	def service(self, **options):
+		service = compile_server.CompileService(os.path.join(self.dir, "jobs"), **options)
+		self.addCleanup(service.shutdown)
+		self.addCleanup(self.proceed.set)
+		return service
+
+	def run_in_background(self, service):
+		results = []
+		thread = threading.Thread(target=lambda: results.append(service.run(self.zip)))
+		thread.daemon = True
+		thread.start()
+		return thread, results
+
+	def request(self, sock, zip_path):
+		sock.sendall(json.dumps({"zip": zip_path}).encode() + b"\n")
+		return json.loads(sock.makefile("rb").readline().decode())
+
+	def test_compiles(self):
+		self.proceed.set()
+		result = self.service(workers=1, queue_size=0).run(self.zip)
+		self.assertFalse(result["isError"], result)
+		with zipfile.ZipFile(self.zip) as archive:
+			self.assertIn("run.sh", archive.namelist())
+		self.assertEqual(os.listdir(os.path.join(self.dir, "jobs")), [])
+
+	def test_busy(self):
+		service = self.service(workers=1, queue_size=1)
+		server = compile_server.serve(service, os.path.join(self.dir, "compile.sock"))
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		self.addCleanup(server.server_close)
+		self.addCleanup(server.shutdown)
+
+		running, _ = self.run_in_background(service)
+		self.assertTrue(self.started.wait(10))
+		waiting, _ = self.run_in_background(service)
+		time.sleep(0.1)
+		# one job running and one waiting use up the worker and the queue
+		sock = socket.socket(socket.AF_UNIX)
+		sock.connect(os.path.join(self.dir, "compile.sock"))
+		with sock:
+			result = self.request(sock, self.zip)
+			self.assertTrue(result["isError"])
+			self.assertIn("busy", result["message"])
+
+			self.proceed.set()
+			running.join(10)
+			waiting.join(10)
+			self.assertFalse(self.request(sock, self.zip)["isError"])
+
+	def test_timeout_frees_the_worker(self):
+		self.honour_limit = True
+		service = self.service(workers=1, queue_size=0, timeout=0.3)
+		started = time.time()
+		thread, results = self.run_in_background(service)
+		thread.join(10)
+		self.assertEqual(results, [{"isError": True, "message": check.TIMEOUT_MESSAGE}])
+		self.assertLess(time.time() - started, 5)
+		with open(self.zip, "rb") as f:
+			self.assertEqual(f.read(), self.original)
+
+		# the job stopped at its deadline, so its worker takes the next one
+		self.proceed.set()
+		service.timeout = 30
+		deadline = time.time() + 10
+		result = service.run(self.zip)
+		while "busy" in result["message"] and time.time() < deadline:
+			time.sleep(0.05)
+			result = service.run(self.zip)
+		self.assertFalse(result["isError"], result)
+		with zipfile.ZipFile(self.zip) as archive:
+			self.assertIn("run.sh", archive.namelist())
+
+	def test_overrunning_job_leaves_the_zip(self):
+		# a compile that doesn't stop at its limit gets its client a timeout
+		# once the grace time is up, and can't replace the zip afterwards
+		service = self.service(workers=1, queue_size=0, timeout=0.3)
+		thread, results = self.run_in_background(service)
+		thread.join(10)
+		self.assertEqual(results[0]["message"], check.TIMEOUT_MESSAGE)
+		self.proceed.set()
+		service.shutdown()
+		with open(self.zip, "rb") as f:
+			self.assertEqual(f.read(), self.original)
+		self.assertEqual(os.listdir(os.path.join(self.dir, "jobs")), [])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,75 @@
+"""Tests for running compile steps in parallel.
+
+	python -m pytest manager/util/test_compiler.py
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+
+# compiler imports sandbox from the manager directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from compiler import _run_steps
+
+class TestRunSteps(unittest.TestCase):
+
+	def setUp(self):
+		self.ran = []
+		self.lock = threading.Lock()
+
+	def step(self, name, errors=(), delay=0, wait=None):
+		def run():
+			if wait is not None:
+				wait.wait(5)
+			time.sleep(delay)
+			with self.lock:
+				self.ran.append(name)
+			return list(errors)
+		return run
+
+	def test_all_succeed(self):
+		for workers in (1, 4):
+			self.ran = []
+			self.assertEqual(_run_steps([self.step(i) for i in range(6)], workers), [])
+			self.assertEqual(sorted(self.ran), list(range(6)))
+
+	def test_first_failure_in_order_wins(self):
+		# the second step fails first, but the first step's errors are the
+		# ones running the steps one at a time would report
+		steps = [self.step("slow", ["slow failed"], delay=0.3),
+				 self.step("fast", ["fast failed"]),
+				 self.step("ok")]
+		self.assertEqual(_run_steps(steps, 3), ["slow failed"])
+		self.assertEqual(_run_steps(steps, 1), ["slow failed"])
+
+	def test_later_failure_reported_when_earlier_succeed(self):
+		steps = [self.step("a", delay=0.2), self.step("b", ["b failed"]), self.step("c", ["c failed"], delay=0.1)]
+		self.assertEqual(_run_steps(steps, 3), ["b failed"])
+
+	def test_steps_after_a_failure_are_cancelled(self):
+		# one worker: the failure is seen before any later step starts
+		steps = [self.step(0, ["failed"])] + [self.step(i) for i in range(1, 5)]
+		self.assertEqual(_run_steps(steps, 1), ["failed"])
+		self.assertEqual(self.ran, [0])
+
+		# two workers: the step already running finishes, and the freed
+		# worker may pick up one more before the rest are cancelled
+		self.ran = []
+		release = threading.Event()
+		steps = [self.step(0, ["failed"]), self.step(1, wait=release)] + \
+				[self.step(i, delay=0.1) for i in range(2, 6)]
+		threading.Timer(0.3, release.set).start()
+		self.assertEqual(_run_steps(steps, 2), ["failed"])
+		self.assertEqual(sorted(self.ran)[:2], [0, 1])
+		self.assertLessEqual(len(self.ran), 3)
+
+	def test_exception_propagates(self):
+		def broken():
+			raise RuntimeError("compiler crashed")
+		with self.assertRaises(RuntimeError):
+			_run_steps([self.step("ok"), broken], 2)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -12,7 +12,6 @@ import psycopg2
 import sys
 import random
 import string
-import boto3
 import botocore
 import time
 import requests
@@ -20,20 +19,104 @@ import socket
 import json
 import datetime
 import _thread
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 import config
 import base64
+import matchqueue
+import leases
+import results
+import storage
+import uploads
+import metrics
+import usage
+import forkserver
+from engine import EngineConnection, EnginePool, EngineError
+from artifacts import ArtifactCache
+from db import Database
 
 running_games = []
-sneak = {'ng_id':None,'DB_BEING_USED':False}
+# ids of matches claimed from the queue but not yet in running_games
+claimed_ids = set()
 
-s3 = boto3.resource('s3')
-bucket = s3.Bucket(config.BUCKET_NAME)
+bucket = storage.open_bucket(config)
 
+# at most MAX_GAMES matches (not scrimmages) run at once; up to
+# START_WORKERS of them are being created and having their sandboxes started
+# at the same time
 MAX_GAMES = 16
+START_WORKERS = 4
 INIT_TIME = 60
-
-ELO_K = 20
-ELO_START = 1200
+# a match fails if the engine hasn't created its game after this many seconds
+CREATE_GAME_TIMEOUT = 30
+# how many queued matches to claim at a time, and the longest we wait between
+# looking at the queue when there are no notifications
+CLAIM_BATCH = 1
+QUEUE_POLL_TIME = 1.0
+DB_POOL_SIZE = 4
+
+# identifies this manager in match_leases; leases are renewed every
+# HEARTBEAT_TIME seconds and expire after leases.LEASE_TIME
+NODE_ID = getattr(config, 'NODE_ID', None) or leases.default_node_id()
+# bot containers, working directories and cgroups are tagged with this, and
+# the startup sweep only removes this node's; the default id changes with
+# every restart, so the host name stands in for it. Managers sharing a host
+# need NODE_ID set.
+SANDBOX_NODE = getattr(config, 'NODE_ID', None) or socket.gethostname()
+HEARTBEAT_TIME = leases.LEASE_TIME / 4
+
+# downloaded and extracted submissions are kept here, up to
+# ARTIFACT_CACHE_BYTES; bots in the next PREFETCH_MATCHES queued matches are
+# downloaded in the background
+ARTIFACT_CACHE_DIR = getattr(config, 'ARTIFACT_CACHE_DIR', 'artifactCache')
+ARTIFACT_CACHE_BYTES = getattr(config, 'ARTIFACT_CACHE_BYTES', 5 * 1024**3)
+PREFETCH_MATCHES = 4
+# a submission that unpacks to more than this many bytes or files is refused
+SUBMISSION_MAX_BYTES = getattr(config, 'SUBMISSION_MAX_BYTES', 512 * 1024**2)
+SUBMISSION_MAX_FILES = getattr(config, 'SUBMISSION_MAX_FILES', 10000)
+
+# source_code holds the submission's full S3 URL; the object key follows
+# this many characters of bucket address
+SOURCE_URL_PREFIX = 49
+
+# finished replays are spooled here until they're uploaded; set NODE_ID in
+# config for spooled results to still count after a restart
+REPLAY_SPOOL_DIR = getattr(config, 'REPLAY_SPOOL_DIR', 'replaySpool')
+REPLAY_URL_PREFIX = "https://s3.amazonaws.com/battlehack-private-2018/"
+UPLOAD_WORKERS = 4
+UPLOAD_QUEUE_SIZE = 32
+
+# with ENGINE_PROCESSES > 0 the manager runs that many engines on ports from
+# ENGINE_BASE_PORT up and spreads matches across them; with 0 (the default) it
+# connects to a single engine already listening on ENGINE_BASE_PORT
+ENGINE_PROCESSES = getattr(config, 'ENGINE_PROCESSES', 0)
+ENGINE_COMMAND = getattr(config, 'ENGINE_COMMAND', ['node', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server', 'dist', 'src', 'cli', 'cli.js')])
+ENGINE_BASE_PORT = 6147
+
+# 'docker' runs each bot in a container; 'namespace' runs it on this host in
+# its own namespaces and cgroup (see sandbox.NamespaceSandbox), with no
+# docker daemon needed
+SANDBOX_BACKEND = getattr(config, 'SANDBOX_BACKEND', 'docker')
+# idle bot containers kept started ahead of time (see sandbox.ContainerPool);
+# 0 starts a fresh container for every bot instead. Docker backend only.
+SANDBOX_POOL_SIZE = getattr(config, 'SANDBOX_POOL_SIZE', 2 * MAX_GAMES)
+SANDBOX_POOL_MAX_USES = getattr(config, 'SANDBOX_POOL_MAX_USES', 1)
+# start Python bots from a template that imports their modules while the
+# engine is creating the game, then forks once the game exists (see
+# forkserver.py)
+PYTHON_FORKSERVER = getattr(config, 'PYTHON_FORKSERVER', False)
+# compiler.Language names, as detect_language returns them, of the bots that
+# run under python3 (PyPy bots run under pypy)
+FORKSERVER_LANGUAGES = ("Python3",)
+FORKSERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "forkserver.py")
+# bots' output beyond the last sandbox.LOG_BUFFER_BYTES per stream is kept
+# gzipped here; None drops it
+SANDBOX_LOG_DIR = getattr(config, 'SANDBOX_LOG_DIR', None)
+
+# Prometheus metrics at /metrics and a JSON summary of the last
+# METRICS_WINDOW seconds at /summary, on localhost
+METRICS_PORT = getattr(config, 'METRICS_PORT', 9147)
+METRICS_WINDOW = 600
 
 ascii_header = """
     __          __  __  __     __               __
@@ -49,60 +132,133 @@ print("="*55)
 sys.stdout.write("\033[0;0m")
 print(prefix + "Starting manager...")
 try:
-    conn = psycopg2.connect(config.PG_CRED)
-    c = conn.cursor()
+    database = Database(lambda: psycopg2.connect(config.PG_CRED), size=DB_POOL_SIZE)
+    leases.ensure_schema(database)
+    results.ensure_schema(database)
+    usage.ensure_schema(database)
+    queueWaiter = matchqueue.QueueWaiter(psycopg2.connect(config.PG_CRED))
 except Exception as e:
     print(prefix + "Failed to connect to database. Exiting.")
     sys.exit()
 print(prefix + "Connected to database. Initializing connection to engine...")
 
+artifacts = ArtifactCache(ARTIFACT_CACHE_DIR, bucket, ARTIFACT_CACHE_BYTES,
+                          max_bytes=SUBMISSION_MAX_BYTES, max_files=SUBMISSION_MAX_FILES)
+stats = metrics.Metrics(window=METRICS_WINDOW)
+
+set_log_dir(SANDBOX_LOG_DIR)
+set_node(SANDBOX_NODE)
+WORKING_PATH = os.path.join("workingPath", node_name())
+# remove this node's bot containers, working directories and cgroups left
+# over from a previous run before any new ones exist
+swept = reaper().sweep(os.path.abspath(WORKING_PATH),
+                       labels=(SANDBOX_LABEL, ContainerPool.LABEL) if SANDBOX_BACKEND == 'docker' else ())
+if swept:
+    print(prefix + "Cleaning up " + str(swept) + " sandboxes left from the last run...")
+    reaper().drain()
+sandboxPool = None
+if SANDBOX_BACKEND == 'docker' and SANDBOX_POOL_SIZE > 0:
+    sandboxPool = ContainerPool(os.path.join(WORKING_PATH, "pool"), SANDBOX_POOL_SIZE, max_uses=SANDBOX_POOL_MAX_USES)
+
+match_slots = threading.Semaphore(max(MAX_GAMES,1))
+starter = ThreadPoolExecutor(max_workers=START_WORKERS)
+# guards match['done'] / match['slot'] and game['ended']
+state_lock = threading.Lock()
+
+def sourceKey(source):
+    return source[SOURCE_URL_PREFIX:]
+
 def random_key(length):
     key = ''
     for i in range(length):
         key += random.choice(string.ascii_letters + string.digits + string.digits)
     return key
 
-def unpack(filePath, destinationFilePath):
-    # Extract the archive into a folder call 'bot'
-    command = "tar -xzf " + os.path.abspath(".") + "/" + filePath + " -C "+ os.path.abspath(".") + "/" + destinationFilePath
-    os.system(command)
-
-def runGame(bots):
+def newSandbox():
+    """A sandbox with an empty working directory for one bot."""
+    if sandboxPool is not None:
+        return sandboxPool.acquire()
+    workingPath = os.path.join(WORKING_PATH, random_key(20)) + "/"
+    if os.path.exists(workingPath):
+        shutil.rmtree(workingPath)
+    os.makedirs(workingPath)
+    os.chmod(workingPath, 0o777)
+    return get_sandbox(os.path.abspath(workingPath), backend=SANDBOX_BACKEND, remove_directory=True)
+
+def botLanguage(botPath):
+    """The language compile_anything wrote on the first line of run.sh."""
+    with open(os.path.join(botPath, "run.sh")) as f:
+        line = f.readline()
+    return line[1:].strip() if line.startswith('#') else None
+
+def runGame(bots, gameReady, engine_port):
+    """Unpack both bots and start them. gameReady() waits for the engine to
+    create the game: bots can't log in before that, so only forkserver
+    templates are started before it returns. engine_port is the port of the
+    engine the game is on."""
     print('runGame', bots)
-    # Setup working path
-    workingPathA = "workingPath/" + random_key(20) + "/"
-    if os.path.exists(workingPathA):
-        shutil.rmtree(workingPathA)
-    os.makedirs(workingPathA)
-    os.chmod(workingPathA, 0o777)
-
-    workingPathB = "workingPath/" + random_key(20) + "/"
-    if os.path.exists(workingPathB):
-        shutil.rmtree(workingPathB)
-    os.makedirs(workingPathB)
-    os.chmod(workingPathB, 0o777)
-
-    sandboxes = [Sandbox(os.path.abspath(workingPathA)), Sandbox(os.path.abspath(workingPathB))]
-
-    # Unpack and setup bot files
-    botPaths = [workingPathA,workingPathB]
-
-    for a in range(len(bots)): unpack(bots[a]['path'], botPaths[a])
-    for index, botPath in enumerate(botPaths):
-        if os.path.isfile(os.path.join(botPath, "run.sh")) == False:
-            print('no run.sh for',bots[index])
-            return
-    
-        os.chmod(botPath, 0o777)
-        os.chmod(os.path.join(botPath, "run.sh"), 0o777)
-        
-        print('starting',bots[index])
-        runGameShellCommand = "cd " + os.path.abspath(botPath) + " && chmod +x run.sh && ./run.sh" + " " + bots[index]['key']
-        sandboxes[index].start(runGameShellCommand)
+    sandboxes = [newSandbox(), newSandbox()]
+    try:
+        # Unpack and setup bot files
+        botPaths = [sandbox.working_directory for sandbox in sandboxes]
+
+        with stats.timer('stage_seconds', stage='unpack'):
+            for a in range(len(bots)): artifacts.checkout(bots[a]['source'], botPaths[a])
+        for index, botPath in enumerate(botPaths):
+            if os.path.isfile(os.path.join(botPath, "run.sh")) == False:
+                print('no run.sh for',bots[index])
+                stats.inc('sandbox_failures', reason='no_run_sh')
+                for sandbox in sandboxes:
+                    sandbox.kill()
+                return
+
+            os.chmod(botPath, 0o777)
+            os.chmod(os.path.join(botPath, "run.sh"), 0o777)
+
+        templates = [PYTHON_FORKSERVER and botLanguage(botPath) in FORKSERVER_LANGUAGES for botPath in botPaths]
+        for index, botPath in enumerate(botPaths):
+            if templates[index]:
+                shutil.copy(FORKSERVER_SCRIPT, os.path.join(botPath, ".forkserver.py"))
+                print('starting template for',bots[index])
+                with stats.timer('stage_seconds', stage='sandbox_start'):
+                    sandboxes[index].start("cd " + os.path.abspath(botPath) + " && python3 .forkserver.py Battle.py", engine_port)
+
+        gameReady()
+        for index, botPath in enumerate(botPaths):
+            print('starting',bots[index])
+            if templates[index]:
+                forkserver.write_key(botPath, bots[index]['key'])
+                continue
+            runGameShellCommand = "cd " + os.path.abspath(botPath) + " && chmod +x run.sh && ./run.sh" + " " + bots[index]['key']
+            with stats.timer('stage_seconds', stage='sandbox_start'):
+                sandboxes[index].start(runGameShellCommand, engine_port)
+    except Exception:
+        for sandbox in sandboxes:
+            sandbox.kill()
+        raise
 
     return sandboxes
 
-def endGame(game,sneak):
+def matchDone(match):
+    """Mark a match as over and give back its slot, if it had one."""
+    with state_lock:
+        if match['done']:
+            return
+        match['done'] = True
+        held, match['slot'] = match['slot'], False
+    if held:
+        match_slots.release()
+
+def endOnce(game):
+    """True the first time it's called for a game: matches on different
+    engines can finish on different threads at the same moment."""
+    with state_lock:
+        if game.get('ended'):
+            return False
+        game['ended'] = True
+        return True
+
+def endGame(game):
     winners = []
     replays = []
     for match in game['matches']:
@@ -110,27 +266,32 @@ def endGame(game,sneak):
             if match['sandboxes'] is not None:
                 for sandbox in match['sandboxes']:
                     sandbox.kill()
+                match['usage'] = [sandbox.resource_usage for sandbox in match['sandboxes']]
                 match['sandboxes'] = None
+            matchDone(match)
             winners.append(match['winner'])
             replays.append(match['replay_data'])
-    if len(winners) < len(game['matches']):
+    if len(winners) < len(game['matches']) or not endOnce(game):
         return
 
     for running_game in running_games:
         if game['db_id'] == running_game['db_id']:
             running_games.remove(running_game)
+    for match in game['matches']:
+        engine.unregister(match['ng_id'])
 
-    keys = []
-    for replay in replays:
-        if replay is None:
-            keys.append("none")
-            continue
-        
-        keys.append("replays/" + random_key(20) + ".bch18")
+    # saves uploading replays that would be discarded; the writes below and in
+    # finishGame check the lease again in their own transactions
+    if not leases.owns(database, game['db_id'], NODE_ID):
+        print(prefix+"Game between " + game['teams'][0]['name'] + " and " + game['teams'][1]['name'] + " finished after its lease was lost, discarding the result.")
+        return
 
-        bucket.put_object(Key=keys[-1], Body=base64.b64decode(replay), ACL='public-read')
- 
-        keys[-1] = "https://s3.amazonaws.com/battlehack-private-2018/" + keys[-1]
+    try:
+        usage.record(database, game['db_id'], [(index, team['db_id'], team['submission'], match['usage'][side])
+                                               for index, match in enumerate(game['matches']) if match.get('usage')
+                                               for side, team in enumerate(game['teams'])])
+    except Exception as e:
+        print(prefix + "Failed to record resource usage: " + str(e))
 
     teamA = 0
     teamB = 0
@@ -144,175 +305,255 @@ def endGame(game,sneak):
     winner = 0 if teamA==teamB else 1 if teamA>teamB else 2
     if winner == 0:
         print(prefix+"Game between " + game['teams'][0]['name'] + " and " + game['teams'][1]['name'] + " failed, nobody connected to the engine.")
-        while sneak['DB_BEING_USED']:
-            time.sleep(0.005)
-        sneak['DB_BEING_USED'] = True
-        c.execute("UPDATE scrimmage_matches SET status='failed', finish_time=CURRENT_TIMESTAMP WHERE id=%s", [game['db_id']])
-        conn.commit()
-        sneak['DB_BEING_USED'] = False
+        stats.inc('games_failed', reason='draw')
+        results.record_failure(database, game['db_id'], NODE_ID)
         return
 
-    red_elo = getTeamRating(game['teams'][0]['db_id'],sneak)
-    blue_elo = getTeamRating(game['teams'][1]['db_id'],sneak)
-
-    red_elo += ELO_K * (2-winner - 1/(1+10**((blue_elo-red_elo)/400)))
-    blue_elo += ELO_K * (winner-1 - 1/(1+10**((red_elo-blue_elo)/400)))     
-
-    print(prefix+"Game between " + game['teams'][0]['name'] + " and " + game['teams'][1]['name'] + "completed (" + ("red" if winner==1 else "blue") + " won), new elos: " + str(red_elo) + " and " +str(blue_elo) + ".")
+    # The replays are uploaded in the background and finishGame records the
+    # result once they're all in the bucket; the lease stays held until then.
+    keys = ["replays/" + random_key(20) + ".bch18" for replay in replays]
+    uploader.submit(game['db_id'], replays, keys, {
+        'db_id': game['db_id'], 'node_id': NODE_ID, 'winner': winner, 'winners': winners, 'spooled_at': time.time(),
+        'teams': [{'name': team['name'], 'db_id': team['db_id']} for team in game['teams']]})
+
+def finishGame(meta, keys):
+    """Record a game's result once its replays are uploaded (see uploads.py)."""
+    teams = meta['teams']
+    if 'spooled_at' in meta:
+        stats.observe('stage_seconds', time.time() - meta['spooled_at'], stage='replay_upload')
+    keys = ["none" if key is None else REPLAY_URL_PREFIX + key for key in keys]
+    winner = meta['winner']
+    with stats.timer('stage_seconds', stage='db_commit'):
+        ratings = results.record_result(database, meta['db_id'], teams[0]['db_id'], teams[1]['db_id'], winner, keys, meta['winners'], node_id=meta['node_id'])
+    if ratings is None:
+        print(prefix+"Game between " + teams[0]['name'] + " and " + teams[1]['name'] + " finished after its lease was lost, discarding the result.")
+        return
+    red_elo, blue_elo = ratings
+    stats.inc('games_completed')
 
-    while sneak['DB_BEING_USED']:
-        time.sleep(0.005)
-    sneak['DB_BEING_USED'] = True
-    c.execute("UPDATE scrimmage_matches SET status='completed', match_files=%s, match_winners=%s, red_rating_after=%s, blue_rating_after=%s, finish_time=CURRENT_TIMESTAMP WHERE id=%s", [keys,winners,red_elo,blue_elo,game['db_id']])
-    conn.commit()
-    sneak['DB_BEING_USED'] = False
+    print(prefix+"Game between " + teams[0]['name'] + " and " + teams[1]['name'] + "completed (" + ("red" if winner==1 else "blue") + " won), new elos: " + str(red_elo) + " and " +str(blue_elo) + ".")
 
-def listen(games, socket, sneak):
-    socket = socket.makefile('rwb',2**16)
+def abandonGame(game):
+    for match in game['matches']:
+        matchDone(match)
+        if match['sandboxes'] is not None:
+            for sandbox in match['sandboxes']:
+                sandbox.kill()
+            match['sandboxes'] = None
+        engine.unregister(match['ng_id'])
+    if game in running_games:
+        running_games.remove(game)
+
+def failGame(game, reason):
+    if not endOnce(game):
+        return
+    stats.inc('games_failed', reason=reason)
+    abandonGame(game)
+    results.record_failure(database, game['db_id'], NODE_ID)
+
+def failEngineGames(game_ids):
+    """Fail the games that had a match on an engine that crashed."""
+    lost = set(game_ids)
+    for game in list(running_games):
+        if any(match['ng_id'] in lost for match in game['matches']):
+            print(prefix+"Engine crashed during game between " + game['teams'][0]['name'] + " and " + game['teams'][1]['name'] + ".")
+            failGame(game, 'engine_crash')
+
+def heartbeat():
     while True:
-        message = json.loads(next(socket).decode())
-        print('message:',message['command'])
-        if message['command'] == 'createGameConfirm':
-            sneak['ng_id'] = message['gameID']
-        else:
-            for game in games:
-                for match in game['matches']:
-                    print("match_id: " +match['ng_id'])
-                    if match['ng_id'] == message['id']:
-                        if message['command'] == 'playerConnected':
-                            match['connected'][int(message['team'])-1] = True
-                            print(prefix+game['teams'][int(message['team'])-1]['name'] + " connected in match against " + game['teams'][int(not bool(int(message['team'])-1))]['name'] + ".")
-                        if message['command'] == 'gameReplay':
-                            match['replay_data'] = message['matchData']
-                            match['winner'] = int(message['winner']['teamID'])
-                            print(prefix+"Match between " + game['teams'][0]['name'] + " and " + game['teams'][1]['name'] + " ended (" + ("red" if match['winner']==1 else "blue" if match['winner']==2 else "nobody") + " won).")
-
-                            endGame(game, sneak)
-        time.sleep(0.005)
-
+        time.sleep(HEARTBEAT_TIME)
+        # only the games running now are checked for a lost lease below: a
+        # game claimed after this has a lease that isn't in held
+        games = list(running_games)
+        working = [game['db_id'] for game in games] + list(claimed_ids) + [int(job) for job in uploader.jobs()]
+        try:
+            held = leases.heartbeat(database, NODE_ID, working)
+            for match_id in leases.reclaim_expired(database):
+                print(prefix + "Requeued game " + str(match_id) + " after its lease expired.")
+            # retry uploads that gave up or whose result couldn't be written
+            uploader.recover()
+        except Exception as e:
+            print(prefix + "Lease heartbeat failed: " + str(e))
+            continue
+        for game in games:
+            if game['db_id'] not in held and endOnce(game):
+                print(prefix+"Lost the lease on game between " + game['teams'][0]['name'] + " and " + game['teams'][1]['name'] + ", stopping it.")
+                abandonGame(game)
+
+def onMatchMessage(game, match, message):
+    """Handles the engine's messages about one match; see engine.py."""
+    stats.inc('engine_messages', command=message['command'])
+    if message['command'] == 'playerConnected':
+        match['connected'][int(message['team'])-1] = True
+        if all(match['connected']) and match['start'] is not None:
+            stats.observe('stage_seconds', (datetime.datetime.now() - match['start']).total_seconds(), stage='engine_connect')
+        print(prefix+game['teams'][int(message['team'])-1]['name'] + " connected in match against " + game['teams'][int(not bool(int(message['team'])-1))]['name'] + ".")
+    if message['command'] == 'gameReplay':
+        match['replay_data'] = message['matchData']
+        match['winner'] = int(message['winner']['teamID'])
+        if match['start'] is not None:
+            stats.observe('stage_seconds', (datetime.datetime.now() - match['start']).total_seconds(), stage='match_runtime')
+        print(prefix+"Match between " + game['teams'][0]['name'] + " and " + game['teams'][1]['name'] + " ended (" + ("red" if match['winner']==1 else "blue" if match['winner']==2 else "nobody") + " won).")
+
+        endGame(game)
+
+def startMatch(game, match, index, cur_map, bots):
+    """Create one match of a scrimmage and start its bots, once a slot is free.
+    Runs on the starter pool, so a scrimmage's maps start side by side."""
+    match_slots.acquire()
+    with state_lock:
+        abandoned = match['done']
+        match['slot'] = not abandoned
+    if abandoned:
+        match_slots.release()
+        return
 
-def startGame(teams, match_map):
-    command = json.dumps({"command":"createGame","sendReplay":True,"serverKey":config.SERVER_KEY,"teams":teams,"map":match_map,"sendReplay":True,"timeoutMS":1000000})
-    s.send(command.encode())
-    s.send(b'\n')
+    teams = [{"name":team['name'],"key":bot['key'],"db_id":team['db_id']} for team, bot in zip(game['teams'], bots)]
+    def gameReady():
+        if match['ng_id'] is not None:
+            return
+        try:
+            match['ng_id'] = created.result(timeout=CREATE_GAME_TIMEOUT)
+        except TimeoutError:
+            if created.cancel():
+                raise EngineError("the engine didn't create the game in " + str(CREATE_GAME_TIMEOUT) + " seconds")
+            # confirmed just as we gave up
+            match['ng_id'] = created.result()
+        stats.observe('stage_seconds', time.time() - requested, stage='create_game')
+        match['start'] = datetime.datetime.now()
+        stats.observe('claim_to_start_seconds', (match['start'] - game['claimed']).total_seconds())
 
-def getTeamRating(id, sneak):
-    while sneak['DB_BEING_USED']:
-        time.sleep(0.005)
-    sneak['DB_BEING_USED'] = True
     try:
-        c.execute("SELECT red_rating_after, finish_time FROM scrimmage_matches WHERE ranked = TRUE and status = 'completed' and red_team=%s ORDER BY finish_time DESC",[id])
-        redElos = c.fetchall()
+        requested = time.time()
+        created = engine.create_game(teams, cur_map, lambda message: onMatchMessage(game, match, message))
+        print(prefix + " --> Starting match " + str(index) + " of " + str(len(game['matches'])) + " on " + cur_map + ".")
+        # the bots are unpacked (and Python templates started) while the
+        # engine creates the game
+        sandboxes = runGame(bots, gameReady, created.port)
+        gameReady()
     except Exception as e:
-        redElos = []
-    
-    try:
-        c.execute("SELECT blue_rating_after, finish_time FROM scrimmage_matches WHERE ranked = TRUE and status = 'completed' and blue_team=%s ORDER BY finish_time DESC",[id])
-        blueElos = c.fetchall()
-    except Exception as e:
-        blueElos = []
-    sneak['DB_BEING_USED'] = False
-    if len(redElos+blueElos) == 0:
-        return ELO_START
-
-    elos = sorted(redElos+blueElos,key=lambda x: x[1],reverse=True)
-
-    elo = ELO_START
-    if len(elos) > 0:
-        elo = elos[0][0]
+        print(prefix + "Failed to start match on " + cur_map + ": " + str(e))
+        stats.inc('sandbox_failures', reason='start_error')
+        failGame(game, 'start_error')
+        return
+    match['sandboxes'] = sandboxes
+    if match['done'] and sandboxes is not None:
+        # the game was abandoned while the bots were starting
+        match['sandboxes'] = None
+        for sandbox in sandboxes:
+            sandbox.kill()
 
-    return elo
+def activeMatches():
+    return sum(1 for game in list(running_games) for match in game['matches'] if not match['done'])
 
+uploader = uploads.ReplayUploader(bucket, REPLAY_SPOOL_DIR, finishGame, workers=UPLOAD_WORKERS, queue_size=UPLOAD_QUEUE_SIZE)
+spooled = uploader.recover()
+if spooled > 0:
+    print(prefix + "Resuming " + str(spooled) + " spooled replay uploads.")
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 try:
-    s.connect(('127.0.0.1', 6147))
-    _thread.start_new_thread(listen, (running_games, s, sneak))
+    if ENGINE_PROCESSES > 0:
+        engine = EnginePool(ENGINE_COMMAND, ENGINE_PROCESSES, ENGINE_BASE_PORT, config.SERVER_KEY, on_crash=failEngineGames)
+        engine.start()
+    else:
+        engine = EngineConnection(('127.0.0.1', ENGINE_BASE_PORT), config.SERVER_KEY)
 except Exception as e:
-    print(prefix + "Failed to connect to engine. Exiting.")
+    print(prefix + "Failed to connect to engine (" + str(e) + "). Exiting.")
     sys.exit()
 
-print(prefix + "Connected to engine.  Queueing games now.")
+_thread.start_new_thread(heartbeat, ())
+
+stats.gauge('running_matches', activeMatches)
+stats.gauge('max_matches', max(MAX_GAMES,1))
+stats.gauge('queued_matches', lambda: matchqueue.queue_depth(database))
+stats.gauge('upload_backlog', uploader.backlog)
+stats.gauge('teardown_backlog', lambda: reaper().backlog())
+if ENGINE_PROCESSES > 0:
+    for port in range(len(engine.engines)):
+        stats.gauge('engine_games', lambda i=port: engine.loads()[i][1], engine=str(port))
+        stats.gauge('engine_latency_seconds', lambda i=port: engine.loads()[i][2] or 0, engine=str(port))
+try:
+    stats.serve(METRICS_PORT)
+except OSError as e:
+    print(prefix + "Failed to serve metrics on port " + str(METRICS_PORT) + ": " + str(e))
+
+print(prefix + "Connected to engine as node " + NODE_ID + ".  Queueing games now.")
 
+claimedGames = []
 while True:
-    try:
-        while sneak['DB_BEING_USED']:
-            sleep(0.005)
-        sneak['DB_BEING_USED'] = True        
-        c.execute("SELECT m.id AS id, red_team, blue_team, s1.source_code AS red_source, s2.source_code as blue_source, t1.name as red_name, t2.name as blue_name, maps FROM scrimmage_matches m INNER JOIN scrimmage_submissions s1 on m.red_submission=s1.id INNER JOIN scrimmage_submissions s2 on m.blue_submission=s2.id INNER JOIN battlecode_teams t1 on m.red_team=t1.id INNER JOIN battlecode_teams t2 on m.blue_team=t2.id WHERE status='queued' ORDER BY request_time ASC")
-    
-        queuedGames = c.fetchall()
-        sneak['DB_BEING_USED'] = False
-    except Exception as e:
-        conn.rollback()
-        time.sleep(0.005)
-        continue
-    
-    if len(running_games) >= max(MAX_GAMES,1) or len(queuedGames) < 1:
-        time.sleep(0.100)
-        for game in running_games:
+    runningCount = activeMatches()
+
+    # the finished games' replays have to go somewhere, so stop taking on
+    # new ones while their uploads are behind
+    if len(claimedGames) == 0 and runningCount < max(MAX_GAMES,1) and not uploader.full():
+        try:
+            claimedGames = matchqueue.claim_matches(database, CLAIM_BATCH, node_id=NODE_ID)
+            claimed_ids.update(queuedGame[0] for queuedGame in claimedGames)
+            claimTime = datetime.datetime.now()
+        except Exception as e:
+            print(prefix + "Failed to claim matches: " + str(e))
+
+    if len(claimedGames) < 1:
+        if runningCount >= max(MAX_GAMES,1):
+            time.sleep(0.100)
+        else:
+            queueWaiter.wait(QUEUE_POLL_TIME)
+        for game in list(running_games):
             for match in game['matches']:
-                timePassed = (datetime.datetime.now() - game['start']).total_seconds()
+                if match['start'] is None:
+                    continue
+                timePassed = (datetime.datetime.now() - match['start']).total_seconds()
                 if not all(match['connected']) and match['winner'] is None and timePassed > INIT_TIME:
                     winners = []
                     for i in range(2):
                         if match['connected'][i]:
                             winners.append(i+1)
                     match['winner'] = 0 if len(winners)==0 else winners[0]
-                    endGame(game,sneak)
+                    stats.inc('matches_timed_out')
+                    endGame(game)
                     print(prefix+"Match between " + game['teams'][0]['name'] + " and " + game['teams'][1]['name'] + " timed out (" + ("red" if match['winner']==1 else "blue" if match['winner']==2 else "nobody") + " won).")
         continue
 
-    queuedGame = queuedGames[0]
+    queuedGame = claimedGames.pop(0)
 
     try:
         print(prefix+"Queuing game between " + queuedGame[5] + " and " + queuedGame[6] + ".")
     except Exception as e:
         print(queuedGame)
+        claimed_ids.discard(queuedGame[0])
         time.sleep(0.005)
         continue
 
-    while sneak['DB_BEING_USED']:
-        time.sleep(0.005)
-    sneak['DB_BEING_USED'] = True
-    c.execute("UPDATE scrimmage_matches SET status='running' WHERE id=%s",[queuedGame[0]])
-    conn.commit()
-    sneak['DB_BEING_USED'] = False
-
-    bucket.download_file(queuedGame[3][49:], 'botA.tar.gz')
-    bucket.download_file(queuedGame[4][49:], 'botB.tar.gz')
-    
+    try:
+        with stats.timer('stage_seconds', stage='download'):
+            artifacts.fetch(sourceKey(queuedGame[3]))
+            artifacts.fetch(sourceKey(queuedGame[4]))
+    except Exception as e:
+        print(prefix + "Failed to download bots: " + str(e))
+        stats.inc('games_failed', reason='download')
+        results.record_failure(database, queuedGame[0], NODE_ID)
+        claimed_ids.discard(queuedGame[0])
+        continue
+
+    try:
+        artifacts.prefetch([sourceKey(source) for source in matchqueue.upcoming_sources(database, PREFETCH_MATCHES)])
+    except Exception as e:
+        print(prefix + "Failed to look ahead in the queue: " + str(e))
+
     maps = []
     for mapID in queuedGame[7]:
-        while sneak['DB_BEING_USED']:
-            time.sleep(0.005)
-        sneak['DB_BEING_USED'] = True
-        c.execute("SELECT name from scrimmage_maps WHERE id=%s",[mapID])
-        maps.append(c.fetchone()[0])
-        sneak['DB_BEING_USED'] = False
-
-    matches = []
-    teams = [{"name":queuedGame[5],"key":None,"db_id":queuedGame[1]},{"name":queuedGame[6],"key":None,"db_id":queuedGame[2]}]
-    running_games.append({'db_id':queuedGame[0],'start':datetime.datetime.now(),'teams':teams,'matches':matches})
+        maps.append(database.execute("SELECT name from scrimmage_maps WHERE id=%s",[mapID],fetch='one')[0])
+
+    # Every match exists up front so endGame waits for all of them, even
+    # those still waiting for a slot.
+    matches = [{"ng_id":None,"sandboxes":None,"connected":[False,False],"replay_data":None,"winner":None,"start":None,"done":False,"slot":False} for cur_map in maps]
+    teams = [{"name":queuedGame[5],"db_id":queuedGame[1],"submission":queuedGame[8]},{"name":queuedGame[6],"db_id":queuedGame[2],"submission":queuedGame[9]}]
+    game = {'db_id':queuedGame[0],'start':datetime.datetime.now(),'claimed':claimTime,'teams':teams,'matches':matches}
+    running_games.append(game)
+    claimed_ids.discard(game['db_id'])
     for index, cur_map in enumerate(maps):
-        redKey, blueKey = random_key(20), random_key(20)
-        bots = [{"botID": queuedGame[1], "key":redKey, "path": "botA.tar.gz"},{"botID": queuedGame[2], "key":blueKey, "path": "botB.tar.gz"}]
-
-        teams[0]['key'] = redKey
-        teams[1]['key'] = blueKey
-
-        startGame(teams,cur_map)
-        print(prefix + " --> Starting match " + str(index) + " of " + str(len(queuedGame[7])) + " on " + cur_map + ".")
-
-        while sneak['ng_id'] is None:
-            time.sleep(0.005)
-
-        matches.append({"ng_id":sneak['ng_id'],"sandboxes":runGame(bots),"connected":[False,False],"replay_data":None,"winner":None})
-        sneak['ng_id'] = None
-
-        if MAX_GAMES == 0:
-            while matches[-1]['winner'] is None:
-                time.sleep(0.100)
+        bots = [{"botID": queuedGame[1], "key":random_key(20), "source": sourceKey(queuedGame[3])},{"botID": queuedGame[2], "key":random_key(20), "source": sourceKey(queuedGame[4])}]
+        starter.submit(startMatch, game, matches[index], index, cur_map, bots)
 
 
 """
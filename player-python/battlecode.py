@@ -18,6 +18,7 @@ try:
 except:
     import json
 import threading
+import collections
 try:
     from queue import Queue
 except:
@@ -38,6 +39,15 @@ THROW_DELAY = 10
 MOVEMENT_DELAY = 1
 BUILD_DELAY = 10
 
+# side length, in tiles, of the buckets used to answer nearest-entity queries
+NEAREST_BUCKET_SIZE = 4
+
+# number of turns of changes kept for State.changed_since() and friends
+CHANGE_HISTORY_TURNS = 20
+
+_ZOBRIST_MASK = 2**64 - 1
+_ZOBRIST_SECTOR = 'sector'
+
 # terminal formatting
 _TERM_RED = '\033[31m'
 _TERM_END = '\033[0m'
@@ -226,6 +236,8 @@ class Entity(object):
         self.held_by = None
         self.holding = None
         self._disintegrated = False
+        # this entity's current contribution to State.zobrist
+        self._zobrist_value = 0
 
     def __str__(self):
         contents = '<id:{},type:{},team:{},location:{},hp:{}'.format(
@@ -263,46 +275,54 @@ class Entity(object):
     def __ne__(self, other):
         return not (self == other)
 
-    def _update(self, data):
-        if self.location in self._state.map._occupied and \
-            self._state.map._occupied[self.location].id == self.id:
-            del self._state.map._occupied[self.location]
+    def _update(self, record):
+        '''Apply a record produced by _digest_entities.'''
+        id, type, team_id, hp, location, cooldown_end, holding_end, \
+            held_by, holding = record
+        occupied = self._state.map._occupied
+
+        if self.location in occupied and occupied[self.location].id == self.id:
+            del occupied[self.location]
 
         if __debug__:
             if self.id is not None:
-                assert data['id'] == self.id
+                assert id == self.id
             if self.type is not None:
-                assert data['type'] == self.type
+                assert type == self.type
             if self.team is not None:
-                assert data['teamID'] == self.team.id
+                assert team_id == self.team.id
 
-        self.id = data['id']
-        self.type = data['type']
-        self.team = self._state.teams[data['teamID']]
-        self.hp = data['hp']
-        self.location = Location(data['location']['x'], data['location']['y'])
-
-        if 'cooldownEnd' in data:
-            self.cooldown_end = data['cooldownEnd']
-        else:
-            self.cooldown_end = None
-
-        if 'holdingEnd' in data:
-            self.holding_end = data['holdingEnd']
-        else:
-            self.holding_end = None
-
-        if 'heldBy' in data:
-            self.held_by = self._state.entities[data['heldBy']]
+        self.id = id
+        self.type = type
+        self.team = self._state.teams[team_id]
+        self.hp = hp
+        self.location = location
+        self.cooldown_end = cooldown_end
+        self.holding_end = holding_end
+
+        if held_by is not None:
+            self.held_by = self._state.entities[held_by]
         else:
             self.held_by = None
-            self._state.map._occupied[self.location] = self
+            occupied[location] = self
 
-        if 'holding' in data:
-            self.holding = self._state.entities[data['holding']]
+        if holding is not None:
+            self.holding = self._state.entities[holding]
         else:
             self.holding = None
 
+        # the first 8 fields of a record are exactly what _zobrist() hashes
+        value = _zobrist_key(record[:8])
+        self._state._zobrist ^= self._zobrist_value ^ value
+        self._zobrist_value = value
+
+    def _zobrist(self):
+        '''Compute this entity's contribution to State.zobrist.'''
+        return _zobrist_key((
+            self.id, self.type, self.team.id, self.hp, self.location,
+            self.cooldown_end, self.holding_end,
+            None if self.held_by is None else self.held_by.id))
+
     @property
     def cooldown(self):
         '''
@@ -490,12 +510,15 @@ class Entity(object):
 
         if self._state.speculate:
             if self.can_move(direction):
+                self._state._touch(self)
                 del self._state.map._occupied[self.location]
                 self.location = self.location.adjacent_location_in_direction(direction)
                 if self.holding != None:
+                    self._state._touch(self.holding)
                     self.holding.location = self.location
                 self._state.map._occupied[self.location] = self
                 self.cooldown_end = self._state.turn + 1
+                self._state._zobrist_commit()
 
     def queue_build(self, direction):
         '''
@@ -522,13 +545,16 @@ class Entity(object):
 
         if self._state.speculate:
             if self.can_build(direction):
+                self._state._touch(self)
                 self.cooldown_end = self._state.turn + 10
                 self._state._build_statue(location)
+                self._state._zobrist_commit()
 
     def _deal_damage(self, damage):
         if self._disintegrated:
             return
 
+        self._state._touch(self)
         self.hp -= damage
         if(self.hp>0):
             return
@@ -537,6 +563,7 @@ class Entity(object):
             del self._state.map._occupied[self.location]
 
         if self.holding != None:
+            self._state._touch(self.holding)
             self.holding.held_by = None
             self._state.map._occupied[self.location] = self.holding
 
@@ -559,6 +586,7 @@ class Entity(object):
 
         if self._state.speculate:
             self._deal_damage(self.hp+1)
+            self._state._zobrist_commit()
 
 
     def queue_throw(self, direction):
@@ -589,6 +617,8 @@ class Entity(object):
                 return
 
             held = self.holding
+            self._state._touch(self)
+            self._state._touch(held)
             self.holding = None
             self.holding_end = None
             initial = self.location
@@ -620,6 +650,7 @@ class Entity(object):
             held.held_by = None
 
             self.cooldown_end = self._state.turn + 10
+            self._state._zobrist_commit()
 
     def queue_pickup(self, entity):
         '''
@@ -643,12 +674,16 @@ class Entity(object):
 
         if self._state.speculate:
             if self.can_pickup(entity):
+                self._state._touch(self)
+                self._state._touch(entity)
                 del self._state.map._occupied[entity.location]
                 self.holding = entity
                 entity.held_by = self
                 entity.location = self.location
                 self.holding_end = self._state.turn + 10
                 self.cooldown_end = self._state.turn + 10
+                self._state._zobrist_commit()
+
     def entities_within_adjacent_distance(self, distance, include_held=False,
             iterator=None):
         '''
@@ -871,13 +906,22 @@ class Sector(object):
         self.top_left = top_left
         self.team = None
 
-    def _update(self, data):
-        if __debug__:
-            assert self.top_left.x == data['topLeft']['x']
-            assert self.top_left.y == data['topLeft']['y']
-
-        assert data['controllingTeamID']!=-1, "We Done goof"
-        self.team = self._state.teams[data['controllingTeamID']]
+    def _update(self, team_id):
+        '''Returns True if the controlling team changed.'''
+        assert team_id!=-1, "We Done goof"
+        team = self._state.teams[team_id]
+        flipped = team != self.team
+        if flipped:
+            self._state._zobrist ^= self._zobrist()
+            self.team = team
+            self._state._zobrist ^= self._zobrist()
+        return flipped
+
+    def _zobrist(self):
+        '''This sector's contribution to State.zobrist.'''
+        if self.team is None:
+            return 0
+        return _zobrist_key((_ZOBRIST_SECTOR, self.top_left, self.team.id))
 
     def __eq__(self, other):
         if not isinstance(other, Sector):
@@ -919,7 +963,7 @@ class Map(object):
         self._sectors = {}
 
         # occupied maps Location to Entity
-        self._occupied = {}
+        self._occupied = _OccupancyIndex()
         for x in range(0, self.width, self.sector_size):
             for y in range(0, self.height, self.sector_size):
                 top_left = Location(x, y)
@@ -970,13 +1014,134 @@ class Map(object):
         )
         return self._sectors[loc]
 
-    def _update_sectors(self, data):
-        for sector_data in data:
-            top_left = Location(sector_data['topLeft']['x'], sector_data['topLeft']['y'])
+    def _update_sectors(self, records):
+        '''
+        Apply records produced by _digest_sectors. Returns the top_left of
+        every sector whose controlling team changed.
+        '''
+        sectors = self._sectors
+        flipped = []
+        for top_left, team_id in records:
             if __debug__:
                 assert top_left.x % self.sector_size == 0
                 assert top_left.y % self.sector_size == 0
-            self._sectors[top_left]._update(sector_data)
+            if sectors[top_left]._update(team_id):
+                flipped.append(top_left)
+        return flipped
+
+    def _max_bucket_ring(self, location):
+        '''The widest bucket ring around location that still touches the map.'''
+        size = self._occupied.bucket_size
+        cx = location.x // size
+        cy = location.y // size
+        buckets_x = (self.width + size - 1) // size
+        buckets_y = (self.height + size - 1) // size
+        return max(cx, buckets_x - 1 - cx, cy, buckets_y - 1 - cy, 0)
+
+class _OccupancyIndex(object):
+    '''
+    Maps Location to the unheld Entity standing there. Entries are also kept
+    in a coarse grid of buckets so spatial queries only look at the part of
+    the map near the query point.
+    '''
+
+    def __init__(self, bucket_size=NEAREST_BUCKET_SIZE):
+        self.bucket_size = bucket_size
+        self._by_location = {}
+        # (bucket x, bucket y) maps to {Location: Entity}
+        self._buckets = {}
+
+    def _bucket_key(self, location):
+        return (location[0] // self.bucket_size, location[1] // self.bucket_size)
+
+    def __contains__(self, location):
+        return location in self._by_location
+
+    def __getitem__(self, location):
+        return self._by_location[location]
+
+    def __setitem__(self, location, entity):
+        self._by_location[location] = entity
+        key = self._bucket_key(location)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = {}
+        bucket[location] = entity
+
+    def __delitem__(self, location):
+        del self._by_location[location]
+        key = self._bucket_key(location)
+        bucket = self._buckets[key]
+        del bucket[location]
+        if not bucket:
+            del self._buckets[key]
+
+    def __iter__(self):
+        return iter(self._by_location)
+
+    def __len__(self):
+        return len(self._by_location)
+
+    def get(self, location, default=None):
+        return self._by_location.get(location, default)
+
+    def _filtered(self, accept):
+        '''A copy of this index holding only the entities accepted by accept.'''
+        index = _OccupancyIndex(self.bucket_size)
+        for location, entity in self._by_location.items():
+            if accept(entity):
+                index[location] = entity
+        return index
+
+    def _nearest(self, location, k, metric, max_ring, accept=None):
+        '''
+        Search rings of buckets outwards from location until no unvisited
+        bucket can hold anything closer than the k-th best match so far.
+        '''
+        if k <= 0 or not self._buckets:
+            return []
+        euclidean = metric == 'euclidean'
+        size = self.bucket_size
+        x, y = location[0], location[1]
+        cx, cy = x // size, y // size
+        buckets = self._buckets
+        found = []
+        ring = 0
+        while True:
+            if ring == 0:
+                keys = [(cx, cy)]
+            else:
+                keys = [(cx + i, cy + s) for i in range(-ring, ring + 1)
+                        for s in (-ring, ring)]
+                keys += [(cx + s, cy + j) for j in range(-ring + 1, ring)
+                         for s in (-ring, ring)]
+            for key in keys:
+                bucket = buckets.get(key)
+                if bucket is None:
+                    continue
+                for other, entity in bucket.items():
+                    if accept is not None and not accept(entity):
+                        continue
+                    dx = abs(other[0] - x)
+                    dy = abs(other[1] - y)
+                    if euclidean:
+                        dist = dx * dx + dy * dy
+                    else:
+                        dist = max(dx, dy)
+                    found.append((dist, entity.id, entity))
+            if ring >= max_ring:
+                break
+            if len(found) >= k:
+                found.sort()
+                # anything in the next ring is at least this far away
+                bound = ring * size + 1
+                if euclidean:
+                    bound *= bound
+                if found[k-1][0] < bound:
+                    break
+            ring += 1
+        found.sort()
+        return [entity for _, _, entity in found[:k]]
 
 class Team(object):
     '''
@@ -1008,6 +1173,9 @@ class State(object):
     Attributes:
         map (Map): This is the map
         turn (int): The turn number in this state
+        zobrist (int): A 64-bit hash of the entities and sector owners. Equal
+                       positions hash equally no matter how they were reached,
+                       within one run of your bot.
         teams ([Teams]): An array of teams indexed by id
         my_team (Team): My team
         my_team_id (int): The id of my team
@@ -1018,6 +1186,9 @@ class State(object):
     def __init__(self, game, teams, my_team_id, initialState):
         self._game = game
         self._max_id = 0
+        self._zobrist = 0
+        # entities changed since the last _zobrist_commit
+        self._zobrist_touched = {}
 
         self.map = Map(
             self,
@@ -1042,8 +1213,13 @@ class State(object):
 
         self._action_queue = []
 
-        self._update_entities(initialState['entities'])
-        self.map._update_sectors(initialState['sectors'])
+        # (turn, changed ids, dead ids, flipped sector top_lefts) for each of
+        # the last few applied turns, and the turn the oldest one starts from
+        self._history = collections.deque(maxlen=CHANGE_HISTORY_TURNS)
+        self._history_start = 0
+
+        self._update_entities(_digest_entities(initialState['entities']))
+        self.map._update_sectors(_digest_sectors(initialState['sectors']))
 
         self.speculate = True
 
@@ -1056,43 +1232,145 @@ class State(object):
     def _queue(self, action):
         self._game._queue(action)
 
-    def _update_entities(self, data):
-        for entity in data:
-            id = entity['id']
-            self._max_id = max(self._max_id, id)
-            if id not in self.entities:
-                self.entities[id] = Entity(self)
-            self.entities[id]._update(entity)
+    def _update_entities(self, records):
+        '''Apply records produced by _digest_entities.'''
+        entities = self.entities
+        max_id = self._max_id
+        # create new entities first: a record may refer to an entity that
+        # appears later in the batch through heldBy or holding
+        for record in records:
+            id = record[0]
+            if id not in entities:
+                entities[id] = Entity(self)
+                if id > max_id:
+                    max_id = id
+        for record in records:
+            entities[record[0]]._update(record)
+        self._max_id = max_id
+
+    def _apply_turn(self, turn):
+        '''
+        Apply a nextTurn message that has been through _digest_turn.
+        Returns the change set recorded for it.
+        '''
+        self._update_entities(turn['changed'])
+        self._kill_entities(turn['dead'])
+        flipped = self.map._update_sectors(turn['changedSectors'])
+        self.turn = turn['turn'] + 1
+
+        changes = (self.turn, tuple(record[0] for record in turn['changed']),
+                   tuple(turn['dead']), tuple(flipped))
+        if len(self._history) == self._history.maxlen:
+            self._history_start = self._history[0][0]
+        self._history.append(changes)
+        return changes
+
+    def _changes_since(self, turn, field):
+        if turn < self._history_start:
+            raise BattlecodeError('changes are only kept since turn {}'.format(
+                self._history_start))
+        found = set()
+        for changes in self._history:
+            if changes[0] > turn:
+                found.update(changes[field])
+        return found
+
+    def changed_since(self, turn):
+        '''
+        Entities the server reported as changed after the given turn, e.g.
+        because they moved, were damaged or were created. Only the last
+        CHANGE_HISTORY_TURNS turns are remembered.
+        Args:
+            turn (int): a turn number, usually the state.turn of an older state
+        Returns:
+            [Entity]: the changed entities that are still alive, by id
+        '''
+        ids = self._changes_since(turn, 1)
+        return [self.entities[id] for id in sorted(ids) if id in self.entities]
+
+    def died_since(self, turn):
+        '''
+        Ids of the entities that died after the given turn.
+        Args:
+            turn (int): a turn number, usually the state.turn of an older state
+        Returns:
+            set(int): the ids of the dead entities
+        '''
+        return self._changes_since(turn, 2)
+
+    def sectors_flipped_since(self, turn):
+        '''
+        Sectors whose controlling team changed after the given turn.
+        Args:
+            turn (int): a turn number, usually the state.turn of an older state
+        Returns:
+            [Sector]: the sectors, ordered by top_left
+        '''
+        top_lefts = self._changes_since(turn, 3)
+        return [self.map._sectors[top_left] for top_left in sorted(top_lefts)]
 
     def _build_statue(self, location):
         ''' Build a statue in this state at locatiion location '''
         self._max_id+=1
 
-        data ={
-            'id': self._max_id,
-            'teamID': self.my_team_id,
-            'type': Entity.STATUE,
-            'location': {
-                'x': location.x,
-                'y': location.y
-            },
-            'hp': 1
-        }
+        record = (self._max_id, Entity.STATUE, self.my_team_id, 1, location,
+                  None, None, None, None)
         self.entities[self._max_id] = Entity(self)
-        self.entities[self._max_id]._update(data)
+        self.entities[self._max_id]._update(record)
 
     def _kill_entities(self, entities):
         for dead in entities:
-            ent = self.entities[dead]
+            ent = self.entities.get(dead)
+            if ent is None:
+                # born and killed within a squashed backlog
+                continue
+            self._zobrist ^= ent._zobrist_value
+            ent._zobrist_value = 0
             if(ent.held_by == None):
-                if self.map._occupied[ent.location].id == ent.id:
+                occupant = self.map._occupied.get(ent.location)
+                if occupant is not None and occupant.id == ent.id:
                     del self.map._occupied[ent.location]
             del self.entities[dead]
 
+    @property
+    def zobrist(self):
+        return self._zobrist
+
+    def _touch(self, entity):
+        '''
+        Mark an entity whose hashed fields are being changed outside of
+        Entity._update. Call _zobrist_commit once the change is done.
+        '''
+        self._zobrist_touched[id(entity)] = entity
+
+    def _zobrist_commit(self):
+        '''Fold the changes to every touched entity into the hash.'''
+        h = self._zobrist
+        for entity in self._zobrist_touched.values():
+            h ^= entity._zobrist_value
+            if self.entities.get(entity.id) is entity:
+                entity._zobrist_value = entity._zobrist()
+            else:
+                entity._zobrist_value = 0
+            h ^= entity._zobrist_value
+        self._zobrist = h
+        self._zobrist_touched.clear()
+
+    def _compute_zobrist(self):
+        h = 0
+        for entity in self.entities.values():
+            h ^= entity._zobrist()
+        for sector in self.map._sectors.values():
+            h ^= sector._zobrist()
+        return h
+
     def _validate(self):
         for ent in self.entities.values():
             if not ent.is_held:
                 assert self.map._occupied[ent.location] == ent
+            assert ent._zobrist_value == ent._zobrist()
+        assert not self._zobrist_touched
+        assert self._zobrist == self._compute_zobrist()
 
     def _validate_keyframe(self, keyframe):
         altstate = State(self._game, self.teams, self.my_team.id, keyframe['state'])
@@ -1131,11 +1409,112 @@ class State(object):
                 continue
             yield entity
 
+    def nearest(self, location, k=1, entity_type=None, team=None,
+            metric='adjacent'):
+        '''
+        Find the entities closest to a location. Held entities are never
+        returned. Ties are broken by entity id.
+        Args:
+            location (Location): the location to search around
+
+        Optional Args:
+            k (int): the maximum number of entities to return
+            entity_type (string): only return entities of this type
+            team (Team): only return entities on this team
+            metric (string): 'adjacent' for max(abs(deltax), abs(deltay)) or
+                             'euclidean' for sqrt(deltax^2+deltay^2)
+        Returns:
+            [Entity]: up to k entities, closest first
+        '''
+        if metric not in ('adjacent', 'euclidean'):
+            raise BattlecodeError('unknown metric: '+str(metric))
+        accept = _entity_filter(entity_type, team)
+        return self.map._occupied._nearest(location, k, metric,
+            self.map._max_bucket_ring(location), accept)
+
+    def nearest_batch(self, locations, k=1, entity_type=None, team=None,
+            metric='adjacent'):
+        '''
+        Answer nearest() for many locations at once. The type and team
+        filters are only applied once, so this is much cheaper than calling
+        nearest() in a loop.
+        Args:
+            locations ([Location]): the locations to search around
+
+        Optional Args:
+            See nearest()
+        Returns:
+            [[Entity]]: the result of nearest() for each location, in order
+        '''
+        if metric not in ('adjacent', 'euclidean'):
+            raise BattlecodeError('unknown metric: '+str(metric))
+        index = self.map._occupied
+        accept = _entity_filter(entity_type, team)
+        if accept is not None:
+            index = index._filtered(accept)
+        return [index._nearest(location, k, metric,
+                    self.map._max_bucket_ring(location))
+                for location in locations]
+
+def _zobrist_key(values):
+    '''Hash a tuple to 64 well-mixed bits (splitmix64 finalizer).'''
+    x = hash(values) & _ZOBRIST_MASK
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _ZOBRIST_MASK
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _ZOBRIST_MASK
+    return x ^ (x >> 31)
+
+def _digest_entities(data):
+    '''
+    Convert entity dicts from the server into flat records for
+    Entity._update:
+    (id, type, teamID, hp, Location, cooldownEnd, holdingEnd, heldBy, holding)
+    with None for missing fields.
+    '''
+    return [(e['id'], e['type'], e['teamID'], e['hp'],
+             Location(e['location']['x'], e['location']['y']),
+             e.get('cooldownEnd'), e.get('holdingEnd'),
+             e.get('heldBy'), e.get('holding'))
+            for e in data]
+
+def _digest_sectors(data):
+    '''Convert sector dicts from the server into (top_left, teamID) records.'''
+    return [(Location(s['topLeft']['x'], s['topLeft']['y']),
+             s['controllingTeamID'])
+            for s in data]
+
+# Game._pushback when nothing is pushed back
+_NOTHING = object()
+
+def _digest_turn(turn):
+    '''
+    Replace the bulky parts of a nextTurn message with records that can be
+    applied directly. Runs on the communication thread, so the bot's thread
+    only has to do State._apply_turn.
+    '''
+    turn['changed'] = _digest_entities(turn['changed'])
+    turn['dead'] = tuple(turn['dead'])
+    turn['changedSectors'] = _digest_sectors(turn['changedSectors'])
+    return turn
+
+def _entity_filter(entity_type, team):
+    if entity_type is None and team is None:
+        return None
+    def accept(entity):
+        if entity_type is not None and entity.type != entity_type:
+            return False
+        if team is not None and entity.team != team:
+            return False
+        return True
+    return accept
+
+# the manager runs several engines on different ports, and tells each bot
+# which one its game is on
+DEFAULT_PORT = int(os.environ.get('BATTLECODE_PORT', 6147))
 if 'BATTLECODE_IP' not in os.environ:
-    DEFAULT_SERVER = ('localhost', 6147)
+    DEFAULT_SERVER = ('localhost', DEFAULT_PORT)
 else:
-    print('Connecting to', (os.environ['BATTLECODE_IP'], 6147))
-    DEFAULT_SERVER = (os.environ['BATTLECODE_IP'], 6147)
+    print('Connecting to', (os.environ['BATTLECODE_IP'], DEFAULT_PORT))
+    DEFAULT_SERVER = (os.environ['BATTLECODE_IP'], DEFAULT_PORT)
 
 class Game(object):
     '''
@@ -1144,14 +1523,24 @@ class Game(object):
     Create a for loop which iterates through game.turns to play the game. It
     will give a state for each turn with which you can see and perform
     actions.
+    Attributes:
+        on_entity_changed (function): if set, called with each Entity the
+                                      server reports as changed
+        on_sector_flipped (function): if set, called with each Sector whose
+                                      controlling team changes
+        The callbacks are given objects from the game's own state, not the
+        copy yielded by turns(); use them to update caches, not to queue
+        actions.
     '''
 
-    def __init__(self, name, server=DEFAULT_SERVER):
+    def __init__(self, name, server=DEFAULT_SERVER, catch_up=True):
         '''Connect to the server and wait for the first turn.
         name is the name this bot would like to be called; it will be ignored on the
         scrimmage server.
         Server is the address to connect to. Leave it as None to connect to a default local
-        server; you shouldn't need to mess with it unless you're making custom matchmaking stuff.'''
+        server; you shouldn't need to mess with it unless you're making custom matchmaking stuff.
+        If catch_up is set and several turns have piled up while the bot was busy, they are
+        merged and applied as one, so the bot only pays for the state it will actually see.'''
 
         assert isinstance(name, str) \
                and len(name) > 5 and len(name) < 100, \
@@ -1182,6 +1571,12 @@ class Game(object):
         self._send(login)
 
         self._recv_queue = Queue()
+        # a message taken off the queue that still needs to be handled; None
+        # (end of stream) can be pushed back too, so _NOTHING means empty
+        self._pushback = _NOTHING
+        self.catch_up = catch_up
+        self.on_entity_changed = None
+        self.on_sector_flipped = None
 
         self._missed_turns = set()
 
@@ -1250,11 +1645,16 @@ class Game(object):
             elif result['command'] == 'missedTurn':
                 sys.stderr.write('Battlecode warning: missed turn {}, speed up your code!\n'.format(result['turn']))
                 self._missed_turns.add(result['turn'])
+            elif result['command'] == 'nextTurn':
+                self._recv_queue.put(_digest_turn(result))
             else:
                 self._recv_queue.put(result)
 
     def _recv(self):
         '''Pull a message from our queue; blocking.'''
+        if self._pushback is not _NOTHING:
+            item, self._pushback = self._pushback, _NOTHING
+            return item
         while True:
             try:
                 item = self._recv_queue.get(block=True, timeout=.1)
@@ -1265,7 +1665,7 @@ class Game(object):
                 continue
 
     def _can_recv_more(self):
-        return not self._recv_queue.empty()
+        return self._pushback is not _NOTHING or not self._recv_queue.empty()
 
     def _finish(self, winner_id):
         if self._socket is not None:
@@ -1291,30 +1691,79 @@ class Game(object):
 
             assert turn['command'] == 'nextTurn'
 
-            self.state._update_entities(turn['changed'])
-            self.state._kill_entities(turn['dead'])
-            self.state.map._update_sectors(turn['changedSectors'])
+            if __debug__:
+                self._report_failures(turn)
 
-            self.state.turn = turn['turn'] + 1
+            if self.catch_up and 'winnerID' not in turn and self._can_recv_more():
+                turn = self._squash_backlog(turn)
+
+            changes = self.state._apply_turn(turn)
+            self._notify(changes)
 
             if 'winnerID' in turn:
                 self._finish(turn['winnerID'])
                 return
 
-            if __debug__:
-                if turn['lastTeamID'] == self.state.my_team.id:
-                    # handle what happened last turn
-                    for action, reason in zip(turn['failed'], turn['reasons']):
-                        print('failed: {}:{} reason: {}'.format(
-                            action['id'],
-                            action['action'],
-                            self.state.turn,
-                            reason,
-                        ))
-
             if turn['nextTeamID'] == self.state.my_team.id and not self._can_recv_more():
                 return
 
+    def _notify(self, changes):
+        _, changed, _, flipped = changes
+        if self.on_entity_changed is not None:
+            for id in changed:
+                entity = self.state.entities.get(id)
+                if entity is not None:
+                    self.on_entity_changed(entity)
+        if self.on_sector_flipped is not None:
+            for top_left in flipped:
+                self.on_sector_flipped(self.state.map._sectors[top_left])
+
+    def _report_failures(self, turn):
+        if turn['lastTeamID'] == self.state.my_team.id:
+            # handle what happened last turn
+            for action, reason in zip(turn['failed'], turn['reasons']):
+                print('failed: {}:{} reason: {}'.format(
+                    action['id'],
+                    action['action'],
+                    turn['turn'] + 1,
+                    reason,
+                ))
+
+    def _squash_backlog(self, turn):
+        '''
+        Merge turn and every nextTurn already waiting behind it into a single
+        nextTurn. The last record for an entity or sector wins, and an entity
+        that died anywhere in the backlog stays dead.
+        '''
+        changed = {}
+        dead = set()
+        sectors = {}
+        while True:
+            for record in turn['changed']:
+                if record[0] not in dead:
+                    changed[record[0]] = record
+            for id in turn['dead']:
+                dead.add(id)
+                changed.pop(id, None)
+            for top_left, team_id in turn['changedSectors']:
+                sectors[top_left] = team_id
+
+            if 'winnerID' in turn or not self._can_recv_more():
+                break
+            following = self._recv()
+            if following is None or following['command'] != 'nextTurn':
+                self._pushback = following
+                break
+            if __debug__:
+                self._report_failures(following)
+            turn = following
+
+        squashed = dict(turn)
+        squashed['changed'] = list(changed.values())
+        squashed['dead'] = tuple(dead)
+        squashed['changedSectors'] = list(sectors.items())
+        return squashed
+
     def _submit_turn(self):
         if self.state.turn in self._missed_turns:
             self.state._action_queue = []
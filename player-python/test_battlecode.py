@@ -0,0 +1,433 @@
+'''Tests for the client library that don't need an engine.
+
+    python -m pytest player-python
+'''
+
+import random
+import threading
+import unittest
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import battlecode
+from battlecode import Direction, Entity, Location, State, Team
+
+
+def _entity(id, type, team_id, x, y, hp=10, **extra):
+    data = {'id': id, 'type': type, 'teamID': team_id, 'hp': hp,
+            'location': {'x': x, 'y': y}}
+    data.update(extra)
+    return data
+
+def _teams():
+    return {0: Team(0, 'neutral'), 1: Team(1, 'red'), 2: Team(2, 'blue')}
+
+def _state(entities, width=20, height=20, sector_size=5, game=None):
+    initial = {
+        'width': width,
+        'height': height,
+        'tiles': [['G'] * width for _ in range(height)],
+        'sectorSize': sector_size,
+        'entities': entities,
+        'sectors': [{'topLeft': {'x': x, 'y': y}, 'controllingTeamID': 0}
+                    for x in range(0, width, sector_size)
+                    for y in range(0, height, sector_size)],
+    }
+    return State(game, _teams(), 1, initial)
+
+def _random_entities(rng, count, width, height):
+    locations = rng.sample([(x, y) for x in range(width) for y in range(height)], count)
+    return [_entity(id, rng.choice([Entity.THROWER, Entity.STATUE, Entity.HEDGE]),
+                    rng.choice([0, 1, 2]), x, y)
+            for id, (x, y) in enumerate(locations, 1)]
+
+
+class TestNearest(unittest.TestCase):
+
+    def brute_force(self, state, location, k, entity_type, team, metric):
+        found = []
+        for entity in state.entities.values():
+            if entity.is_held:
+                continue
+            if entity_type is not None and entity.type != entity_type:
+                continue
+            if team is not None and entity.team != team:
+                continue
+            dx = abs(entity.location.x - location.x)
+            dy = abs(entity.location.y - location.y)
+            dist = dx * dx + dy * dy if metric == 'euclidean' else max(dx, dy)
+            found.append((dist, entity.id))
+        return [id for _, id in sorted(found)[:k]]
+
+    def test_matches_brute_force(self):
+        rng = random.Random(26)
+        for width, height, count in [(20, 20, 60), (37, 11, 25), (50, 50, 5), (8, 8, 64)]:
+            state = _state(_random_entities(rng, count, width, height), width, height)
+            queries = [Location(rng.randrange(width), rng.randrange(height)) for _ in range(20)]
+            for metric in ('adjacent', 'euclidean'):
+                for k in (1, 3, 10, count + 5):
+                    for entity_type, team in [(None, None), (Entity.STATUE, None),
+                                              (None, state.teams[2]),
+                                              (Entity.THROWER, state.teams[1])]:
+                        batch = state.nearest_batch(queries, k, entity_type, team, metric)
+                        for location, result in zip(queries, batch):
+                            expected = self.brute_force(state, location, k, entity_type, team, metric)
+                            self.assertEqual([e.id for e in state.nearest(location, k, entity_type, team, metric)], expected)
+                            self.assertEqual([e.id for e in result], expected)
+
+    def test_follows_moves_and_deaths(self):
+        state = _state([_entity(1, Entity.THROWER, 1, 0, 0),
+                        _entity(2, Entity.THROWER, 2, 19, 19)])
+        self.assertEqual([e.id for e in state.nearest(Location(18, 18))], [2])
+        state._update_entities(battlecode._digest_entities([_entity(1, Entity.THROWER, 1, 17, 17)]))
+        self.assertEqual([e.id for e in state.nearest(Location(16, 16))], [1])
+        state._kill_entities([1])
+        self.assertEqual([e.id for e in state.nearest(Location(16, 16), k=5)], [2])
+
+    def test_skips_held_entities(self):
+        state = _state([_entity(1, Entity.THROWER, 1, 3, 3, holding=2),
+                        _entity(2, Entity.THROWER, 1, 3, 3, heldBy=1)])
+        self.assertEqual([e.id for e in state.nearest(Location(3, 3), k=5)], [1])
+
+    def test_empty_and_bad_metric(self):
+        state = _state([])
+        self.assertEqual(state.nearest(Location(1, 1), k=3), [])
+        self.assertEqual(state.nearest_batch([Location(1, 1)], k=3), [[]])
+        with self.assertRaises(battlecode.BattlecodeError):
+            state.nearest(Location(1, 1), metric='manhattan')
+
+
+def _turn(number, changed=(), dead=(), sectors=(), winner=None):
+    turn = {'command': 'nextTurn', 'turn': number, 'lastTeamID': 2,
+            'nextTeamID': 1, 'failed': [], 'reasons': [],
+            'changed': list(changed), 'dead': list(dead),
+            'changedSectors': [{'topLeft': {'x': x, 'y': y}, 'controllingTeamID': team}
+                               for (x, y), team in sectors]}
+    if winner is not None:
+        turn['winnerID'] = winner
+    return battlecode._digest_turn(turn)
+
+def _offline_game(entities):
+    """A Game fed from its queue by the test instead of a socket."""
+    game = battlecode.Game.__new__(battlecode.Game)
+    game._socket = None
+    game._recv_queue = Queue()
+    game._pushback = battlecode._NOTHING
+    game.catch_up = True
+    game.on_entity_changed = None
+    game.on_sector_flipped = None
+    game._missed_turns = set()
+    game.winner = None
+    game.state = _state(entities, game=game)
+    return game
+
+
+class TestSquashBacklog(unittest.TestCase):
+
+    ENTITIES = [_entity(1, Entity.THROWER, 1, 0, 0),
+                _entity(2, Entity.THROWER, 2, 5, 5),
+                _entity(3, Entity.STATUE, 2, 9, 9)]
+
+    def backlog(self):
+        return [
+            _turn(0, changed=[_entity(1, Entity.THROWER, 1, 1, 1),
+                              _entity(4, Entity.STATUE, 1, 2, 2)],
+                  sectors=[((0, 0), 1), ((5, 5), 2)]),
+            _turn(1, changed=[_entity(1, Entity.THROWER, 1, 2, 1),
+                              _entity(2, Entity.THROWER, 2, 6, 5, hp=4)],
+                  dead=[3], sectors=[((0, 0), 2)]),
+            _turn(2, changed=[_entity(5, Entity.STATUE, 2, 7, 7)],
+                  dead=[4, 5], sectors=[((10, 10), 1)]),
+        ]
+
+    def await_turn(self, game):
+        thread = threading.Thread(target=game._await_turn)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), '_await_turn hung')
+
+    def test_squash_matches_turn_by_turn(self):
+        stepped = _state(self.ENTITIES)
+        for turn in self.backlog():
+            stepped._apply_turn(turn)
+
+        game = _offline_game(self.ENTITIES)
+        backlog = self.backlog()
+        for turn in backlog[1:]:
+            game._recv_queue.put(turn)
+        squashed = game._squash_backlog(backlog[0])
+        self.assertEqual(squashed['turn'], 2)
+        self.assertEqual(sorted(squashed['dead']), [3, 4, 5])
+        self.assertEqual(sorted(record[0] for record in squashed['changed']), [1, 2])
+        self.assertEqual(dict(squashed['changedSectors']),
+                         {Location(0, 0): 2, Location(5, 5): 2, Location(10, 10): 1})
+
+        state = game.state
+        flipped = state._apply_turn(squashed)[3]
+        self.assertEqual(sorted(flipped), [Location(0, 0), Location(5, 5), Location(10, 10)])
+        self.assertEqual(state.turn, stepped.turn)
+        self.assertEqual(sorted(state.entities), sorted(stepped.entities))
+        for id in state.entities:
+            self.assertEqual(state.entities[id], stepped.entities[id])
+        for top_left in state.map._sectors:
+            self.assertEqual(state.map._sectors[top_left].team, stepped.map._sectors[top_left].team)
+        self.assertEqual(state.zobrist, stepped.zobrist)
+        state._validate()
+
+    def test_stops_at_other_messages(self):
+        game = _offline_game(self.ENTITIES)
+        first, second, third = self.backlog()
+        keyframe = {'command': 'keyframe', 'state': {}}
+        game._recv_queue.put(second)
+        game._recv_queue.put(keyframe)
+        game._recv_queue.put(third)
+        squashed = game._squash_backlog(first)
+        self.assertEqual(squashed['turn'], 1)
+        self.assertIs(game._recv(), keyframe)
+        self.assertIs(game._recv(), third)
+
+    def test_stops_at_winner(self):
+        game = _offline_game(self.ENTITIES)
+        first, second, third = self.backlog()
+        second['winnerID'] = 2
+        game._recv_queue.put(second)
+        game._recv_queue.put(third)
+        squashed = game._squash_backlog(first)
+        self.assertEqual(squashed['winnerID'], 2)
+        self.assertIs(game._recv(), third)
+
+    def test_end_of_stream(self):
+        game = _offline_game(self.ENTITIES)
+        for turn in self.backlog():
+            game._recv_queue.put(turn)
+        game._recv_queue.put(None)
+        self.await_turn(game)
+        self.assertEqual(game.state.turn, 3)
+        self.assertIs(game.winner, game.state.teams[0])
+
+    def test_end_of_stream_without_backlog(self):
+        game = _offline_game(self.ENTITIES)
+        game._recv_queue.put(None)
+        self.await_turn(game)
+        self.assertIs(game.winner, game.state.teams[0])
+
+    def test_winner_after_backlog(self):
+        game = _offline_game(self.ENTITIES)
+        for turn in self.backlog():
+            game._recv_queue.put(turn)
+        game._recv_queue.put(_turn(3, winner=1))
+        self.await_turn(game)
+        self.assertEqual(game.state.turn, 4)
+        self.assertIs(game.winner, game.state.teams[1])
+
+
+class TestHistory(unittest.TestCase):
+
+    ENTITIES = TestSquashBacklog.ENTITIES
+
+    def backlog(self, start=0):
+        return [
+            _turn(start, changed=[_entity(1, Entity.THROWER, 1, 1, 1),
+                                  _entity(4, Entity.STATUE, 1, 2, 2)],
+                  sectors=[((0, 0), 1), ((5, 5), 2)]),
+            _turn(start + 1, changed=[_entity(1, Entity.THROWER, 1, 2, 1),
+                                      _entity(2, Entity.THROWER, 2, 6, 5, hp=4)],
+                  dead=[3], sectors=[((0, 0), 2)]),
+            _turn(start + 2, changed=[_entity(5, Entity.STATUE, 2, 7, 7)],
+                  dead=[4, 5], sectors=[((10, 10), 1)]),
+        ]
+
+    await_turn = TestSquashBacklog.await_turn
+
+    def test_since(self):
+        state = _state(self.ENTITIES)
+        for turn in self.backlog():
+            state._apply_turn(turn)
+        self.assertEqual(state.turn, 3)
+
+        self.assertEqual([e.id for e in state.changed_since(0)], [1, 2])
+        self.assertEqual([e.id for e in state.changed_since(1)], [1, 2])
+        self.assertEqual(state.changed_since(2), [])
+        self.assertIs(state.changed_since(0)[0], state.entities[1])
+
+        self.assertEqual(state.died_since(0), {3, 4, 5})
+        self.assertEqual(state.died_since(2), {4, 5})
+        self.assertEqual(state.died_since(3), set())
+
+        self.assertEqual([s.top_left for s in state.sectors_flipped_since(0)],
+                         [Location(0, 0), Location(5, 5), Location(10, 10)])
+        self.assertEqual([s.top_left for s in state.sectors_flipped_since(1)],
+                         [Location(0, 0), Location(10, 10)])
+        self.assertEqual(state.sectors_flipped_since(3), [])
+
+    def test_evicted_history(self):
+        state = _state(self.ENTITIES)
+        for turn in self.backlog():
+            state._apply_turn(turn)
+        for number in range(3, 3 + battlecode.CHANGE_HISTORY_TURNS):
+            state._apply_turn(_turn(number))
+        oldest = state.turn - battlecode.CHANGE_HISTORY_TURNS
+        self.assertEqual(state.changed_since(oldest), [])
+        self.assertEqual(state.died_since(oldest), set())
+        self.assertEqual(state.sectors_flipped_since(oldest), [])
+        for since in (state.changed_since, state.died_since, state.sectors_flipped_since):
+            with self.assertRaises(battlecode.BattlecodeError):
+                since(oldest - 1)
+
+    def callbacks(self, game):
+        changed = []
+        flipped = []
+        game.on_entity_changed = lambda entity: changed.append(entity)
+        game.on_sector_flipped = lambda sector: flipped.append(sector)
+        return changed, flipped
+
+    def test_callbacks_turn_by_turn(self):
+        game = _offline_game(self.ENTITIES)
+        game.catch_up = False
+        changed, flipped = self.callbacks(game)
+        for turn in self.backlog():
+            game._recv_queue.put(turn)
+        self.await_turn(game)
+        # entity 5 died in the turn it was created in, so it's never reported
+        self.assertEqual([entity.id for entity in changed], [1, 4, 1, 2])
+        self.assertEqual([sector.top_left for sector in flipped],
+                         [Location(0, 0), Location(5, 5), Location(0, 0), Location(10, 10)])
+        for entity in changed:
+            self.assertIs(entity, game.state.entities.get(entity.id, entity))
+        self.assertIs(flipped[0], game.state.map._sectors[Location(0, 0)])
+
+    def test_callbacks_after_catch_up(self):
+        game = _offline_game(self.ENTITIES)
+        changed, flipped = self.callbacks(game)
+        for turn in self.backlog():
+            game._recv_queue.put(turn)
+        self.await_turn(game)
+        self.assertEqual(sorted(entity.id for entity in changed), [1, 2])
+        self.assertEqual(game.state.entities[1].location, Location(2, 1))
+        self.assertEqual(sorted(sector.top_left for sector in flipped),
+                         [Location(0, 0), Location(5, 5), Location(10, 10)])
+        self.assertEqual(game.state.map._sectors[Location(0, 0)].team, game.state.teams[2])
+
+    def test_catch_up_with_full_history(self):
+        game = _offline_game(self.ENTITIES)
+        state = game.state
+        for number in range(battlecode.CHANGE_HISTORY_TURNS):
+            state._apply_turn(_turn(number))
+        self.assertEqual(state.changed_since(0), [])
+
+        # three turns squashed into one are one entry in the history, so
+        # only the oldest turn is evicted to make room
+        for turn in self.backlog(state.turn):
+            game._recv_queue.put(turn)
+        self.await_turn(game)
+        self.assertEqual(state.turn, battlecode.CHANGE_HISTORY_TURNS + 3)
+        self.assertEqual([e.id for e in state.changed_since(1)], [1, 2])
+        with self.assertRaises(battlecode.BattlecodeError):
+            state.changed_since(0)
+        # the squashed changes are reported after every turn they cover
+        for since in range(battlecode.CHANGE_HISTORY_TURNS, state.turn):
+            self.assertEqual([e.id for e in state.changed_since(since)], [1, 2])
+            self.assertEqual(state.died_since(since), {3, 4, 5})
+            self.assertEqual(len(state.sectors_flipped_since(since)), 3)
+        self.assertEqual(state.changed_since(state.turn), [])
+
+
+def _speculative(game):
+    """The copy of game.state that Game.turns() yields."""
+    game.state._game = None
+    copy = battlecode._deepcopy(game.state)
+    copy._game = game
+    game.state._game = game
+    return copy
+
+
+class TestZobrist(unittest.TestCase):
+
+    ENTITIES = [_entity(1, Entity.THROWER, 1, 5, 5),
+                _entity(2, Entity.THROWER, 1, 6, 5),
+                _entity(3, Entity.THROWER, 2, 9, 5),
+                _entity(4, Entity.STATUE, 2, 5, 9)]
+
+    def test_initial_hash_matches_full_recompute(self):
+        state = _state(self.ENTITIES)
+        self.assertNotEqual(state.zobrist, 0)
+        self.assertEqual(state.zobrist, state._compute_zobrist())
+        state._validate()
+
+    def test_equal_positions_hash_equal(self):
+        game = _offline_game(self.ENTITIES)
+        a = _speculative(game)
+        a.entities[1].queue_move(Direction.NORTH)
+        a.entities[2].queue_move(Direction.EAST)
+        b = _speculative(game)
+        b.entities[2].queue_move(Direction.EAST)
+        b.entities[1].queue_move(Direction.NORTH)
+        a._validate()
+        b._validate()
+        self.assertEqual(a.zobrist, b.zobrist)
+        self.assertNotEqual(a.zobrist, game.state.zobrist)
+
+    def test_speculation_leaves_the_game_state_alone(self):
+        game = _offline_game(self.ENTITIES)
+        before = game.state.zobrist
+        spec = _speculative(game)
+        spec.entities[2].queue_build(Direction.SOUTH)
+        spec._validate()
+        spec.entities[1].queue_pickup(spec.entities[2])
+        spec._validate()
+        self.assertNotEqual(spec.zobrist, before)
+        # throwing away the copy is the rollback
+        self.assertEqual(game.state.zobrist, before)
+        game.state._validate()
+
+    def test_speculated_move_matches_the_server(self):
+        game = _offline_game(self.ENTITIES)
+        spec = _speculative(game)
+        spec.entities[1].queue_move(Direction.WEST)
+        game.state._apply_turn(_turn(0, changed=[
+            _entity(1, Entity.THROWER, 1, 4, 5, cooldownEnd=1)]))
+        game.state._validate()
+        self.assertEqual(game.state.zobrist, spec.zobrist)
+
+    def test_throw_and_disintegrate(self):
+        game = _offline_game(self.ENTITIES)
+        game.state._apply_turn(_turn(0, changed=[
+            _entity(1, Entity.THROWER, 1, 5, 5, holding=2),
+            _entity(2, Entity.THROWER, 1, 5, 5, heldBy=1)]))
+        game.state._validate()
+        spec = _speculative(game)
+        spec.entities[1].queue_throw(Direction.EAST)
+        spec._validate()
+        spec = _speculative(game)
+        spec.entities[1].queue_disintegrate()
+        spec._validate()
+        self.assertNotIn(1, spec.entities)
+        self.assertFalse(spec.entities[2].is_held)
+
+    def test_changes_undone_restore_the_hash(self):
+        state = _state(self.ENTITIES)
+        before = state.zobrist
+        state._apply_turn(_turn(0, changed=[_entity(3, Entity.THROWER, 2, 10, 5, hp=7)],
+                                sectors=[((0, 0), 1)]))
+        changed = state.zobrist
+        self.assertNotEqual(changed, before)
+        state._apply_turn(_turn(1, changed=[_entity(3, Entity.THROWER, 2, 9, 5)],
+                                sectors=[((0, 0), 0)]))
+        state._validate()
+        self.assertEqual(state.zobrist, before)
+
+    def test_deaths_and_births(self):
+        state = _state(self.ENTITIES)
+        before = state.zobrist
+        state._apply_turn(_turn(0, changed=[_entity(5, Entity.STATUE, 1, 1, 1)], dead=[4]))
+        state._validate()
+        state._apply_turn(_turn(1, changed=[_entity(4, Entity.STATUE, 2, 5, 9)], dead=[5]))
+        state._validate()
+        self.assertEqual(state.zobrist, before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,19 +8,6 @@ rounds = 0
 
 start = time.clock()
 
-def nearest_glass_state(state, entity):
-    nearest_statue = None
-    nearest_dist = 10000
-    for other_entity in state.get_entities(entity_type=battlecode.Entity.STATUE):
-        if(entity == other_entity):
-            continue
-        dist = entity.location.adjacent_distance_to(other_entity.location)
-        if(dist< nearest_dist):
-            dist = nearest_dist
-            nearest_statue = other_entity
-
-    return nearest_statue
-
 for state in game.turns():
     for entity in state.get_entities(team=state.my_team):
 
@@ -38,8 +25,9 @@ for state in game.turns():
             if entity.can_pickup(pickup_entity):
                 entity.queue_pickup(pickup_entity)
 
-        statue = nearest_glass_state(state, entity)
-        if(statue != None):
+        statues = state.nearest(entity.location, entity_type=battlecode.Entity.STATUE)
+        if statues:
+            statue = statues[0]
             direction = entity.location.direction_to(statue.location)
             if entity.can_throw(direction):
                 entity.queue_throw(direction)
@@ -659,25 +659,30 @@ export default class Server {
                 this.error("unimplemented command: "+(<any>command).command);
             }
         } catch (e) {
+            // lets a client with several requests in flight tell which failed
+            let requestID = (<any>command).requestID;
             if (e instanceof ClientError) {
                 // their fault
                 client.send({
                     command: "error",
-                    reason: e.message
+                    reason: e.message,
+                    requestID: requestID
                 });
                 this.error(`Error from client ${prettyID(client.id)}: ${e.stack}`)
             } else if (e instanceof Error) {
                 // our fault
                 client.send({
                     command: "error",
-                    reason: "Internal server error: "+e.message
+                    reason: "Internal server error: "+e.message,
+                    requestID: requestID
                 });
                 this.error(`Internal server error: ${e.stack}`);
             } else {
                 // still our fault
                 client.send({
                     command: "error",
-                    reason: "Internal server error: "+JSON.stringify(e)
+                    reason: "Internal server error: "+JSON.stringify(e),
+                    requestID: requestID
                 });
                 this.error(`Internal server error: ${JSON.stringify(e)}`);
             }
@@ -804,7 +809,8 @@ export default class Server {
         this.log(`Created ${lobby.isPickup? 'pickup ':''}game ${prettyID(lobby.id)} on map ${lobby.map.mapName}`);
         client.send({
             command: "createGameConfirm",
-            gameID: lobby.id
+            gameID: lobby.id,
+            requestID: createGame.requestID
         });
     }
 
@@ -290,6 +290,11 @@ export interface MissedTurn {
 export interface ErrorCommand {
     command: "error";
     reason: string;
+
+    /**
+     * The requestID of the command that failed, if it had one.
+     */
+    requestID?: string;
 }
 
 /**
@@ -356,12 +361,23 @@ export interface CreateGame {
      * If you don't want a timeout, just set it really high.
      */
     timeoutMS?: number;
+
+    /**
+     * Echoed back in the CreateGameConfirm, so a client with several createGame
+     * requests in flight can tell which confirmation belongs to which request.
+     */
+    requestID?: string;
 }
 
 export interface CreateGameConfirm {
     command: "createGameConfirm";
 
     gameID: GameID;
+
+    /**
+     * The requestID of the CreateGame this confirms, if it had one.
+     */
+    requestID?: string;
 }
 
 export interface ListMapsRequest {